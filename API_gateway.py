@@ -1,16 +1,25 @@
 import json
+import threading
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
 import os
+from daemon import profiler
+from daemon.compression import ASSET_CACHE, MIN_COMPRESS_SIZE, choose_encoding, compress, parse_accept_encoding
+from daemon.fingerprint import FINGERPRINTS, IMMUTABLE_CACHE_CONTROL, PAGE_CACHE_CONTROL
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Endpoints other origins must not call from a browser
+SAME_ORIGIN_PATHS = ('/share', '/admin/')
 
 class API(BaseHTTPRequestHandler):    
     def do_OPTIONS(self):
         self.send_response(204)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        if not self.path.startswith(SAME_ORIGIN_PATHS):
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
 
     def do_GET(self):
@@ -19,7 +28,20 @@ class API(BaseHTTPRequestHandler):
 
         try:
             if self.path == '/messages':
-                message_text = ui_queue.get(timeout=2)
+                if not self.server.long_polls.acquire(blocking=False):
+                    # Every long-poll slot is busy; the rest of the pool stays
+                    # free for the other endpoints and the client retries
+                    self.send_error(503)
+                    return
+                try:
+                    message_text = ui_queue.get(timeout=2)
+                except Empty:
+                    self.send_response(204)
+                    self.send_header('Access-Control-Allow-Origin', '*')
+                    self.end_headers()
+                    return
+                finally:
+                    self.server.long_polls.release()
                 
                 sender = "Anonymous"
                 text = message_text
@@ -45,6 +67,13 @@ class API(BaseHTTPRequestHandler):
                 self.send_header('Access-Control-Allow-Origin', '*')
                 self.end_headers()
                 self.wfile.write(json.dumps(response).encode('utf-8'))
+            elif self.path.startswith('/history'):
+                self.serve_history()
+            elif self.path == '/files':
+                files = peer_instance.list_files() if peer_instance else []
+                self.send_body('application/json', json.dumps({'files': files}).encode('utf-8'))
+            elif self.path.startswith('/admin/profile') and profiler.is_local(self.client_address):
+                self.serve_admin('GET')
             elif self.path == '/channels':
                 # Channel listing
                 self.send_response(200)
@@ -119,11 +148,37 @@ class API(BaseHTTPRequestHandler):
                 self.send_header('Access-Control-Allow-Origin', '*')
                 self.end_headers()
                 self.wfile.write(json.dumps({"status": "ok"}).encode('utf-8'))    
+            elif self.path == '/share':
+                # Publishes local files to every peer, so only the owner may
+                # call it: from this machine, without a cross-site form post
+                if not profiler.is_local(self.client_address) or not self.headers.get('Content-Type', '').startswith('application/json'):
+                    self.send_error(403)
+                    return
+                path = peer_instance.resolve_share_path(str(data.get('path', ''))) if peer_instance else None
+                if path is None:
+                    self.send_error(404, "File not found")
+                    return
+                manifest = peer_instance.share_file(path, data.get('channel', '#general'))
+                self.send_body('application/json', json.dumps({"file_id": manifest["file_id"], "chunks": len(manifest["chunks"])}).encode('utf-8'), cors=False)
+            elif self.path.startswith('/admin/profile'):
+                # Same guard as /share: a cross-site form cannot send JSON
+                if not profiler.is_local(self.client_address) or not self.headers.get('Content-Type', '').startswith('application/json'):
+                    self.send_error(403)
+                    return
+                self.serve_admin('POST')
+            elif self.path == '/download':
+                download = peer_instance.download_file(data.get('file_id', '')) if peer_instance else None
+                if download is None:
+                    self.send_error(404, "Unknown file, asked peers for its manifest")
+                    return
+                done, total = download.progress()
+                self.send_body('application/json', json.dumps({"status": "started", "progress": [done, total]}).encode('utf-8'))
             elif self.path == '/join-channel':
                 channel = data.get('channel')
                 
                 if peer_instance and channel:
                     peer_instance.current_channel = channel
+                    peer_instance.subscribe(channel)
                 
                 self.send_response(200)
                 self.send_header('Content-type', 'application/json')
@@ -136,6 +191,62 @@ class API(BaseHTTPRequestHandler):
         except Exception:
             self.send_error(500)
     
+    def serve_admin(self, method):
+        status, content_type, body = profiler.handle_admin('peer', parse_qs(urlparse(self.path).query), method)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_history(self):
+        peer_instance = self.server.peer_instance
+        query = parse_qs(urlparse(self.path).query)
+        channel = query.get('channel', ['#general'])[0]
+        try:
+            before = int(query['before'][0]) if 'before' in query else None
+            limit = min(int(query.get('limit', ['50'])[0]), 500)
+        except ValueError:
+            self.send_error(400, "Invalid history query")
+            return
+
+        messages = peer_instance.history.page(channel, before, limit) if peer_instance else []
+        response = {
+            'channel': channel,
+            'messages': [m.to_dict() for m in messages],
+            'next_before': messages[0].id if messages else None
+        }
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+    def send_body(self, content_type, body, filepath=None, cache_control=None, cors=True):
+        """
+        Send ``body`` compressed when the client accepts it; static files
+        pass ``filepath`` so their compressed variant is cached.
+        """
+        encoding = choose_encoding(parse_accept_encoding(self.headers.get('Accept-Encoding', '')))
+        if encoding and filepath:
+            body = ASSET_CACHE.get(filepath, encoding, body) or body
+        elif encoding and len(body) >= MIN_COMPRESS_SIZE:
+            body = compress(body, encoding)
+        else:
+            encoding = None
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', 'Accept-Encoding')
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if cors:
+            self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
     def serve_chat_html(self):
         try:
             peer = self.server.peer_instance
@@ -148,42 +259,35 @@ class API(BaseHTTPRequestHandler):
             }
                     
             html_file = os.path.join(BASE_DIR, 'www', 'chat.html')
-            with open(html_file, 'r', encoding='utf-8') as f:
-                html_content = f.read()
+            with open(html_file, 'rb') as f:
+                html_content = FINGERPRINTS.rewrite_html(f.read()).decode('utf-8')
             
             html_content = html_content.replace('__APP_CONFIG_JSON__', json.dumps(config_data))
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(html_content.encode('utf-8'))
+            self.send_body('text/html; charset=utf-8', html_content.encode('utf-8'), cache_control=PAGE_CACHE_CONTROL)
         except Exception:
             self.send_error(404, "File Not Found")
 
+    def asset_cache_control(self, served_name):
+        # Any *.css or *.js path is answered with the one file of that type,
+        # so only a URL naming that very file may be cached for good
+        name, immutable = FINGERPRINTS.resolve(os.path.basename(urlparse(self.path).path))
+        return IMMUTABLE_CACHE_CONTROL if immutable and name == served_name else None
+
     def serve_chat_css(self):
         try:
             css_file = os.path.join(BASE_DIR, 'static', 'css', 'chat.css')
-            with open(css_file, 'r', encoding='utf-8') as f:
+            with open(css_file, 'rb') as f:
                 css_content = f.read()
-            self.send_response(200)
-            self.send_header('Content-type', 'text/css; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(css_content.encode('utf-8'))
+            self.send_body('text/css; charset=utf-8', css_content, css_file, self.asset_cache_control('chat.css'))
         except Exception:
             self.send_error(404, "File Not Found")
             
     def serve_chat_js(self):
         try:
             js_file = os.path.join(BASE_DIR, 'static', 'js', 'chat.js')
-            with open(js_file, 'r', encoding='utf-8') as f:
+            with open(js_file, 'rb') as f:
                 js_content = f.read()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/javascript; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(js_content.encode('utf-8'))
+            self.send_body('application/javascript; charset=utf-8', js_content, js_file, self.asset_cache_control('chat.js'))
         except Exception:
             self.send_error(404, "File Not Found")
 
@@ -191,17 +295,41 @@ class PeerHttpServer(HTTPServer):
     def __init__(self, server_address, RequestHandlerClass, peer_instance, ui_queue):
         self.peer_instance = peer_instance
         self.ui_queue = ui_queue
+        self.long_polls = threading.BoundedSemaphore(LONG_POLL_SLOTS)
         super().__init__(server_address, RequestHandlerClass)
 
-def run_api_server(port, peer_instance, ui_queue):
+API_WORKERS = 16
+# /messages holds a worker for up to 2 s, so long-polls may take at most
+# this many workers and the remainder always serves the other endpoints
+LONG_POLL_SLOTS = 12
+
+def run_api_server(port, peer_instance, ui_queue, loop=None):
+    """
+    Serve the chat UI. With ``loop`` the listening socket joins that
+    event loop and requests run on a fixed pool of API_WORKERS threads,
+    of which /messages long-polls may hold LONG_POLL_SLOTS; the server is
+    returned. Without it this
+    blocks in serve_forever.
+    """
+    FINGERPRINTS.build([os.path.join(BASE_DIR, 'static'), os.path.join(BASE_DIR, 'www')])
     try:
         server_address = ('0.0.0.0', port)
         httpd = PeerHttpServer(server_address, API, peer_instance, ui_queue)
         httpd.timeout = 1
         print("Listening on port {}".format(port))
-        httpd.serve_forever()
+        if loop is None:
+            httpd.serve_forever()
+            return httpd
+        workers = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix='api')
+
+        def serve(sock, addr):
+            sock.setblocking(True)
+            httpd.process_request(sock, addr)
+        loop.listen(httpd.socket, lambda sock, addr: workers.submit(serve, sock, addr))
+        return httpd
     except OSError as e:
-        if e.errno == 48:
+        if e.errno in (48, 98):
             print("Error: Port {} is already in use.".format(port))
     except Exception:
-        print("Unexpected error")
\ No newline at end of file
+        print("Unexpected error")
+    return None
@@ -0,0 +1,197 @@
+import time
+import socket
+import select
+import itertools
+import threading
+from queue import PriorityQueue, Empty
+from .response import Response
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Request line prefixes served ahead of everything else
+HIGH_PRIORITY_PATHS = (b"/submit-info",)
+LOW_PRIORITY_PATHS = (b"/static/", b"/css/", b"/images/", b"/js/")
+LOW_PRIORITY_SUFFIXES = (b".css", b".js", b".png", b".jpg", b".ico")
+
+def classify(conn):
+    """
+    Peek at the request line without consuming it or blocking the accept
+    thread, and map the path to a priority. Requests whose bytes have not
+    arrived yet are treated as normal. Servers that read requests before
+    admission (``reader``) classify the parsed path instead.
+    """
+    try:
+        readable, _, _ = select.select([conn], [], [], 0)
+        if not readable:
+            return PRIORITY_NORMAL
+        data = conn.recv(256, socket.MSG_PEEK)
+    except (InterruptedError, OSError, ValueError):
+        return PRIORITY_NORMAL
+    parts = data.split(b" ", 2)
+    if len(parts) < 2:
+        return PRIORITY_NORMAL
+    return path_priority(parts[1])
+
+def path_priority(path):
+    """
+    :param path (bytes): request target.
+    """
+    if path.startswith(HIGH_PRIORITY_PATHS):
+        return PRIORITY_HIGH
+    if path.startswith(LOW_PRIORITY_PATHS) or path.endswith(LOW_PRIORITY_SUFFIXES):
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
+
+class ConcurrencyLimit:
+    """
+    AIMD limit driven by latency: grows by ``1/limit`` per fast request
+    and shrinks by ``backoff`` when a request takes longer than
+    ``tolerance`` times the recent minimum latency. The baseline is the
+    minimum over the previous ``window`` requests, so it can rise when
+    the service really got slower, but only to a latency that was
+    actually observed at its best over a whole window.
+    """
+    def __init__(self, initial=8, min_limit=2, max_limit=64, tolerance=2.0, backoff=0.9, latency_floor=0.005, window=1000):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.latency_floor = latency_floor
+        self.window = window
+        self.min_rtt = None
+        self.window_min_rtt = None
+        self.samples = 0
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def cancel(self):
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify()
+
+    def release(self, rtt):
+        with self.cond:
+            self.inflight -= 1
+            self.samples += 1
+            if self.window_min_rtt is None or rtt < self.window_min_rtt:
+                self.window_min_rtt = rtt
+            if self.min_rtt is None or rtt < self.min_rtt:
+                self.min_rtt = rtt
+            if self.samples % self.window == 0:
+                # Resetting to one sample would adopt whatever latency the
+                # overload of the moment produced; the window minimum does not
+                self.min_rtt = self.window_min_rtt
+                self.window_min_rtt = None
+            threshold = max(self.min_rtt * self.tolerance, self.latency_floor)
+            if rtt > threshold:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.cond.notify()
+
+class AdmissionController:
+    """
+    Bounded worker pool in front of a connection handler.
+
+    With a ``reader``, every connection is first read on its own thread,
+    as the server did before the pool, and only a complete request
+    queues for a worker permit. A silent or slow client then holds no
+    permit and its read time never reaches the latency limit.
+
+    :param handler (callable): called as ``handler(conn, addr)``, or
+        ``handler(conn, addr, state)`` with a reader.
+    :param reader (callable, optional): called as ``reader(conn, addr)``;
+        returns (request path, state), or None once it has closed the
+        connection. ``state.release()`` is called if the request is shed.
+    :param workers (int): number of worker threads.
+    :param max_queue (int): connections waiting beyond this are shed.
+    :param max_queue_time (float): seconds a connection may wait before it is shed.
+    :param retry_after (int): value sent in Retry-After with 503.
+    """
+    def __init__(self, handler, workers=32, max_queue=512, max_queue_time=1.0, retry_after=1, limit=None, reader=None):
+        self.handler = handler
+        self.reader = reader
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.retry_after = retry_after
+        # Each worker holds at most one permit, so a limit above the
+        # worker count could never be reached and would stop reacting
+        self.limit = limit or ConcurrencyLimit(initial=min(8, workers), min_limit=min(2, workers), max_limit=workers)
+        self.queue = PriorityQueue()
+        self.sequence = itertools.count()
+        self.shed = 0
+        for _ in range(workers):
+            threading.Thread(target=self.run_worker, daemon=True).start()
+
+    def submit(self, conn, addr):
+        if self.reader is None:
+            return self.enqueue(classify(conn), conn, addr, None)
+        threading.Thread(target=self.read_request, args=(conn, addr), daemon=True).start()
+        return True
+
+    def read_request(self, conn, addr):
+        try:
+            result = self.reader(conn, addr)
+        except Exception as e:
+            print("[Backend] Read error for {}: {}".format(addr, e))
+            conn.close()
+            return
+        if result is not None:
+            path, state = result
+            self.enqueue(path_priority(path.encode('latin-1')), conn, addr, state)
+
+    def enqueue(self, priority, conn, addr, state):
+        if self.queue.qsize() >= self.max_queue:
+            self.reject(conn, state)
+            return False
+        self.queue.put((priority, next(self.sequence), time.monotonic(), conn, addr, state))
+        return True
+
+    def reject(self, conn, state=None):
+        if state is not None:
+            state.release()
+        self.shed += 1
+        try:
+            conn.sendall(Response().build_service_unavailable(self.retry_after))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def run_worker(self):
+        while True:
+            # Take a permit first so time spent waiting for one counts as queue time
+            self.limit.acquire()
+            try:
+                priority, _, queued_at, conn, addr, state = self.queue.get(timeout=1)
+            except Empty:
+                self.limit.cancel()
+                continue
+            # Shed before doing any work if the client already waited too long
+            if priority != PRIORITY_HIGH and time.monotonic() - queued_at > self.max_queue_time:
+                self.limit.cancel()
+                self.reject(conn, state)
+                continue
+            started = time.monotonic()
+            try:
+                if state is None:
+                    self.handler(conn, addr)
+                else:
+                    self.handler(conn, addr, state)
+            except Exception as e:
+                print("[Backend] Handler error for {}: {}".format(addr, e))
+                try:
+                    conn.close()
+                except OSError:
+                    pass
+            finally:
+                self.limit.release(time.monotonic() - started)
@@ -0,0 +1,105 @@
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+COOKIE_NAME = 'auth'
+TOKEN_TTL = 3600
+CACHE_SIZE = 4096
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+class TokenSigner:
+    """
+    Stateless session tokens: ``payload.signature``, both base64url, the
+    payload being ``{"sub": user, "exp": unix time}`` and the signature
+    an HMAC-SHA256 of it. Any process holding the secret can verify a
+    token without a session store. Verified tokens are remembered until
+    they expire, so repeat requests skip the HMAC and the JSON decode.
+
+    :param secret (bytes): key shared by every process that verifies.
+    :param ttl (int): token lifetime in seconds.
+    """
+    def __init__(self, secret, ttl=TOKEN_TTL, cache_size=CACHE_SIZE):
+        self.secret = secret
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def issue(self, subject, ttl=None):
+        payload = b64encode(json.dumps({"sub": subject, "exp": int(time.time()) + (ttl or self.ttl)}, separators=(',', ':')).encode('utf-8'))
+        return "{}.{}".format(payload, self.sign(payload))
+
+    def sign(self, payload):
+        return b64encode(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def verify(self, token):
+        """
+        :return: the token's subject, or None if it is forged, malformed
+            or expired.
+        """
+        if not token:
+            return None
+        now = time.time()
+        with self.lock:
+            cached = self.cache.get(token)
+            if cached is not None:
+                if cached[1] > now:
+                    self.cache.move_to_end(token)
+                    return cached[0]
+                del self.cache[token]
+                return None
+        payload, sep, signature = token.partition('.')
+        if not sep or not hmac.compare_digest(self.sign(payload), signature):
+            return None
+        try:
+            claims = json.loads(b64decode(payload).decode('utf-8'))
+            subject, expires = claims["sub"], float(claims["exp"])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if expires <= now:
+            return None
+        with self.lock:
+            self.cache[token] = (subject, expires)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return subject
+
+def parse_cookie(cookie_header, name=COOKIE_NAME):
+    for pair in (cookie_header or '').split(';'):
+        key, _, value = pair.strip().partition('=')
+        if key == name:
+            return value
+    return None
+
+# Trackers and backends that must accept each other's tokens share
+# SESSION_SECRET; without it every process signs with its own key.
+SIGNER = TokenSigner(os.environ.get('SESSION_SECRET', '').encode('utf-8') or os.urandom(32))
+
+def configure(secret=None, ttl=None):
+    global SIGNER
+    SIGNER = TokenSigner(secret.encode('utf-8') if secret else SIGNER.secret, ttl or SIGNER.ttl)
+
+def issue(subject, ttl=None):
+    return SIGNER.issue(subject, ttl)
+
+def verify(token):
+    return SIGNER.verify(token)
+
+def authenticate(cookie_header):
+    """
+    :return: the user named by the request's session cookie, or None.
+    """
+    return SIGNER.verify(parse_cookie(cookie_header))
+
+def set_cookie(token, ttl=None):
+    return "{}={}; Max-Age={}; Path=/; HttpOnly".format(COOKIE_NAME, token, ttl or SIGNER.ttl)
@@ -1,24 +1,53 @@
 import socket
-import threading
 from .httpadapter import HttpAdapter
+from .compression import ASSET_CACHE
+from .fingerprint import FINGERPRINTS
+from .admission import AdmissionController
+from .timeouts import Timeouts, start_reporter
+from . import response
+from . import tracing
+from . import profiler
 
-def handle_client(ip, port, conn, addr, routes):
+def read_client(ip, port, conn, addr, routes, timeouts=None):
+    """
+    Read one request ahead of admission.
+
+    :return: (request path, HttpAdapter holding the request), or None if
+        the client sent nothing to serve.
+    """
+    daemon = HttpAdapter(ip, port, conn, addr, routes, timeouts)
+    if not daemon.read_client(conn, addr, routes):
+        return None
+    return daemon.request.path, daemon
+
+def handle_client(ip, port, conn, addr, routes, timeouts=None, daemon=None):
     """
     :param ip (str): IP address of the server.
     :param port (int): Port number the server is listening on.
     :param conn (socket.socket): Client connection socket.
     :param addr (tuple): client address (IP, port).
     :param routes (dict): Dictionary of route handlers.
+    :param timeouts (Timeouts, optional): Read deadlines for the client.
+    :param daemon (HttpAdapter, optional): adapter that already read the request.
     """
-    daemon = HttpAdapter(ip, port, conn, addr, routes)
+    daemon = daemon or HttpAdapter(ip, port, conn, addr, routes, timeouts)
     daemon.handle_client(conn, addr, routes)
 
-def run_backend(ip, port, routes):
+def run_backend(ip, port, routes, workers=32, max_queue_time=1.0, timeouts=None, trace_file=None, profile_dir=None):
     """
     :param ip (str): IP address to bind the server.
     :param port (int): Port number to listen on.
     :param routes (dict): Dictionary of route handlers.
+    :param workers (int): Size of the worker pool.
+    :param max_queue_time (float): Seconds a connection may wait before it gets 503.
+    :param timeouts (Timeouts, optional): Client read deadlines. Defaults to Timeouts().
+    :param trace_file (str, optional): Where to append request spans.
+    :param profile_dir (str, optional): Where profiler dumps are written.
     """
+    timeouts = timeouts or Timeouts()
+    if trace_file:
+        tracing.configure(trace_file, 'backend')
+    profiler.install_signal_handler('backend', profile_dir)
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     try:
@@ -27,19 +56,31 @@ def run_backend(ip, port, routes):
         print("[Backend] Listening on port {}".format(port))
         if routes != {}:
             print("[Backend] route settings {}".format(routes))
+        FINGERPRINTS.build([response.BASE_DIR + "static", response.BASE_DIR + "www"])
+        ASSET_CACHE.warm([response.BASE_DIR + "www", response.BASE_DIR + "static"])
+        admission = AdmissionController(
+            lambda conn, addr, daemon: handle_client(ip, port, conn, addr, routes, timeouts, daemon),
+            workers=workers,
+            max_queue_time=max_queue_time,
+            reader=lambda conn, addr: read_client(ip, port, conn, addr, routes, timeouts)
+        )
+        start_reporter("Backend")
 
         while True:
             conn, addr = server.accept()
-            client_thread = threading.Thread(target=handle_client, args=(ip, port, conn, addr, routes))
-            client_thread.daemon = True
-            client_thread.start()
+            admission.submit(conn, addr)
     except socket.error as e:
       print("Socket error: {}".format(e))
 
-def create_backend(ip, port, routes={}):
+def create_backend(ip, port, routes={}, workers=32, max_queue_time=1.0, timeouts=None, trace_file=None, profile_dir=None):
     """
     :param ip (str): IP address to bind the server.
     :param port (int): Port number to listen on.
     :param routes (dict, optional): Dictionary of route handlers. Defaults to empty dict.
+    :param workers (int, optional): Size of the worker pool. Defaults to 32.
+    :param max_queue_time (float, optional): Queue wait before shedding with 503. Defaults to 1.0.
+    :param timeouts (Timeouts, optional): Client read deadlines. Defaults to Timeouts().
+    :param trace_file (str, optional): Append request spans in Chrome trace event format. Defaults to None.
+    :param profile_dir (str, optional): Where SIGUSR1 and route profiles are written. Defaults to the temp dir.
     """
-    run_backend(ip, port, routes)
\ No newline at end of file
+    run_backend(ip, port, routes, workers, max_queue_time, timeouts, trace_file, profile_dir)
\ No newline at end of file
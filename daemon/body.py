@@ -0,0 +1,308 @@
+import tempfile
+from urllib.parse import unquote_plus
+from .timeouts import Deadline
+
+READ_SIZE = 64 * 1024
+# Uploads above this many bytes move from memory to a temporary file
+SPOOL_THRESHOLD = 1024 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+MAX_PART_HEADER_SIZE = 8 * 1024
+# Fields or parts per body; each one costs a dict entry or a temporary file
+MAX_FIELDS = 1000
+
+class BodyStream:
+    """
+    Request body still on the socket, for routes registered with
+    ``stream=True``. Read it once: iterate for raw chunks, or call
+    ``spool``, ``form`` or ``multipart``. Memory stays bounded by
+    READ_SIZE plus whatever the handler keeps.
+
+    :param conn (socket.socket): client socket positioned after the header.
+    :param initial (bytes): body bytes that arrived with the header.
+    :param length (int): Content-Length.
+    :param headers (dict): request headers, for the content type.
+    :param timeouts (Timeouts, optional): the body deadline applies to the whole read.
+    """
+    def __init__(self, conn, initial, length, headers=None, timeouts=None):
+        self.conn = conn
+        self.pending = initial
+        self.remaining = length - len(initial)
+        self.length = length
+        self.headers = headers or {}
+        self.timeouts = timeouts
+        self.deadline = None
+
+    def read(self, size=READ_SIZE):
+        """
+        :return: up to ``size`` bytes, b"" at the end of the body.
+        :raises TimeoutError: when the body deadline expired.
+        :raises ConnectionError: when the client went away early.
+        """
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data
+        if self.remaining <= 0:
+            self.finish()
+            return b""
+        if self.deadline is None and self.timeouts and self.timeouts.body:
+            self.deadline = Deadline(self.conn, self.timeouts.scope)
+            self.deadline.arm('body', self.timeouts.body)
+        try:
+            data = self.conn.recv(min(size, self.remaining))
+        except OSError:
+            data = b""
+        if not data:
+            self.finish()
+            if self.deadline is not None and self.deadline.expired:
+                raise TimeoutError("{} body timeout".format(self.timeouts.scope))
+            raise ConnectionError("client closed with {} body bytes unread".format(self.remaining))
+        self.remaining -= len(data)
+        if self.remaining <= 0:
+            self.finish()
+        return data
+
+    def finish(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+
+    def __iter__(self):
+        while True:
+            data = self.read()
+            if not data:
+                return
+            yield data
+
+    def spool(self, threshold=SPOOL_THRESHOLD):
+        """
+        :return: the whole body as a file object at offset 0, in memory
+            up to ``threshold`` bytes and on disk beyond.
+        """
+        spooled = tempfile.SpooledTemporaryFile(max_size=threshold)
+        for data in self:
+            spooled.write(data)
+        spooled.seek(0)
+        return spooled
+
+    def form(self, max_field_size=MAX_FIELD_SIZE, max_fields=MAX_FIELDS):
+        """
+        :return: dict of the decoded ``application/x-www-form-urlencoded`` fields.
+        :raises ValueError: on a field or field count over the limits.
+        """
+        parser = FormParser(max_field_size, max_fields)
+        for data in self:
+            parser.feed(data)
+        return parser.close()
+
+    def multipart(self, threshold=SPOOL_THRESHOLD, max_field_size=MAX_FIELD_SIZE, max_fields=MAX_FIELDS):
+        """
+        :return: (fields dict, files dict of UploadedFile).
+        :raises ValueError: without a multipart boundary, on a malformed
+            body or on more than ``max_fields`` parts.
+        """
+        boundary = header_params(self.headers.get('content-type', '')).get('boundary')
+        if not boundary:
+            raise ValueError("multipart body without a boundary")
+        parser = MultipartParser(boundary, threshold, max_field_size, max_fields)
+        try:
+            for data in self:
+                parser.feed(data)
+        except (TimeoutError, ConnectionError):
+            parser.abort()
+            raise
+        return parser.close()
+
+def header_params(value):
+    """
+    Split ``type; key=value; key="value"`` into a dict of the parameters.
+    """
+    params = {}
+    for item in value.split(';')[1:]:
+        key, sep, val = item.strip().partition('=')
+        if sep:
+            params[key.lower()] = val.strip().strip('"')
+    return params
+
+class FormParser:
+    """
+    Incremental ``application/x-www-form-urlencoded`` decoder; only the
+    field being received is buffered.
+    """
+    def __init__(self, max_field_size=MAX_FIELD_SIZE, max_fields=MAX_FIELDS):
+        self.max_field_size = max_field_size
+        self.max_fields = max_fields
+        self.count = 0
+        self.fields = {}
+        self.partial = bytearray()
+
+    def feed(self, data):
+        self.partial += data
+        pairs = self.partial.split(b'&')
+        self.partial = pairs.pop()
+        for pair in pairs:
+            self.add(pair)
+        if len(self.partial) > self.max_field_size:
+            raise ValueError("form field larger than {} bytes".format(self.max_field_size))
+
+    def add(self, pair):
+        if not pair:
+            return
+        self.count += 1
+        if self.count > self.max_fields:
+            raise ValueError("form with more than {} fields".format(self.max_fields))
+        key, _, value = bytes(pair).decode('latin-1').partition('=')
+        self.fields[unquote_plus(key)] = unquote_plus(value)
+
+    def close(self):
+        self.add(self.partial)
+        self.partial = bytearray()
+        return self.fields
+
+class UploadedFile:
+    __slots__ = ('name', 'filename', 'content_type', 'file', 'size')
+
+    def __init__(self, name, filename, content_type, file, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+
+class MultipartParser:
+    """
+    Incremental ``multipart/form-data`` decoder. File parts are written
+    to spooled temporary files as they arrive; plain fields are kept as
+    strings up to ``max_field_size``. Only a delimiter's worth of bytes
+    is held back between feeds. When it raises, its temporary files are
+    already closed.
+    """
+    def __init__(self, boundary, threshold=SPOOL_THRESHOLD, max_field_size=MAX_FIELD_SIZE, max_fields=MAX_FIELDS):
+        self.delimiter = b"\r\n--" + boundary.encode('latin-1')
+        self.threshold = threshold
+        self.max_field_size = max_field_size
+        self.max_fields = max_fields
+        self.count = 0
+        self.fields = {}
+        self.files = {}
+        # The first delimiter may open the body without a leading CRLF
+        self.buffer = bytearray(b"\r\n")
+        self.state = 'preamble'
+        self.part = None
+
+    def feed(self, data):
+        try:
+            self.parse(data)
+        except ValueError:
+            self.abort()
+            raise
+
+    def parse(self, data):
+        self.buffer += data
+        while True:
+            if self.state == 'preamble':
+                index = self.buffer.find(self.delimiter)
+                if index < 0:
+                    # Keep a possible delimiter prefix
+                    del self.buffer[:max(0, len(self.buffer) - len(self.delimiter))]
+                    return
+                del self.buffer[:index + len(self.delimiter)]
+                self.state = 'boundary'
+            elif self.state == 'boundary':
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer[:2] == b"--":
+                    self.state = 'done'
+                    self.buffer = bytearray()
+                    return
+                end = self.buffer.find(b"\r\n")
+                if end < 0:
+                    return
+                del self.buffer[:end + 2]
+                self.state = 'headers'
+            elif self.state == 'headers':
+                if self.buffer[:2] == b"\r\n":
+                    # A part without headers starts straight with the blank line
+                    header_block, skip = b"", 2
+                else:
+                    end = self.buffer.find(b"\r\n\r\n")
+                    if end < 0:
+                        if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                            raise ValueError("multipart part header too large")
+                        return
+                    header_block, skip = bytes(self.buffer[:end]), end + 4
+                self.start_part(header_block.decode('utf-8', 'replace'))
+                del self.buffer[:skip]
+                self.state = 'body'
+            elif self.state == 'body':
+                index = self.buffer.find(self.delimiter)
+                if index < 0:
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        self.write_part(self.buffer[:len(self.buffer) - keep])
+                        del self.buffer[:len(self.buffer) - keep]
+                    return
+                self.write_part(self.buffer[:index])
+                del self.buffer[:index + len(self.delimiter)]
+                self.end_part()
+                self.state = 'boundary'
+            else:
+                # Epilogue after the closing delimiter is ignored
+                self.buffer = bytearray()
+                return
+
+    def start_part(self, header_block):
+        self.count += 1
+        if self.count > self.max_fields:
+            raise ValueError("multipart body with more than {} parts".format(self.max_fields))
+        headers = {}
+        for line in header_block.split("\r\n"):
+            key, sep, value = line.partition(':')
+            if sep:
+                headers[key.strip().lower()] = value.strip()
+        params = header_params(headers.get('content-disposition', ''))
+        filename = params.get('filename')
+        if filename is not None:
+            sink = tempfile.SpooledTemporaryFile(max_size=self.threshold)
+        else:
+            sink = bytearray()
+        self.part = [params.get('name', ''), filename, headers.get('content-type', 'text/plain'), sink, 0]
+
+    def write_part(self, data):
+        part = self.part
+        part[4] += len(data)
+        if part[1] is None and part[4] > self.max_field_size:
+            raise ValueError("multipart field {} larger than {} bytes".format(part[0], self.max_field_size))
+        if part[1] is None:
+            part[3].extend(data)
+        else:
+            part[3].write(data)
+
+    def end_part(self):
+        name, filename, content_type, sink, size = self.part
+        self.part = None
+        if filename is None:
+            self.fields[name] = bytes(sink).decode('utf-8', 'replace')
+        else:
+            sink.seek(0)
+            # The last part of a name wins, as for fields; nothing else
+            # would ever close the file it replaces
+            replaced = self.files.get(name)
+            if replaced is not None:
+                replaced.file.close()
+            self.files[name] = UploadedFile(name, filename, content_type, sink, size)
+
+    def abort(self):
+        """
+        Close the temporary files of the open part and of finished parts.
+        """
+        part, self.part = self.part, None
+        if part is not None and part[1] is not None:
+            part[3].close()
+        for upload in self.files.values():
+            upload.file.close()
+        self.files = {}
+
+    def close(self):
+        if self.state != 'done':
+            self.abort()
+            raise ValueError("multipart body ended before the closing boundary")
+        return self.fields, self.files
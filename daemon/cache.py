@@ -0,0 +1,202 @@
+import time
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from .dictionary import CaseInsensitiveDict
+
+CACHEABLE_STATUS = (200, 203, 301)
+
+def parse_size(value):
+    """
+    Parse ``64m``, ``512k`` or a plain byte count.
+    """
+    value = str(value).strip().lower()
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_cache_control(value):
+    directives = {}
+    for item in (value or '').split(','):
+        name, _, arg = item.strip().partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"')
+    return directives
+
+def parse_response_head(response):
+    """
+    :param response (bytes): raw HTTP response.
+    :return: (status code, headers, body offset).
+    """
+    head, sep, _ = response.partition(b"\r\n\r\n")
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        status_code = int(lines[0].split(' ')[1])
+    except (IndexError, ValueError):
+        status_code = 0
+    headers = CaseInsensitiveDict()
+    for line in lines[1:]:
+        if ':' in line:
+            key, val = line.split(':', 1)
+            headers[key.strip()] = val.strip()
+    return status_code, headers, len(head) + len(sep)
+
+def http_timestamp(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+class CacheEntry:
+    __slots__ = ('response', 'status_code', 'headers', 'stored_at', 'ttl', 'swr', 'size', 'revalidating')
+
+    def __init__(self, response, status_code, headers, ttl, swr):
+        self.response = response
+        self.status_code = status_code
+        self.headers = headers
+        self.stored_at = time.time()
+        self.ttl = ttl
+        self.swr = swr
+        self.size = len(response)
+        self.revalidating = False
+
+    def age(self, now=None):
+        return (now or time.time()) - self.stored_at
+
+    def state(self, now=None):
+        age = self.age(now)
+        if age < self.ttl:
+            return 'fresh'
+        if age < self.ttl + self.swr:
+            return 'stale'
+        return 'expired'
+
+    def conditional_headers(self):
+        lines = []
+        if 'etag' in self.headers:
+            lines.append("If-None-Match: {}".format(self.headers['etag']))
+        if 'last-modified' in self.headers:
+            lines.append("If-Modified-Since: {}".format(self.headers['last-modified']))
+        return lines
+
+class ResponseCache:
+    """
+    Shared HTTP response cache for one virtual host, bounded by total
+    bytes with LRU eviction.
+
+    :param max_bytes (int): upper bound on stored response bytes.
+    :param default_ttl (float): lifetime when upstream gives no expiry.
+    :param stale_while_revalidate (float): default window to serve stale.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=0, stale_while_revalidate=0):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.entries = OrderedDict()
+        self.vary = {}
+        self.variants = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, base_key, request_headers, vary_names):
+        return (base_key,) + tuple(request_headers.get(name, '') for name in vary_names)
+
+    def lookup(self, base_key, request_headers):
+        with self.lock:
+            vary_names = self.vary.get(base_key)
+            if vary_names is None:
+                return None
+            key = self.make_key(base_key, request_headers, vary_names)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def lifetime(self, headers):
+        """
+        :return: (ttl, stale-while-revalidate) or None if not storable.
+        """
+        cc = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in cc or 'private' in cc or 'set-cookie' in headers:
+            return None
+        try:
+            if 's-maxage' in cc:
+                ttl = int(cc['s-maxage'])
+            elif 'max-age' in cc:
+                ttl = int(cc['max-age'])
+            elif 'expires' in headers:
+                expires = http_timestamp(headers['expires'])
+                date = http_timestamp(headers.get('date')) or time.time()
+                ttl = max(0, expires - date) if expires else 0
+            else:
+                ttl = self.default_ttl
+            swr = int(cc.get('stale-while-revalidate', self.stale_while_revalidate))
+        except ValueError:
+            return None
+        if 'no-cache' in cc:
+            ttl = 0
+        if ttl <= 0 and swr <= 0 and not ('etag' in headers or 'last-modified' in headers):
+            return None
+        return ttl, swr
+
+    def store(self, base_key, request_headers, response):
+        status_code, headers, _ = parse_response_head(response)
+        if status_code not in CACHEABLE_STATUS or len(response) > self.max_bytes:
+            return None
+        vary_header = headers.get('vary', '')
+        if vary_header.strip() == '*':
+            return None
+        lifetime = self.lifetime(headers)
+        if lifetime is None:
+            return None
+        vary_names = tuple(sorted(name.strip().lower() for name in vary_header.split(',') if name.strip()))
+        entry = CacheEntry(response, status_code, headers, *lifetime)
+        with self.lock:
+            current = self.vary.get(base_key)
+            if current != vary_names:
+                if current is not None:
+                    # Variants stored under the old Vary list are unreachable now
+                    self.drop(base_key)
+                self.vary[base_key] = vary_names
+            key = self.make_key(base_key, request_headers, vary_names)
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            else:
+                self.variants[base_key] = self.variants.get(base_key, 0) + 1
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes and self.entries:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.forget_variant(evicted_key[0])
+        return entry
+
+    def forget_variant(self, base_key):
+        remaining = self.variants.get(base_key, 1) - 1
+        if remaining <= 0:
+            self.variants.pop(base_key, None)
+            self.vary.pop(base_key, None)
+        else:
+            self.variants[base_key] = remaining
+
+    def refresh(self, entry, response):
+        """
+        Apply a 304 Not Modified from upstream to ``entry``.
+        """
+        _, headers, _ = parse_response_head(response)
+        for name in ('cache-control', 'expires', 'date', 'etag', 'last-modified'):
+            if name in headers:
+                entry.headers[name] = headers[name]
+        lifetime = self.lifetime(entry.headers)
+        if lifetime is not None:
+            entry.ttl, entry.swr = lifetime
+        entry.stored_at = time.time()
+
+    def drop(self, base_key):
+        for key in [k for k in self.entries if k[0] == base_key]:
+            self.size -= self.entries.pop(key).size
+        self.variants.pop(base_key, None)
+        self.vary.pop(base_key, None)
@@ -0,0 +1,229 @@
+import json
+import time
+import socket
+import random
+import threading
+from urllib.parse import urlparse
+from .dictionary import CaseInsensitiveDict
+
+# Statuses our servers send before doing any work, so any method may be retried
+RETRY_STATUS = (429, 503)
+
+class ClientResponse:
+    __slots__ = ('status_code', 'reason', 'headers', 'set_cookies', 'body')
+
+    def __init__(self, status_code, reason, headers, set_cookies, body):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.set_cookies = set_cookies
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+class StaleConnection(Exception):
+    """
+    A reused keep-alive connection was closed by the server before any
+    response byte arrived; the request was not processed.
+    """
+
+class HttpSession:
+    """
+    HTTP/1.1 client bound to one server. It keeps one persistent
+    connection, stores cookies from Set-Cookie and sends them back, and
+    retries failed attempts with jittered exponential backoff.
+
+    :param base_url (str): e.g. ``http://localhost:8080``.
+    :param connect_timeout (float): TCP connect timeout.
+    :param read_timeout (float): per-recv timeout while waiting for a response.
+    :param retries (int): extra attempts after the first.
+    :param backoff (float): base delay; attempt ``n`` sleeps up to ``backoff * 2**n``.
+    :param max_backoff (float): cap on a single delay.
+    """
+    def __init__(self, base_url, connect_timeout=5.0, read_timeout=10.0, retries=3, backoff=0.2, max_backoff=5.0, user_agent='P2P-Peer/1.0'):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 8000
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.user_agent = user_agent
+        self.cookies = {}
+        self.sock = None
+        self.buffer = bytearray(8192)
+        self.lock = threading.Lock()
+
+    def request(self, method, path, body_data=None, headers=None):
+        """
+        :return: ClientResponse.
+        :raises OSError: when every attempt failed at the socket level.
+        """
+        method = method.upper()
+        payload = self.encode_request(method, path, body_data, headers)
+        attempt = 0
+        with self.lock:
+            while True:
+                try:
+                    response = self.exchange(payload)
+                except StaleConnection:
+                    # Free retry: the server dropped an idle connection
+                    self.close_socket()
+                    continue
+                except (OSError, ValueError) as e:
+                    self.close_socket()
+                    if attempt >= self.retries:
+                        raise OSError("{} {} failed: {}".format(method, path, e))
+                    self.sleep_backoff(attempt)
+                    attempt += 1
+                    continue
+                if response.status_code in RETRY_STATUS and attempt < self.retries:
+                    retry_after = response.headers.get('retry-after', '')
+                    self.sleep_backoff(attempt, float(retry_after) if retry_after.isdigit() else None)
+                    attempt += 1
+                    continue
+                return response
+
+    def sleep_backoff(self, attempt, floor=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        if floor is not None:
+            delay = max(delay, min(floor, self.max_backoff))
+        time.sleep(delay)
+
+    def encode_request(self, method, path, body_data, headers):
+        body = b""
+        if body_data is not None:
+            if isinstance(body_data, dict):
+                body_data = "&".join("{}={}".format(k, v) for k, v in body_data.items())
+            body = body_data if isinstance(body_data, bytes) else str(body_data).encode('utf-8')
+        lines = [
+            "{} {} HTTP/1.1".format(method, path),
+            "Host: {}:{}".format(self.host, self.port),
+            "Connection: keep-alive",
+            "User-Agent: {}".format(self.user_agent),
+        ]
+        if self.cookies:
+            lines.append("Cookie: {}".format("; ".join("{}={}".format(k, v) for k, v in self.cookies.items())))
+        headers = headers or {}
+        if body or method in ('POST', 'PUT'):
+            if not any(key.lower() == 'content-type' for key in headers):
+                lines.append("Content-Type: application/x-www-form-urlencoded")
+            lines.append("Content-Length: {}".format(len(body)))
+        for key, value in headers.items():
+            lines.append("{}: {}".format(key, value))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.read_timeout)
+        return sock
+
+    def close_socket(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def exchange(self, payload):
+        reused = self.sock is not None
+        if not reused:
+            self.sock = self.connect()
+        try:
+            try:
+                self.sock.sendall(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                if reused:
+                    raise StaleConnection()
+                raise
+            response, keep_alive = self.read_response(reused)
+        except Exception:
+            self.close_socket()
+            raise
+        if not keep_alive:
+            self.close_socket()
+        self.store_cookies(response.set_cookies)
+        return response
+
+    def read_response(self, reused):
+        """
+        Parse the status line and headers in a single pass over the
+        header block, then read exactly the body.
+
+        :return: (ClientResponse, whether the connection stays open).
+        """
+        sock = self.sock
+        view = memoryview(self.buffer)
+        data = bytearray()
+        end = -1
+        while end < 0:
+            try:
+                n = sock.recv_into(self.buffer)
+            except ConnectionResetError:
+                if reused and not data:
+                    raise StaleConnection()
+                raise
+            if not n:
+                if reused and not data:
+                    raise StaleConnection()
+                raise ConnectionError("connection closed mid-response")
+            search_from = max(0, len(data) - 3)
+            data += view[:n]
+            end = data.find(b"\r\n\r\n", search_from)
+        view.release()
+
+        status_code, reason = 0, ""
+        headers = CaseInsensitiveDict()
+        set_cookies = []
+        for index, line in enumerate(data[:end].decode('latin-1').split('\r\n')):
+            if index == 0:
+                parts = line.split(' ', 2)
+                status_code = int(parts[1])
+                reason = parts[2] if len(parts) > 2 else ""
+                continue
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+            key, value = key.strip(), value.strip()
+            if key.lower() == 'set-cookie':
+                set_cookies.append(value)
+            headers[key] = value
+
+        body = data[end + 4:]
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        length = headers.get('content-length')
+        if length is not None:
+            length = int(length)
+            while len(body) < length:
+                chunk = sock.recv(min(65536, length - len(body)))
+                if not chunk:
+                    raise ConnectionError("connection closed mid-body")
+                body += chunk
+        elif status_code != 304 and status_code >= 200:
+            # No framing: the body runs until the server closes
+            keep_alive = False
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                body += chunk
+        return ClientResponse(status_code, reason, headers, set_cookies, bytes(body)), keep_alive
+
+    def store_cookies(self, set_cookies):
+        for value in set_cookies:
+            pair, _, attributes = value.partition(';')
+            name, sep, cookie = pair.strip().partition('=')
+            if not sep:
+                continue
+            if 'max-age=0' in attributes.lower().replace(' ', ''):
+                self.cookies.pop(name, None)
+            else:
+                self.cookies[name] = cookie
+
+    def close(self):
+        with self.lock:
+            self.close_socket()
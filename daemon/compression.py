@@ -0,0 +1,119 @@
+import os
+import gzip
+import mimetypes
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: Dynamic bodies smaller than this are sent as-is
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+)
+
+def supported_encodings():
+    # Server preference order
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+def parse_accept_encoding(header):
+    """
+    :param header (str): raw ``Accept-Encoding`` value.
+    :return: dict of coding -> q value.
+    """
+    accepted = {}
+    if not header:
+        return accepted
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+def choose_encoding(accepted):
+    best, best_q = None, 0.0
+    for coding in supported_encodings():
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def is_compressible(content_type):
+    if not content_type:
+        return False
+    return content_type.lower().startswith(COMPRESSIBLE_TYPES)
+
+def compress(data, encoding, level=6):
+    if encoding == 'gzip':
+        # mtime=0 keeps the output stable for identical input
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'br' and brotli:
+        return brotli.compress(data, quality=min(level, 11))
+    raise ValueError("Unsupported content encoding: {}".format(encoding))
+
+class AssetCache:
+    """
+    Precompressed variants of static files, keyed by path and dropped
+    when the file's mtime or size changes.
+    """
+    def __init__(self, level=9):
+        self.level = level
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, filepath, encoding, content=None, key=None):
+        """
+        :param key (str, optional): cache slot when ``content`` is a
+            transformed version of the file; defaults to ``filepath``.
+        """
+        key = key or filepath
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, {})
+                self.entries[key] = entry
+            variant = entry[1].get(encoding)
+        if variant is not None:
+            return variant
+        if content is None:
+            with open(filepath, 'rb') as f:
+                content = f.read()
+        variant = compress(content, encoding, self.level)
+        with self.lock:
+            if self.entries.get(key, (None,))[0] == stamp:
+                entry[1][encoding] = variant
+        return variant
+
+    def warm(self, directories):
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    filepath = os.path.join(root, name)
+                    mime_type, _ = mimetypes.guess_type(filepath)
+                    if not is_compressible(mime_type):
+                        continue
+                    for encoding in supported_encodings():
+                        self.get(filepath, encoding)
+
+ASSET_CACHE = AssetCache()
@@ -0,0 +1,341 @@
+import time
+import heapq
+import socket
+import itertools
+import selectors
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+RESOLVER_WORKERS = 2
+
+def is_ip_address(host):
+    try:
+        socket.inet_aton(host)
+    except OSError:
+        return False
+    return host.count('.') == 3
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Connection:
+    """
+    Non-blocking stream socket driven by an EventLoop. Received bytes go
+    to ``handler.data_received(conn, data)`` and the close to
+    ``handler.connection_lost(conn)``, both on the loop thread. ``send``
+    and ``close`` may be called from any thread; sends are queued and
+    flushed when the socket is writable.
+
+    :param max_pending (int): queued bytes after which the peer is
+        treated as stuck and the connection is closed.
+    """
+    def __init__(self, loop, sock, addr, handler, max_pending=8 * 1024 * 1024):
+        self.loop = loop
+        self.sock = sock
+        self.addr = addr
+        self.handler = handler
+        self.max_pending = max_pending
+        self.write_queue = deque()
+        self.pending = 0
+        self.write_lock = threading.Lock()
+        self.flush_scheduled = False
+        self.writing = False
+        self.closed = False
+
+    def send(self, data):
+        if self.closed:
+            raise OSError("connection closed")
+        with self.write_lock:
+            self.write_queue.append(memoryview(data))
+            self.pending += len(data)
+            overflow = self.pending > self.max_pending
+            schedule = not self.flush_scheduled
+            self.flush_scheduled = True
+        if overflow:
+            self.close()
+            raise OSError("send queue full")
+        if schedule:
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        while not self.closed:
+            with self.write_lock:
+                if not self.write_queue:
+                    self.flush_scheduled = False
+                    self.loop.set_writing(self, False)
+                    return
+                view = self.write_queue[0]
+            try:
+                sent = self.sock.send(view)
+            except (BlockingIOError, InterruptedError):
+                self.loop.set_writing(self, True)
+                return
+            except OSError:
+                self.close()
+                return
+            with self.write_lock:
+                self.pending -= sent
+                if sent < len(view):
+                    self.write_queue[0] = view[sent:]
+                else:
+                    self.write_queue.popleft()
+
+    def handle_read(self):
+        if self.closed:
+            return
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+            return
+        self.handler.data_received(self, data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.call_soon(self.finish_close)
+
+    def detach(self):
+        """
+        Stop driving the socket and return it in blocking mode, without
+        calling ``connection_lost``. Anything still queued is written
+        first so the stream stays intact. Loop thread only.
+        """
+        self.closed = True
+        self.loop.forget(self.sock)
+        self.sock.setblocking(True)
+        with self.write_lock:
+            queued, self.write_queue = self.write_queue, deque()
+            self.pending = 0
+        for view in queued:
+            self.sock.sendall(view)
+        return self.sock
+
+    def finish_close(self):
+        self.loop.forget(self.sock)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.handler.connection_lost(self)
+
+class EventLoop:
+    """
+    ``selectors`` loop running on one thread. Other threads hand it work
+    through ``call_soon``, which wakes the selector through a socketpair.
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.ready = deque()
+        self.ready_lock = threading.Lock()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.thread = None
+        self.running = False
+        self.waker, self.wake_writer = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, (self.drain_waker, None))
+        self.resolver = ThreadPoolExecutor(max_workers=RESOLVER_WORKERS, thread_name_prefix='resolve')
+
+    def start(self, name='event-loop'):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.resolver.shutdown(wait=False)
+        self.wake()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def drain_waker(self):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def call_soon(self, callback, *args):
+        with self.ready_lock:
+            self.ready.append((callback, args))
+        if not self.in_loop():
+            self.wake()
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.time() + delay, callback, args)
+        # The heap is only touched on the loop thread
+        self.call_soon(self.push_timer, timer)
+        return timer
+
+    def push_timer(self, timer):
+        heapq.heappush(self.timers, (timer.when, next(self.sequence), timer))
+
+    def time(self):
+        return time.monotonic()
+
+    def add_reader(self, sock, callback):
+        self.call_soon(self.selector.register, sock, selectors.EVENT_READ, (callback, None))
+
+    def forget(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def set_writing(self, conn, writing):
+        if conn.closed or conn.writing == writing:
+            return
+        conn.writing = writing
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+        try:
+            self.selector.modify(conn.sock, events, (conn.handle_read, conn.flush))
+        except (KeyError, ValueError):
+            pass
+
+    def listen(self, sock, on_accept):
+        """
+        Accept connections on ``sock`` and pass each ``(sock, addr)`` to
+        ``on_accept`` on the loop thread.
+        """
+        sock.setblocking(False)
+
+        def accept():
+            while True:
+                try:
+                    client, addr = sock.accept()
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError as e:
+                    print("[EventLoop] Accept failed: {}".format(e))
+                    return
+                on_accept(client, addr)
+        self.add_reader(sock, accept)
+
+    def attach(self, sock, addr, handler):
+        """
+        Drive ``sock`` with ``handler``; ``handler.connection_made(conn)``
+        runs on the loop thread before any data.
+        """
+        sock.setblocking(False)
+        conn = Connection(self, sock, addr, handler)
+
+        def register():
+            self.selector.register(sock, selectors.EVENT_READ, (conn.handle_read, conn.flush))
+            handler.connection_made(conn)
+        self.call_soon(register)
+        return conn
+
+    def connect(self, addr, timeout, on_done):
+        """
+        Non-blocking connect; ``on_done(sock, error)`` runs on the loop
+        thread with exactly one of them set.
+        """
+        def begin(host):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                sock.connect_ex((host, addr[1]))
+            except OSError as e:
+                sock.close()
+                on_done(None, e)
+                return
+            state = {}
+
+            def finish(error):
+                if state.get('done'):
+                    return
+                state['done'] = True
+                timer.cancel()
+                self.forget(sock)
+                if error is None:
+                    on_done(sock, None)
+                else:
+                    sock.close()
+                    on_done(None, error)
+
+            def writable():
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                finish(OSError(err, "connect failed") if err else None)
+
+            timer = self.call_later(timeout, finish, TimeoutError("connect timed out"))
+            self.selector.register(sock, selectors.EVENT_WRITE, (None, writable))
+
+        def resolve():
+            try:
+                host = socket.gethostbyname(addr[0])
+            except OSError as e:
+                self.call_soon(on_done, None, e)
+                return
+            self.call_soon(begin, host)
+        if is_ip_address(addr[0]):
+            self.call_soon(begin, addr[0])
+        else:
+            # A lookup can block for seconds, so it never runs on the loop
+            self.resolver.submit(resolve)
+
+    def run(self):
+        while self.running:
+            with self.ready_lock:
+                idle = not self.ready
+            timeout = None
+            if not idle:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - self.time())
+            for key, mask in self.selector.select(timeout):
+                on_read, on_write = key.data
+                try:
+                    if mask & selectors.EVENT_READ and on_read:
+                        on_read()
+                    if mask & selectors.EVENT_WRITE and on_write:
+                        on_write()
+                except Exception as e:
+                    print("[EventLoop] Callback failed: {}".format(e))
+            now = self.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, timer = heapq.heappop(self.timers)
+                if not timer.cancelled:
+                    self.run_callback(timer.callback, timer.args)
+            self.run_ready()
+        # Let closes queued by stop() go out
+        self.run_ready()
+
+    def run_ready(self):
+        with self.ready_lock:
+            batch = self.ready
+            self.ready = deque()
+        for callback, args in batch:
+            self.run_callback(callback, args)
+
+    def run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as e:
+            print("[EventLoop] Callback failed: {}".format(e))
@@ -0,0 +1,99 @@
+import os
+import re
+import hashlib
+import threading
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Pages name the current asset versions, so clients revalidate them every time
+PAGE_CACHE_CONTROL = 'no-cache'
+HASH_LENGTH = 10
+
+FINGERPRINTED_NAME = re.compile(r'^(.+)\.([0-9a-f]{%d})(\.[^.]+)$' % HASH_LENGTH)
+ASSET_REFERENCE = re.compile(rb'''(\b(?:src|href)\s*=\s*["'])([^"'#?]+)''', re.IGNORECASE)
+
+class AssetFingerprints:
+    """
+    Content-hash names for static assets, built once at startup: ``chat.js``
+    becomes ``chat.<hash>.js``. Both servers look files up by basename, so
+    HTML only needs the basename rewritten, and a fingerprinted URL can be
+    cached forever because new content gets a new name.
+    """
+    def __init__(self):
+        self.names = {}
+        self.newest_mtime = 0
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def build(self, directories):
+        """
+        Hash every non-HTML file under ``directories``. Basenames that occur
+        twice are left alone since the servers could not tell them apart.
+        """
+        names = {}
+        seen = set()
+        newest = 0
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if name.endswith('.html'):
+                        continue
+                    filepath = os.path.join(root, name)
+                    try:
+                        with open(filepath, 'rb') as f:
+                            digest = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+                        newest = max(newest, os.stat(filepath).st_mtime)
+                    except OSError:
+                        continue
+                    if name in seen:
+                        names.pop(name, None)
+                        continue
+                    seen.add(name)
+                    base, ext = os.path.splitext(name)
+                    names[name] = (digest, "{}.{}{}".format(base, digest, ext))
+        with self.lock:
+            self.names = names
+            self.newest_mtime = newest
+            self.pages = {}
+        print("[Fingerprint] {} assets fingerprinted".format(len(names)))
+
+    def resolve(self, basename):
+        """
+        :return: (real basename, whether the URL names the current content
+            and may be cached as immutable). A stale fingerprint still
+            resolves so that old pages keep working.
+        """
+        match = FINGERPRINTED_NAME.match(basename)
+        if match is None:
+            return basename, False
+        name = match.group(1) + match.group(3)
+        entry = self.names.get(name)
+        if entry is None:
+            return basename, False
+        return name, entry[0] == match.group(2)
+
+    def rewrite_html(self, content):
+        """
+        Point ``src``/``href`` references at the fingerprinted names.
+        Results are remembered per page content.
+        """
+        if not self.names:
+            return content
+        page = self.pages.get(content)
+        if page is not None:
+            return page
+
+        def replace(match):
+            url = match.group(2)
+            head, sep, name = url.rpartition(b'/')
+            entry = self.names.get(name.decode('latin-1'))
+            if entry is None:
+                return match.group(0)
+            return match.group(1) + head + sep + entry[1].encode('latin-1')
+        page = ASSET_REFERENCE.sub(replace, content)
+        with self.lock:
+            if len(self.pages) > 64:
+                self.pages.clear()
+            self.pages[content] = page
+        return page
+
+FINGERPRINTS = AssetFingerprints()
@@ -0,0 +1,206 @@
+import time
+import threading
+import itertools
+
+DEFAULT_CAPACITY = 1000
+# Missed sequence numbers remembered per sender run
+MAX_GAPS = 64
+
+class Message:
+    __slots__ = ("id", "channel", "username", "content", "timestamp", "seq", "epoch")
+
+    def __init__(self, id, channel, username, content, timestamp, seq=None, epoch=None):
+        self.id = id
+        self.channel = channel
+        self.username = username
+        self.content = content
+        self.timestamp = timestamp
+        #: Sender-assigned sequence number and run, used by peer sync
+        self.seq = seq
+        self.epoch = epoch
+
+    def to_packet(self):
+        return {
+            "type": "message",
+            "id": "{}:{}:{}".format(self.username, self.epoch, self.seq),
+            "seq": self.seq,
+            "epoch": self.epoch,
+            "channels": self.channel,
+            "username": self.username,
+            "content": self.content,
+            "timestamp": self.timestamp
+        }
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "channel": self.channel,
+            "sender": self.username,
+            "text": self.content,
+            "timestamp": self.timestamp,
+            "raw": "{}|[{}]: {}".format(self.channel, self.username, self.content)
+        }
+
+def sender_key(username, epoch):
+    """
+    Name of one sender run: a peer numbers its messages from 1 in every
+    channel and starts a new ``epoch`` each time it starts.
+    """
+    return "{}#{}".format(username, epoch)
+
+class SeqTracker:
+    """
+    Sequence numbers seen from one sender run in one channel: everything
+    up to ``high`` except the numbers in ``gaps``. Only the newest
+    MAX_GAPS gaps are kept, so a tracker stays small on the wire however
+    many messages a peer missed.
+    """
+    __slots__ = ("high", "gaps", "touched")
+
+    def __init__(self, high=0, gaps=()):
+        self.high = high
+        self.gaps = sorted(set(gap for gap in gaps if 0 < gap < high))[-MAX_GAPS:]
+        self.touched = time.monotonic()
+
+    def __contains__(self, seq):
+        return seq <= self.high and seq not in self.gaps
+
+    def add(self, seq):
+        self.touched = time.monotonic()
+        if seq > self.high:
+            self.gaps.extend(range(max(self.high + 1, seq - MAX_GAPS), seq))
+            del self.gaps[:-MAX_GAPS]
+            self.high = seq
+        elif seq in self.gaps:
+            self.gaps.remove(seq)
+
+    def to_packet(self):
+        return [self.high] + self.gaps
+
+    @classmethod
+    def from_packet(cls, value):
+        """
+        :param value: ``[high, gap, ...]``.
+        :return: SeqTracker, or None if ``value`` is malformed.
+        """
+        if not isinstance(value, list) or not 0 < len(value) <= MAX_GAPS + 1:
+            return None
+        if not all(isinstance(seq, int) for seq in value):
+            return None
+        return cls(value[0], value[1:])
+
+class ChannelHistory:
+    """
+    Fixed-size ring buffer of :class:`Message` for one channel.
+    Ids are appended in increasing order, so ``before`` lookups are a
+    binary search over the logical (oldest -> newest) positions.
+    """
+    __slots__ = ("capacity", "_buffer", "_start", "_count")
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._buffer = [None] * capacity
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _at(self, index):
+        return self._buffer[(self._start + index) % self.capacity]
+
+    def append(self, message):
+        if self._count < self.capacity:
+            self._buffer[(self._start + self._count) % self.capacity] = message
+            self._count += 1
+        else:
+            # Overwrite the oldest record
+            self._buffer[self._start] = message
+            self._start = (self._start + 1) % self.capacity
+
+    def page(self, before=None, limit=50):
+        """
+        :param before (int, optional): only return messages with id < before.
+        :param limit (int): maximum number of messages to return.
+        :return: list of messages, oldest first.
+        """
+        end = self._count
+        if before is not None:
+            lo, hi = 0, self._count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._at(mid).id < before:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            end = lo
+        begin = max(0, end - limit)
+        return [self._at(i) for i in range(begin, end)]
+
+    def missing(self, vector, limit):
+        """
+        :param vector (dict): SeqTracker per sender key.
+        :return: (messages not in ``vector``, whether more remain).
+        """
+        messages = []
+        for i in range(self._count):
+            message = self._at(i)
+            if message.seq is None or message.epoch is None:
+                continue
+            seen = vector.get(sender_key(message.username, message.epoch))
+            if seen is not None and message.seq in seen:
+                continue
+            if len(messages) == limit:
+                return messages, True
+            messages.append(message)
+        return messages, False
+
+    def senders(self):
+        keys = set()
+        for i in range(self._count):
+            message = self._at(i)
+            if message.epoch is not None:
+                keys.add(sender_key(message.username, message.epoch))
+        return keys
+
+class MessageHistory:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            # The ring buffers index modulo the capacity
+            raise ValueError("history capacity must be at least 1, got {}".format(capacity))
+        self.capacity = capacity
+        self.channels = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def add(self, channel, username, content, timestamp, seq=None, epoch=None):
+        with self.lock:
+            history = self.channels.get(channel)
+            if history is None:
+                history = ChannelHistory(self.capacity)
+                self.channels[channel] = history
+            message = Message(next(self._ids), channel, username, content, timestamp, seq, epoch)
+            history.append(message)
+        return message
+
+    def page(self, channel, before=None, limit=50):
+        with self.lock:
+            history = self.channels.get(channel)
+            if history is None:
+                return []
+            return history.page(before, limit)
+
+    def missing(self, channel, vector, limit):
+        with self.lock:
+            history = self.channels.get(channel)
+            if history is None:
+                return [], False
+            return history.missing(vector, limit)
+
+    def senders(self, channel):
+        """
+        :return: sender keys with at least one message in ``channel``.
+        """
+        with self.lock:
+            history = self.channels.get(channel)
+            return history.senders() if history is not None else set()
@@ -1,6 +1,37 @@
+import threading
+from urllib.parse import urlparse, parse_qs
 from .request import Request
 from .response import Response
 from .utils import raw_data_to_msg
+from . import tracing
+from . import profiler
+from . import auth
+
+class ObjectPool:
+    """
+    Free list of reusable objects; ``release`` calls ``reset()`` on the
+    object and keeps at most ``size`` of them.
+    """
+    def __init__(self, factory, size=64):
+        self.factory = factory
+        self.size = size
+        self.items = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.items:
+                return self.items.pop()
+        return self.factory()
+
+    def release(self, obj):
+        obj.reset()
+        with self.lock:
+            if len(self.items) < self.size:
+                self.items.append(obj)
+
+REQUEST_POOL = ObjectPool(Request)
+RESPONSE_POOL = ObjectPool(Response)
 
 class HttpAdapter:
     __attrs__ = [
@@ -11,67 +42,146 @@ class HttpAdapter:
         "routes",
         "request",
         "response",
+        "timeouts",
+        "trace",
+        "header_string",
     ]
 
-    def __init__(self, ip, port, conn, connaddr, routes):
+    def __init__(self, ip, port, conn, connaddr, routes, timeouts=None):
         self.ip = ip
         self.port = port
         self.conn = conn
         self.connaddr = connaddr
         self.routes = routes
-        self.request = Request()
-        self.response = Response()
+        self.request = REQUEST_POOL.acquire()
+        self.response = RESPONSE_POOL.acquire()
+        self.timeouts = timeouts
+        self.trace = None
+        self.header_string = None
 
     def handle_client(self, conn, addr, routes):
-        self.conn = conn        
+        if self.trace is None and not self.read_client(conn, addr, routes):
+            return
+        # The request may have been read on another thread
+        tracing.resume(self.trace)
+        try:
+            self.serve_client(conn, addr, routes, self.trace)
+        finally:
+            self.release()
+
+    def read_client(self, conn, addr, routes):
+        """
+        Read and prepare one request. The backend calls this before the
+        request competes for a worker permit, since its pace is up to
+        the client.
+
+        :return: True if there is a request to serve; otherwise the
+            connection is closed and the adapter released.
+        """
+        self.conn = conn
         self.connaddr = addr
+        self.trace = tracing.begin('backend')
+        try:
+            with self.trace.span('read'):
+                header_string, body_byte = raw_data_to_msg(conn, self.timeouts, self.wants_stream)
+        except (TimeoutError, ValueError) as e:
+            print("[HttpAdapter] {} closed: {}".format(addr, e))
+            conn.close()
+            self.release()
+            return False
+        self.request.prepare(header_string, body_byte, routes)
+        if not self.request.method:
+            conn.close()
+            self.release()
+            return False
+        self.header_string = header_string
+        return True
+
+    def release(self):
+        tracing.finish(self.trace)
+        # Nothing may touch request/response after they go back to the pool
+        REQUEST_POOL.release(self.request)
+        RESPONSE_POOL.release(self.response)
+        self.request = None
+        self.response = None
+
+    def wants_stream(self, header_string):
+        method, path, _ = self.request.extract_request_line(header_string)
+        hook = self.routes.get((method, path)) if self.routes else None
+        return getattr(hook, '_route_stream', False)
+
+    def call_hook(self, req):
+        if not req.hook:
+            return None
+        with tracing.span('handler'):
+            return profiler.ROUTES.call((req.method, req.path), req.hook, header=req.headers, body=req.body)
+
+    def serve_client(self, conn, addr, routes, trace):
         req = self.request
         resp = self.response
-        header_string, body_byte = raw_data_to_msg(conn)
-        req.prepare(header_string, body_byte, routes)
-        if not req.method:
-            conn.close()
-            return
-        auth_cookie = req.cookies.get('auth', 'false')
-        if req.path == "/login" or req.path == "/login.html":
+        trace.request_id = tracing.find_request_id(self.header_string) or trace.request_id
+        trace.name = "{} {}".format(req.method, req.path)
+        resp.request = req
+        if req.path.startswith("/admin/profile") and profiler.is_local(addr):
+            status, content_type, body = profiler.handle_admin('backend', parse_qs(urlparse(req.path).query), req.method)
+            response = resp.build_body_response(status, content_type, body)
+        elif req.path == "/login" or req.path == "/login.html":
             if req.method == "GET":
                 req.path = '/login.html'
                 response = resp.build_response(req)
             elif req.method == "POST":
-                if req.hook:
-                    API_return = req.hook(header=req.headers, body=req.body)
+                API_return = self.call_hook(req)
                 if API_return != True:
                     response = resp.build_unauthorized()
                 else:
-                    resp.headers['Set-Cookie'] = 'auth=true'
+                    username = req.body.get('username', '') if isinstance(req.body, dict) else ''
+                    resp.headers['Set-Cookie'] = auth.set_cookie(auth.issue(username))
                     req.path = '/index.html'
                     response = resp.build_response(req)
         elif req.path == "/" or req.path == "/index.html":
-            if auth_cookie != 'true':
+            # The page depends on the auth cookie, so caches must key on it
+            resp.add_vary('Cookie')
+            if auth.verify(req.cookies.get(auth.COOKIE_NAME)) is None:
                 response = resp.build_unauthorized()
             else:
                 req.path = '/index.html'
                 response = resp.build_response(req)
         elif req.path == "/submit-info":
-            API_return = None
-            if req.hook:
-                API_return = req.hook(header=req.headers, body=req.body)
+            API_return = self.call_hook(req)
             if API_return == True:
                 response = resp.build_json_response({"status": "success"})
             else:
                 response = resp.build_json_response({"status": "failed"})
         elif req.path == "/get-list":
-            API_return = None
-            if req.hook:
-                API_return = req.hook(header=req.headers, body=req.body)
+            API_return = self.call_hook(req)
             if isinstance(API_return, (dict, list)):
                 response = resp.build_json_response(API_return)
             else:
                 response = resp.build_json_response({"status": "failed"})
+        elif req.path == "/replicate":
+            API_return = self.call_hook(req)
+            if isinstance(API_return, dict):
+                response = resp.build_json_response(API_return)
+            else:
+                response = resp.build_body_response(400, 'application/json', b'{"status": "failed"}')
+        elif req.hook:
+            # Any other registered route: bodies of streaming uploads and
+            # plain handlers alike turn into JSON
+            try:
+                API_return = self.call_hook(req)
+            except (ValueError, ConnectionError, TimeoutError) as e:
+                print("[HttpAdapter] {} {} failed: {}".format(req.method, req.path, e))
+                API_return = None
+            if isinstance(API_return, (dict, list)):
+                response = resp.build_json_response(API_return)
+            elif API_return == True:
+                response = resp.build_json_response({"status": "success"})
+            else:
+                response = resp.build_body_response(400, 'application/json', b'{"status": "failed"}')
         elif req.path.startswith("/static/") or req.path.startswith("/css/") or req.path.startswith("/images/") or req.path.startswith("/js/"):
             response = resp.build_response(req)
         else:
             response = resp.build_not_found()
-        conn.sendall(response)
+        conn.sendall(trace.add_response_headers(response))
         conn.close()
         return
\ No newline at end of file
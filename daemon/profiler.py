@@ -0,0 +1,204 @@
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import signal
+import cProfile
+import tempfile
+import threading
+
+LOOPBACK = ('127.0.0.1', '::1', 'localhost')
+# Admin actions that change profiler state; they must come as POST
+STATE_ACTIONS = ('start', 'stop', 'route')
+MAX_INTERVAL = 1.0
+
+def frame_label(code):
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class StackSampler:
+    """
+    Statistical profiler: a daemon thread snapshots every thread's stack
+    each ``interval`` seconds and counts them in collapsed form
+    (``outer;inner;leaf``), the input format of flamegraph tools. Costs
+    nothing while stopped and one frame walk per thread per tick while
+    running. Samples are wall clock, so blocked threads show up under
+    the call they wait in.
+    """
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.counts = {}
+        self.samples = 0
+        self.started = None
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self, interval=None):
+        with self.lock:
+            if self.running:
+                return False
+            if interval:
+                self.interval = interval
+            self.counts = {}
+            self.samples = 0
+            self.started = time.time()
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return False
+            self.running = False
+            thread = self.thread
+        thread.join()
+        return True
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            time.sleep(self.interval)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-{}'.format(ident)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def folded(self):
+        counts = dict(self.counts)
+        return "".join("{} {}\n".format(stack, count)
+                       for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+    def status(self):
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "stacks": len(self.counts),
+            "started": self.started,
+        }
+
+class RouteProfiler:
+    """
+    Deterministic ``cProfile`` capture of the next ``count`` calls of one
+    route handler. Profiled calls are serialized because a Profile object
+    cannot be shared by threads; unarmed routes only pay a dict lookup.
+    """
+    def __init__(self):
+        self.armed = {}
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def arm(self, key, count, path):
+        with self.lock:
+            self.armed[key] = [count, cProfile.Profile(), path, threading.Lock()]
+
+    def call(self, key, func, *args, **kwargs):
+        capture = self.armed.get(key)
+        if capture is None:
+            return func(*args, **kwargs)
+        with capture[3]:
+            if capture[0] <= 0:
+                return func(*args, **kwargs)
+            try:
+                return capture[1].runcall(func, *args, **kwargs)
+            finally:
+                capture[0] -= 1
+                if capture[0] == 0:
+                    self.finish(key, capture)
+
+    def finish(self, key, capture):
+        with self.lock:
+            if self.armed.get(key) is capture:
+                del self.armed[key]
+        profile, path = capture[1], capture[2]
+        profile.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(15)
+        self.results[key] = path
+        print("[Profiler] {} {} written to {}".format(key[0], key[1], path))
+        print(out.getvalue())
+
+    def status(self):
+        with self.lock:
+            armed = {"{} {}".format(*key): capture[0] for key, capture in self.armed.items()}
+        return {"armed": armed, "results": {"{} {}".format(*key): path for key, path in self.results.items()}}
+
+SAMPLER = StackSampler()
+ROUTES = RouteProfiler()
+PROFILE_DIR = tempfile.gettempdir()
+
+def dump_path(service, suffix):
+    return os.path.join(PROFILE_DIR, "{}-{}-{}.{}".format(service, os.getpid(), int(time.time()), suffix))
+
+def install_signal_handler(service, directory=None):
+    """
+    Toggle the sampler on SIGUSR1; stopping writes the collapsed stacks
+    to ``directory``.
+    """
+    global PROFILE_DIR
+    if directory:
+        PROFILE_DIR = directory
+    if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+        return
+
+    def on_signal(signum, frame):
+        if SAMPLER.start():
+            print("[Profiler] Sampling started")
+            return
+        SAMPLER.stop()
+        path = dump_path(service, 'folded')
+        with open(path, 'w') as f:
+            f.write(SAMPLER.folded())
+        print("[Profiler] {} samples written to {}".format(SAMPLER.samples, path))
+    signal.signal(signal.SIGUSR1, on_signal)
+
+def is_local(addr):
+    return bool(addr) and addr[0] in LOOPBACK
+
+def handle_admin(service, query, method='GET'):
+    """
+    Run one ``/admin/profile`` command.
+
+    :param query (dict): parsed query string, values are lists.
+    :param method (str): request method; actions in STATE_ACTIONS need POST.
+    :return: (status code, content type, body bytes).
+    """
+    action = query.get('action', ['status'])[0]
+    if action in STATE_ACTIONS and method != 'POST':
+        return 405, 'application/json', json.dumps({"error": "{} requires POST".format(action)}).encode('utf-8')
+    try:
+        if action == 'start':
+            interval = float(query['interval'][0]) if 'interval' in query else None
+            if interval is not None and not 0 < interval <= MAX_INTERVAL:
+                raise ValueError(interval)
+            SAMPLER.start(interval)
+        elif action in ('stop', 'dump'):
+            if action == 'stop':
+                SAMPLER.stop()
+            return 200, 'text/plain; charset=utf-8', SAMPLER.folded().encode('utf-8')
+        elif action == 'route':
+            route_method = query.get('method', ['GET'])[0].upper()
+            path = query['path'][0]
+            count = int(query.get('count', ['100'])[0])
+            if count <= 0:
+                raise ValueError(count)
+            ROUTES.arm((route_method, path), count, dump_path(service, 'prof'))
+        elif action != 'status':
+            return 400, 'application/json', json.dumps({"error": "unknown action"}).encode('utf-8')
+    except (KeyError, ValueError):
+        return 400, 'application/json', json.dumps({"error": "invalid arguments"}).encode('utf-8')
+    body = {"sampler": SAMPLER.status(), "routes": ROUTES.status()}
+    return 200, 'application/json', json.dumps(body).encode('utf-8')
@@ -1,25 +1,116 @@
+import math
 import socket
 import threading
+from urllib.parse import urlparse, parse_qs
 from .response import Response
 from .utils import raw_data_to_msg
+from .cache import ResponseCache, CACHEABLE_STATUS, parse_size, parse_response_head, parse_cache_control
+from .dictionary import CaseInsensitiveDict
+from .routing import RoutingTable
+from .ratelimit import RateLimiter
+from .timeouts import Timeouts, start_reporter
+from . import tracing
+from . import profiler
+
+CLIENT_TIMEOUTS = Timeouts()
+UPSTREAM_TIMEOUTS = Timeouts.upstream()
 
 HOST_COUNTERS = {}
 COUNTERS_LOCK = threading.Lock()
 
+CACHES = {}
+CACHES_LOCK = threading.Lock()
+
+LIMITERS = {}
+LIMITERS_LOCK = threading.Lock()
+
+INFLIGHT = {}
+INFLIGHT_LOCK = threading.Lock()
+
+# Request headers that can change the upstream response for the same URL
+FLIGHT_KEY_HEADERS = ('accept-encoding', 'cookie', 'authorization', 'if-none-match', 'if-modified-since')
+
+class Flight:
+    __slots__ = ('done', 'response')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+def shareable(response):
+    """
+    Whether one client's response may be handed to another, by the same
+    rules a shared cache uses.
+    """
+    status_code, headers, _ = parse_response_head(response)
+    if status_code not in CACHEABLE_STATUS and status_code != 304:
+        return False
+    cc = parse_cache_control(headers.get('cache-control'))
+    return not ('no-store' in cc or 'private' in cc or 'no-cache' in cc or 'set-cookie' in headers)
+
+def single_flight(key, fetch):
+    """
+    Run ``fetch`` once for concurrent callers sharing ``key``; followers
+    wait for the leader and reuse its response when it is shareable, and
+    fetch their own otherwise. If the leader's fetch raises, it and its
+    followers answer 502.
+    """
+    with INFLIGHT_LOCK:
+        flight = INFLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            INFLIGHT[key] = flight
+    if not leader:
+        flight.done.wait()
+    else:
+        try:
+            flight.response = fetch()
+        except Exception as e:
+            print("[Proxy] Upstream fetch for {} failed: {}".format(key, e))
+        finally:
+            with INFLIGHT_LOCK:
+                del INFLIGHT[key]
+            flight.done.set()
+    if flight.response is None:
+        return Response().build_bad_gateway()
+    if leader:
+        return flight.response
+    if not shareable(flight.response):
+        return fetch()
+    # The leader's request id and timings describe the leader's request
+    return tracing.strip_response_headers(flight.response)
+
+def flight_key(hostname, path, request_headers):
+    return (hostname, path) + tuple(request_headers.get(name, '') for name in FLIGHT_KEY_HEADERS)
+
 def forward_request(host, port, request):
     backend = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        backend.connect((host, port))
-        backend.sendall(request)
-        header_string, body_byte = raw_data_to_msg(backend)
+        backend.settimeout(UPSTREAM_TIMEOUTS.connect)
+        with tracing.span('connect'):
+            backend.connect((host, port))
+        backend.settimeout(None)
+        with tracing.span('upstream'):
+            backend.sendall(request)
+            header_string, body_byte = raw_data_to_msg(backend, UPSTREAM_TIMEOUTS)
         return header_string.encode('latin-1') + b"\r\n\r\n" + body_byte
+    except TimeoutError as e:
+        print("[Proxy] Upstream {}:{} {}".format(host, port, e))
+        return Response().build_gateway_timeout()
+    except ValueError as e:
+        # Unparseable response head, e.g. a bad Content-Length
+        print("[Proxy] Upstream {}:{} {}".format(host, port, e))
+        return Response().build_bad_gateway()
     except socket.error:
       print("Socket error")
       resp = Response()
       return resp.build_internal_error()
+    finally:
+        backend.close()
 
 def resolve_routing_policy(hostname, routes):
-    proxy_pass_list, dist_policy = routes.get(hostname,([], 'round-robin'))
+    proxy_pass_list, dist_policy = routes.get(hostname, ([], 'round-robin', {}))[:2]
     if isinstance(proxy_pass_list, list):
         if len(proxy_pass_list) == 0:
             print("{} has no backend".format(hostname))
@@ -31,7 +122,7 @@ def resolve_routing_policy(hostname, routes):
             print("{} has multiple backends".format(hostname))
             # Default to RoundRobin
             with COUNTERS_LOCK:
-                current_index = HOST_COUNTERS.get(hostname, 0)
+                current_index = HOST_COUNTERS.get(hostname, 0) % len(proxy_pass_list)
                 selected_backend = proxy_pass_list[current_index]
                 proxy_host, proxy_port = selected_backend.split(":", 1)
                 new_index = (current_index + 1) % len(proxy_pass_list)
@@ -41,27 +132,199 @@ def resolve_routing_policy(hostname, routes):
         proxy_host, proxy_port = proxy_pass_list.split(":", 1)
     return proxy_host, proxy_port
 
-def handle_client(ip, port, conn, addr, routes):
-    header_string, body_byte = raw_data_to_msg(conn)
+def get_cache(hostname, options):
+    if options.get('proxy_cache', 'off') != 'on':
+        return None
+    with CACHES_LOCK:
+        cache = CACHES.get(hostname)
+        if cache is None:
+            cache = ResponseCache(
+                max_bytes=parse_size(options.get('proxy_cache_max_size', '64m')),
+                default_ttl=float(options.get('proxy_cache_valid', 0)),
+                stale_while_revalidate=float(options.get('proxy_cache_stale_while_revalidate', 0))
+            )
+            CACHES[hostname] = cache
+    return cache
+
+def revalidate(cache, key, request_headers, header_string, entry, proxy_host, proxy_port):
+    lines = [line for line in header_string.split('\r\n')
+             if not line.lower().startswith(('if-none-match:', 'if-modified-since:'))]
+    lines.extend(entry.conditional_headers())
+    request = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+    response = forward_request(proxy_host, proxy_port, request)
+    entry.revalidating = False
+    status_code, _, _ = parse_response_head(response)
+    if status_code == 304:
+        cache.refresh(entry, response)
+        return entry.response
+    if status_code >= 500:
+        # Upstream trouble: keep serving what we have
+        return entry.response
+    cache.store(key, request_headers, tracing.strip_response_headers(response))
+    return response
+
+def fetch_cached(cache, key, request_headers, header_string, msg, proxy_host, proxy_port):
+    entry = cache.lookup(key, request_headers)
+    if entry is not None:
+        state = entry.state()
+        if state == 'fresh':
+            print("[Proxy] Cache hit {}".format(key))
+            return entry.response
+        if state == 'stale':
+            print("[Proxy] Cache stale {}".format(key))
+            if not entry.revalidating:
+                entry.revalidating = True
+                threading.Thread(target=revalidate, args=(cache, key, request_headers, header_string, entry, proxy_host, proxy_port), daemon=True).start()
+            return entry.response
+        return single_flight(flight_key(*key, request_headers),
+                             lambda: revalidate(cache, key, request_headers, header_string, entry, proxy_host, proxy_port))
+
+    def fetch():
+        # A flight that finished just before ours may have filled the cache
+        entry = cache.lookup(key, request_headers)
+        if entry is not None and entry.state() == 'fresh':
+            return entry.response
+        response = forward_request(proxy_host, proxy_port, msg)
+        cache.store(key, request_headers, tracing.strip_response_headers(response))
+        return response
+    return single_flight(flight_key(*key, request_headers), fetch)
+
+def get_limiter(hostname, options):
+    if 'limit_req_client' not in options and 'limit_req_host' not in options:
+        return None
+    with LIMITERS_LOCK:
+        if hostname in LIMITERS:
+            return LIMITERS[hostname]
+        try:
+            limiter = RateLimiter(options)
+        except ValueError as e:
+            # Remember the bad setting so it is reported once per config
+            print("[Proxy] {} rate limit ignored: {}".format(hostname, e))
+            limiter = None
+        LIMITERS[hostname] = limiter
+    return limiter
+
+def limit_settings(options):
+    return {k: v for k, v in options.items() if k.startswith('limit_req')}
+
+def cache_settings(options):
+    return {k: v for k, v in options.items() if k.startswith('proxy_cache')}
+
+def apply_reload(old, new):
+    """
+    Keep balancer counters and caches of hosts whose settings did not
+    change across a config reload.
+    """
+    for hostname, (old_passes, _, old_options) in old.routes.items():
+        new_route = new.routes.get(hostname)
+        if new_route is None or new_route[0] != old_passes:
+            with COUNTERS_LOCK:
+                HOST_COUNTERS.pop(hostname, None)
+        if new_route is None or cache_settings(new_route[2]) != cache_settings(old_options):
+            with CACHES_LOCK:
+                CACHES.pop(hostname, None)
+        if new_route is None or limit_settings(new_route[2]) != limit_settings(old_options):
+            with LIMITERS_LOCK:
+                LIMITERS.pop(hostname, None)
+
+def handle_client(ip, port, conn, addr, routing):
+    trace = tracing.begin('proxy')
+    try:
+        serve_client(ip, port, conn, addr, routing, trace)
+    except Exception as e:
+        # Whatever went wrong, the client still gets an answer and a close
+        print("[Proxy] {} failed: {}".format(addr, e))
+        try:
+            conn.sendall(trace.add_response_headers(Response().build_bad_gateway()))
+        except OSError:
+            pass
+        conn.close()
+    finally:
+        tracing.finish(trace)
+
+def serve_client(ip, port, conn, addr, routing, trace):
+    try:
+        with trace.span('read'):
+            header_string, body_byte = raw_data_to_msg(conn, CLIENT_TIMEOUTS)
+    except TimeoutError as e:
+        print("[Proxy] {} closed: {}".format(addr, e))
+        conn.close()
+        return
+    # Reuse the client's request id, or mint one for the upstream to log
+    request_id = tracing.find_request_id(header_string)
+    if request_id:
+        trace.request_id = request_id
+    elif header_string:
+        header_string = tracing.add_request_header(header_string, tracing.REQUEST_ID_HEADER, trace.request_id)
+    trace.name = " ".join(header_string.split('\r\n', 1)[0].split()[:2])
+    target = trace.name.partition(' ')[2]
+    if target.startswith('/admin/'):
+        # Upstreams see the proxy's loopback address, so admin access is
+        # decided here for every service behind it
+        if not profiler.is_local(addr):
+            print("[Proxy] Refused {} from {}".format(target, addr))
+            conn.sendall(trace.add_response_headers(Response().build_forbidden()))
+            conn.close()
+            return
+        if target.startswith('/admin/profile'):
+            status, content_type, body = profiler.handle_admin('proxy', parse_qs(urlparse(target).query), trace.name.partition(' ')[0])
+            conn.sendall(Response().build_body_response(status, content_type, body))
+            conn.close()
+            return
     msg = header_string.encode('latin-1') + b"\r\n\r\n" + body_byte
     hostname = "unknown"
-    for line in header_string.splitlines():
-        if line.lower().startswith('host:'):
-            hostname = line.split(':', 1)[1].strip()
-            break
-    print("{} at host: {}".format(addr, hostname))
-    proxy_host, proxy_port = resolve_routing_policy(hostname, routes)
-    if proxy_host and proxy_port is not None:
+    request_headers = CaseInsensitiveDict()
+    for line in header_string.split('\r\n')[1:]:
+        if ':' in line:
+            key, val = line.split(':', 1)
+            request_headers[key.strip()] = val.strip()
+    with trace.span('route'):
+        snapshot = routing.current
+        route_key, route = snapshot.match(request_headers.get('host', ''))
+        hostname = route_key or request_headers.get('host', hostname)
+        print("{} at host: {}".format(addr, hostname))
+        limiter = get_limiter(hostname, route[2]) if route else None
+        wait = limiter.check(addr, request_headers) if limiter else None
+        if wait is None:
+            proxy_host, proxy_port = resolve_routing_policy(hostname, snapshot.routes)
+    if wait is not None:
+        print("[Proxy] Rate limited {} on {}".format(addr, hostname))
+        response = Response().build_too_many_requests(max(1, int(math.ceil(wait))))
+    elif proxy_host and proxy_port is not None:
         proxy_port = int(proxy_port)
         print("Host {} forwards to {}:{}".format(hostname, proxy_host, proxy_port))
-        response = forward_request(proxy_host, proxy_port, msg)
+        request_line = header_string.split('\r\n', 1)[0].split()
+        options = route[2]
+        cache = get_cache(hostname, options)
+        is_get = len(request_line) == 3 and request_line[0] == 'GET' and not body_byte
+        if cache and is_get and 'authorization' not in request_headers:
+            key = (hostname, request_line[1])
+            response = fetch_cached(cache, key, request_headers, header_string, msg, proxy_host, proxy_port)
+        elif is_get and options.get('proxy_coalesce', 'off') == 'on':
+            key = flight_key(hostname, request_line[1], request_headers)
+            response = single_flight(key, lambda: forward_request(proxy_host, proxy_port, msg))
+        else:
+            response = forward_request(proxy_host, proxy_port, msg)
     else:
         response = Response()
         response = response.build_not_found()
-    conn.sendall(response)
+    conn.sendall(trace.add_response_headers(response))
     conn.close()
 
-def run_proxy(ip, port, routes):
+def run_proxy(ip, port, routes, config_file=None, timeouts=None, upstream_timeouts=None, trace_file=None, profile_dir=None):
+    global CLIENT_TIMEOUTS, UPSTREAM_TIMEOUTS
+    profiler.install_signal_handler('proxy', profile_dir)
+    if trace_file:
+        tracing.configure(trace_file, 'proxy')
+    if timeouts:
+        CLIENT_TIMEOUTS = timeouts
+    if upstream_timeouts:
+        UPSTREAM_TIMEOUTS = upstream_timeouts
+    start_reporter("Proxy")
+    routing = RoutingTable(routes, config_file, on_reload=apply_reload)
+    routing.install_signal_handler()
+    if config_file:
+        routing.watch()
     proxy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
         proxy.bind((ip, port))
@@ -69,10 +332,10 @@ def run_proxy(ip, port, routes):
         print("[Proxy] Listening on IP {} port {}".format(ip,port))
         while True:
             conn, addr = proxy.accept()
-            client_thread = threading.Thread(target=handle_client, args=(ip, port, conn, addr, routes))
+            client_thread = threading.Thread(target=handle_client, args=(ip, port, conn, addr, routing))
             client_thread.start()
     except socket.error as e:
       print("Socket error: {}".format(e))
 
-def create_proxy(ip, port, routes):
-    run_proxy(ip, port, routes)
\ No newline at end of file
+def create_proxy(ip, port, routes, config_file=None, timeouts=None, upstream_timeouts=None, trace_file=None, profile_dir=None):
+    run_proxy(ip, port, routes, config_file, timeouts, upstream_timeouts, trace_file, profile_dir)
\ No newline at end of file
@@ -0,0 +1,141 @@
+import re
+import time
+import math
+import threading
+from . import auth
+
+# Values of ``limit_req_key``; the session modes verify the auth cookie
+KEY_MODES = ('ip', 'cookie', 'ip_cookie')
+SESSION_KEY_MODES = ('cookie', 'ip_cookie')
+
+def parse_key_mode(value):
+    if value not in KEY_MODES:
+        raise ValueError("Invalid limit_req_key: {} (expected one of {})".format(value, ', '.join(KEY_MODES)))
+    return value
+
+def parse_rate(value):
+    """
+    Parse a ``limit_req_*`` option such as ``10r/s burst=20``.
+
+    :return: (tokens per second, burst size).
+    """
+    match = re.match(r'\s*(\d+(?:\.\d+)?)r/([sm])(?:\s+burst=(\d+))?\s*$', value)
+    if not match:
+        raise ValueError("Invalid rate: {}".format(value))
+    rate = float(match.group(1))
+    if rate <= 0:
+        raise ValueError("Rate must be positive: {}".format(value))
+    if match.group(2) == 'm':
+        rate /= 60.0
+    burst = int(match.group(3)) if match.group(3) else max(1, int(math.ceil(rate)))
+    return rate, burst
+
+class TokenBucketTable:
+    """
+    Token buckets keyed by client, split over ``stripes`` independently
+    locked dicts. Buckets refill lazily when touched. A bucket idle long
+    enough to be full again is the same as a missing one, so it is
+    dropped. Each stripe stays in least-recently-used order, which makes
+    eviction pop from the front.
+
+    :param rate (float): tokens added per second.
+    :param burst (int): bucket capacity.
+    :param stripes (int): number of lock stripes.
+    :param max_entries (int): upper bound on tracked keys.
+    """
+    def __init__(self, rate, burst, stripes=64, max_entries=1000000):
+        self.rate = rate
+        self.burst = burst
+        self.idle_after = burst / rate
+        self.max_per_stripe = max(1, max_entries // stripes)
+        self.stripes = [({}, threading.Lock()) for _ in range(stripes)]
+
+    def take(self, key, now=None):
+        """
+        :return: (allowed, seconds until a token is available).
+        """
+        now = now if now is not None else time.monotonic()
+        buckets, lock = self.stripes[hash(key) % len(self.stripes)]
+        with lock:
+            state = buckets.pop(key, None)
+            if state is None:
+                tokens = float(self.burst)
+            else:
+                tokens, last = state
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1.0:
+                tokens -= 1.0
+                allowed, wait = True, 0.0
+            else:
+                allowed, wait = False, (1.0 - tokens) / self.rate
+            buckets[key] = (tokens, now)
+            self.evict(buckets, now)
+        return allowed, wait
+
+    def refund(self, key):
+        """
+        Give back the token of a request that was rejected further on.
+        """
+        buckets, lock = self.stripes[hash(key) % len(self.stripes)]
+        with lock:
+            state = buckets.get(key)
+            if state is not None:
+                buckets[key] = (min(self.burst, state[0] + 1.0), state[1])
+
+    def evict(self, buckets, now):
+        while buckets:
+            oldest = next(iter(buckets))
+            tokens, last = buckets[oldest]
+            if len(buckets) <= self.max_per_stripe and now - last < self.idle_after:
+                break
+            del buckets[oldest]
+
+    def __len__(self):
+        return sum(len(buckets) for buckets, _ in self.stripes)
+
+class RateLimiter:
+    """
+    Per-client and per-host limits for one virtual host, built from the
+    ``limit_req_client``, ``limit_req_host`` and ``limit_req_key``
+    options of a host block.
+    """
+    def __init__(self, options):
+        self.key_mode = parse_key_mode(options.get('limit_req_key', 'ip'))
+        self.client = None
+        self.host = None
+        if 'limit_req_client' in options:
+            self.client = TokenBucketTable(*parse_rate(options['limit_req_client']))
+        if 'limit_req_host' in options:
+            self.host = TokenBucketTable(*parse_rate(options['limit_req_host']), stripes=1)
+
+    def client_key(self, addr, request_headers):
+        ip = addr[0] if addr else ''
+        if self.key_mode == 'ip':
+            return ip
+        # Only a verified session names a client; anything else could be
+        # rotated at will to dodge the limit, so it falls back to the IP
+        user = auth.authenticate(request_headers.get('cookie', ''))
+        if user is None:
+            return ip
+        if self.key_mode == 'cookie':
+            return 'user:' + user
+        return (ip, user)
+
+    def check(self, addr, request_headers):
+        """
+        :return: None if allowed, else seconds the client should wait.
+        """
+        now = time.monotonic()
+        key = None
+        if self.client is not None:
+            key = self.client_key(addr, request_headers)
+            allowed, wait = self.client.take(key, now)
+            if not allowed:
+                return wait
+        if self.host is not None:
+            allowed, wait = self.host.take('', now)
+            if not allowed:
+                if key is not None:
+                    self.client.refund(key)
+                return wait
+        return None
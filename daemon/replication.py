@@ -0,0 +1,160 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from .client import HttpSession
+from . import auth
+
+class Membership:
+    """
+    Peer registry that several trackers can merge in any order. Each
+    entry carries a ``[wall time, tracker id]`` stamp and a merge keeps
+    the higher stamp, so every tracker converges on the same view once
+    it has seen the same updates.
+    """
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.last_stamp = 0.0
+        self.cached_digest = None
+
+    def next_stamp(self):
+        # Strictly increasing even if the wall clock steps back
+        self.last_stamp = max(self.last_stamp + 1e-6, time.time())
+        return [self.last_stamp, self.node_id]
+
+    def add(self, ip, port, username=None):
+        key = "{}:{}".format(ip, port)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["username"] == username:
+                return
+            self.entries[key] = {
+                "ip": ip,
+                "port": int(port),
+                "username": username,
+                "first_seen": entry["first_seen"] if entry else time.time(),
+                "stamp": self.next_stamp(),
+            }
+            self.cached_digest = None
+
+    def peers(self):
+        with self.lock:
+            entries = sorted(self.entries.values(), key=lambda entry: entry["first_seen"])
+        return [(entry["ip"], entry["port"]) for entry in entries]
+
+    def digest(self):
+        with self.lock:
+            if self.cached_digest is None:
+                items = sorted((key, entry["stamp"]) for key, entry in self.entries.items())
+                self.cached_digest = hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()
+            return self.cached_digest
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.entries)
+
+    def merge(self, entries):
+        """
+        :return: number of entries that changed.
+        """
+        changed = 0
+        with self.lock:
+            for key, entry in entries.items():
+                try:
+                    stamp = [float(entry["stamp"][0]), str(entry["stamp"][1])]
+                    incoming = {
+                        "ip": str(entry["ip"]),
+                        "port": int(entry["port"]),
+                        "username": entry.get("username"),
+                        "first_seen": float(entry.get("first_seen", stamp[0])),
+                        "stamp": stamp,
+                    }
+                except (KeyError, IndexError, TypeError, ValueError):
+                    continue
+                current = self.entries.get(key)
+                if current is None or current["stamp"] < stamp:
+                    self.entries[key] = incoming
+                    self.last_stamp = max(self.last_stamp, stamp[0])
+                    changed += 1
+            if changed:
+                self.cached_digest = None
+        return changed
+
+class Replicator:
+    """
+    Push-pull anti-entropy between trackers. Every ``interval`` seconds
+    one random replica gets our digest; only when the digests differ do
+    the two sides swap entries, so a converged cluster sends one small
+    request per tracker per round.
+
+    :param membership (Membership): local state.
+    :param replicas (list): base URLs of the other trackers.
+    :param interval (float): seconds between rounds.
+    """
+    def __init__(self, membership, replicas, interval=1.0):
+        self.membership = membership
+        self.replicas = list(replicas)
+        self.interval = interval
+        self.sessions = {url: HttpSession(url, connect_timeout=1.0, read_timeout=2.0, retries=0) for url in self.replicas}
+        self.token = None
+        self.token_renew_at = 0
+        self.running = False
+
+    def start(self):
+        if not self.replicas:
+            return
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while self.running:
+            # Jitter keeps trackers started together from syncing in lockstep
+            time.sleep(self.interval * random.uniform(0.5, 1.5))
+            url = random.choice(self.replicas)
+            try:
+                self.sync(url)
+            except (OSError, ValueError) as e:
+                print("[Replication] Sync with {} unsuccessfully: {}".format(url, e))
+
+    def post(self, url, payload):
+        # Replicas accept each other by a token signed with the shared secret
+        if time.time() >= self.token_renew_at:
+            self.token = auth.issue("tracker:{}".format(self.membership.node_id), ttl=300)
+            self.token_renew_at = time.time() + 240
+        session = self.sessions[url]
+        session.cookies[auth.COOKIE_NAME] = self.token
+        response = session.request("POST", "/replicate", body_data=json.dumps(payload).encode('utf-8'),
+                                   headers={"Content-Type": "application/json"})
+        if response.status_code != 200:
+            raise ValueError("status code {}".format(response.status_code))
+        return response.json()
+
+    def sync(self, url):
+        reply = self.post(url, {"node": self.membership.node_id, "digest": self.membership.digest()})
+        if reply.get("digest") == self.membership.digest():
+            return
+        pulled = self.membership.merge(reply.get("entries", {}))
+        if reply.get("digest") != self.membership.digest():
+            # They are missing some of ours
+            self.post(url, {"node": self.membership.node_id, "entries": self.membership.snapshot()})
+        if pulled:
+            print("[Replication] Pulled {} entries from {}".format(pulled, url))
+
+    def handle(self, payload):
+        """
+        Answer one ``/replicate`` request from another tracker.
+
+        :return: dict reply, or None for a malformed request.
+        """
+        if not isinstance(payload, dict):
+            return None
+        entries = payload.get("entries")
+        if isinstance(entries, dict):
+            self.membership.merge(entries)
+        reply = {"digest": self.membership.digest()}
+        if "digest" in payload and payload["digest"] != reply["digest"]:
+            reply["entries"] = self.membership.snapshot()
+        return reply
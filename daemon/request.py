@@ -1,37 +1,95 @@
 from .dictionary import CaseInsensitiveDict
+from .compression import parse_accept_encoding
+from .body import BodyStream
+from . import tracing
 
 class Request():
+    # Headers, cookies, body and Accept-Encoding are parsed from the raw
+    # message on first access, so static file requests never pay for them.
+    # That first access is what the 'parse' spans time.
+    __slots__ = (
+        'method', 'url', 'path', 'version', 'routes', 'hook',
+        '_header_string', '_body_byte',
+        '_headers', '_cookies', '_body', '_accept_encoding',
+    )
+
     def __init__(self):
+        self.reset()
+
+    def reset(self):
         #: HTTP verb to send to the server.
         self.method = None
         #: HTTP URL to send the request to.
         self.url = None
-        #: dictionary of HTTP headers.
-        self.headers = None
         #: HTTP path
-        self.path = None        
-        # The cookies set used to create Cookie header
-        self.cookies = None
-        #: request body to send to the server.
-        self.body = None
+        self.path = None
+        self.version = None
         #: Routes
         self.routes = {}
         #: Hook point for routed mapped-path
         self.hook = None
+        # Raw message the lazy attributes are parsed from
+        self._header_string = ""
+        self._body_byte = b""
+        self._headers = None
+        self._cookies = None
+        self._body = None
+        self._accept_encoding = None
+
+    @property
+    def headers(self):
+        """dictionary of HTTP headers."""
+        if self._headers is None:
+            with tracing.span('parse'):
+                self._headers = self.prepare_headers(self._header_string)
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+
+    @property
+    def cookies(self):
+        """The cookies set used to create Cookie header"""
+        if self._cookies is None:
+            self._cookies = self.parse_cookies(self.headers.get('cookie', ''))
+        return self._cookies
+
+    @cookies.setter
+    def cookies(self, value):
+        self._cookies = value
+
+    @property
+    def body(self):
+        """request body to send to the server."""
+        if self._body is None:
+            with tracing.span('parse-body'):
+                self._body = self.parse_body(self._body_byte)
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    @property
+    def accept_encoding(self):
+        """Accepted content codings and their q values"""
+        if self._accept_encoding is None:
+            self._accept_encoding = parse_accept_encoding(self.headers.get('accept-encoding', ''))
+        return self._accept_encoding
 
     def extract_request_line(self, request):
         try:
-            lines = request.splitlines()
-            if not lines:
+            first_line, _, _ = request.partition('\r\n')
+            if not first_line:
                 return None, None, None
-            first_line = lines[0]
             method, path, version = first_line.split()
             if path == '/':
                 path = '/index.html'
         except Exception:
             return None, None, None
         return method, path, version
-             
+
     def prepare_headers(self, request):
         lines = request.split('\r\n')
         headers = CaseInsensitiveDict()
@@ -41,55 +99,51 @@ class Request():
                 headers[key] = val
         return headers
 
-    def prepare(self, header_string, body_byte, routes=None):
-        # Prepare the request line from the request header
-        self.method, self.path, self.version = self.extract_request_line(header_string)
-        if not self.method:
-            self.headers = {}
-            self.body = {}
-            self.cookies = {}
-            return
-        print("[Request] {} path {} version {}".format(self.method, self.path, self.version))
-        self.headers = self.prepare_headers(header_string)
+    def parse_body(self, body_byte):
+        if isinstance(body_byte, BodyStream):
+            # Streaming routes read the body themselves
+            return body_byte
         content_type = self.headers.get('content-type', '').lower()
-
-        def parse_body(body_str):
-            if not body_str:
+        if 'application/x-www-form-urlencoded' in content_type or 'text' in content_type:
+            try:
+                body_str = body_byte.decode('utf-8')
+            except Exception:
                 return {}
-            
             dict_body = {}
             for pair in body_str.split('&'):
                 if '=' in pair:
                     key, val = pair.split('=', 1)
                     dict_body[key] = val
             return dict_body
+        return body_byte
 
-        if 'application/x-www-form-urlencoded' in content_type or 'text' in content_type:
-            try:
-                body_str = body_byte.decode('utf-8')
-                self.body = parse_body(body_str)
-            except Exception:
-                self.body = {}
-        else:
-            self.body = body_byte
-        # Cookies Parsing 
-        def parse_cookies(cookies_str):
-            if not cookies_str:
-                return {}
-            
-            cookies = {}
-            for pair in cookies_str.split(';'):
-                if '=' in pair:
-                    key, val = pair.strip().split('=', 1)
-                    cookies[key] = val
-            return cookies
-        cookies_str = self.headers.get('cookie', '')
-        self.cookies = parse_cookies(cookies_str)
+    def parse_cookies(self, cookies_str):
+        if not cookies_str:
+            return {}
+
+        cookies = {}
+        for pair in cookies_str.split(';'):
+            if '=' in pair:
+                key, val = pair.strip().split('=', 1)
+                cookies[key] = val
+        return cookies
+
+    def prepare(self, header_string, body_byte, routes=None):
+        # Prepare the request line from the request header
+        self.method, self.path, self.version = self.extract_request_line(header_string)
+        if not self.method:
+            self._headers = {}
+            self._body = {}
+            self._cookies = {}
+            return
+        print("[Request] {} path {} version {}".format(self.method, self.path, self.version))
+        self._header_string = header_string
+        self._body_byte = body_byte
         # Routing Hook
-        if not routes == {}:
+        if routes:
             self.routes = routes
             self.hook = routes.get((self.method, self.path))
-            
+
     def prepare_body(self, data, files, json=None):
         pass
 
@@ -100,4 +154,4 @@ class Request():
         pass
 
     def prepare_cookies(self, cookies):
-        pass
\ No newline at end of file
+        pass
@@ -1,22 +1,122 @@
-import datetime
 import os
+import time
 import mimetypes
 import json
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from . import tracing
+from .compression import ASSET_CACHE, MIN_COMPRESS_SIZE, choose_encoding, compress, is_compressible
+from .fingerprint import FINGERPRINTS, IMMUTABLE_CACHE_CONTROL, PAGE_CACHE_CONTROL
 
 BASE_DIR = ""
 
+STATUS_REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+JSON_CACHE_SIZE = 256
+
+DEFAULT_CACHE_CONTROL = 'max-age=86000'
+
+# (second, formatted Date value), swapped as a whole so readers need no lock
+_date_cache = (0, b"")
+# (status, content type, cache control) -> encoded status line and constant headers
+_header_blocks = {}
+# small scalar-only JSON results -> encoded body
+_json_cache = OrderedDict()
+_json_cache_lock = threading.Lock()
+
+def http_date():
+    global _date_cache
+    now = int(time.time())
+    second, value = _date_cache
+    if second != now:
+        value = formatdate(now, usegmt=True).encode('ascii')
+        _date_cache = (now, value)
+    return value
+
+def header_block(status_code, content_type=None, cache_control=DEFAULT_CACHE_CONTROL):
+    key = (status_code, content_type, cache_control)
+    block = _header_blocks.get(key)
+    if block is None:
+        lines = ["HTTP/1.1 {} {}".format(status_code, STATUS_REASONS.get(status_code, ""))]
+        if content_type:
+            lines.append("Content-Type: {}".format(content_type))
+        lines.append("Accept-Ranges: bytes")
+        lines.append("Cache-Control: {}".format(cache_control))
+        lines.append("Connection: close")
+        block = ("\r\n".join(lines) + "\r\n").encode('utf-8')
+        _header_blocks[key] = block
+    return block
+
+def encode_json(data):
+    """
+    Serialize ``data``, reusing the bytes of earlier identical results
+    when ``data`` is a small dict of scalars such as ``{"status": "ok"}``.
+    """
+    key = None
+    if isinstance(data, dict) and len(data) <= 8:
+        if all(isinstance(v, (str, int, float, bool, type(None))) for v in data.values()):
+            # True, 1 and 1.0 are equal dict keys but encode differently
+            key = tuple((type(k), k, type(v), v) for k, v in data.items())
+    if key is None:
+        return json.dumps(data).encode('utf-8')
+    with _json_cache_lock:
+        body = _json_cache.get(key)
+    if body is None:
+        body = json.dumps(data).encode('utf-8')
+        with _json_cache_lock:
+            _json_cache[key] = body
+            if len(_json_cache) > JSON_CACHE_SIZE:
+                _json_cache.popitem(last=False)
+    return body
+
+def build_static_response(status_code, text):
+    body = text.encode('utf-8')
+    return b"".join((
+        header_block(status_code, 'text/html'),
+        b"Content-Length: ", str(len(body)).encode('ascii'), b"\r\n\r\n",
+        body
+    ))
+
+UNAUTHORIZED_RESPONSE = build_static_response(401, "401 Unauthorized")
+FORBIDDEN_RESPONSE = build_static_response(403, "403 Forbidden")
+NOT_FOUND_RESPONSE = build_static_response(404, "404 Not Found")
+INTERNAL_ERROR_RESPONSE = build_static_response(500, "500 Internal Server Error")
+BAD_GATEWAY_RESPONSE = build_static_response(502, "502 Bad Gateway")
+GATEWAY_TIMEOUT_RESPONSE = build_static_response(504, "504 Gateway Timeout")
+
 class Response():   
     __attrs__ = [ 
        '_content', '_header', 'status_code', 'method', 'headers', 'url', 
        'history', 'encoding', 'reason', 'cookies', 'elapsed', 'request', 'body', 'reason'
     ]
+    __slots__ = ('_content', '_header', 'status_code', 'headers', 'reason', 'request', 'cache_control')
 
     def __init__(self):
+        self.headers = {}
+        self.reset()
+
+    def reset(self):
         self._content = False
+        self._header = None
         self.status_code = None
-        self.headers = {}
+        self.headers.clear()
         self.reason = None
         self.request = None
+        self.cache_control = DEFAULT_CACHE_CONTROL
         
         # Variables not use yet
         # self._content_consumed = False
@@ -46,6 +146,8 @@ class Response():
                 base_dir = BASE_DIR+"static/css/"
             elif sub_type == 'plain':
                 base_dir = BASE_DIR+"static/css/"
+            elif sub_type == 'javascript':
+                base_dir = BASE_DIR+"static/js/"
             else:
                 raise ValueError("Unsupported text subtype: {}".format(sub_type))
         elif main_type == 'image':
@@ -69,7 +171,7 @@ class Response():
     def build_content(self, path, base_dir):
         filepath = os.path.join(base_dir, path.lstrip('/'))
         try:
-            with open(filepath, 'rb') as f:
+            with tracing.span('file'), open(filepath, 'rb') as f:
                 content = f.read()
             return content
         except FileNotFoundError:
@@ -84,28 +186,19 @@ class Response():
     def build_response_header(self):
         if self.status_code is None:
             self.status_code = 200
-            self.reason = "OK"
-        elif self.status_code == 401:
-            self.reason = "Unauthorized"
-        elif self.status_code == 404:
-            self.reason = "Not Found"
-        elif self.status_code == 500:
-            self.reason = "Internal Server Error"
-        
-        status_line = "HTTP/1.1 {} {}\r\n".format(self.status_code or 200, self.reason)
-        
-        self.headers['Date'] = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
-        self.headers['Accept-Ranges'] = 'bytes'
-        self.headers['Content-Length'] = str(len(self._content))
-        self.headers['Cache-Control'] = 'max-age=86000'
-        self.headers['Connection'] = 'close'
-        
-        header_text = ""
+        self.reason = STATUS_REASONS.get(self.status_code, "")
+
+        parts = [
+            header_block(self.status_code, self.headers.get('Content-Type'), self.cache_control),
+            b"Date: ", http_date(), b"\r\n",
+        ]
+        if self.status_code != 304:
+            parts.extend((b"Content-Length: ", str(len(self._content)).encode('ascii'), b"\r\n"))
         for header, value in self.headers.items():
-            header_text += "{}: {}\r\n".format(header, value)
-            
-        header_text = status_line + header_text + "\r\n"
-        return header_text.encode('utf-8')
+            if header != 'Content-Type':
+                parts.append("{}: {}\r\n".format(header, value).encode('utf-8'))
+        parts.append(b"\r\n")
+        return b"".join(parts)
         
     def build_response(self, request):
         path = request.path
@@ -114,59 +207,134 @@ class Response():
             base_dir = self.prepare_content_type(mime_type)
         except:
             print("[Response] Unsupported MIME type: {}".format(mime_type))
-            return self.build_notfound()
-        path = os.path.basename(path)
+            return self.build_not_found()
+        path, immutable = FINGERPRINTS.resolve(os.path.basename(path))
+        page = mime_type == 'text/html' and bool(FINGERPRINTS.names)
+        if immutable:
+            self.cache_control = IMMUTABLE_CACHE_CONTROL
+        elif page:
+            self.cache_control = PAGE_CACHE_CONTROL
+        # A page changes whenever an asset it names does
+        if self.check_not_modified(request, os.path.join(base_dir, path), FINGERPRINTS.newest_mtime if page else 0):
+            self._content = b""
+            self.status_code = 304
+            self._header = self.build_response_header()
+            return self._header
         self._content = self.build_content(path, base_dir)
         if self.status_code == 401:
             return self.build_unauthorized()
         elif self.status_code == 404:
-            return self.build_notfound()
+            return self.build_not_found()
         elif self.status_code == 500:
             return self.build_internal_error()
+        cache_key = None
+        if page:
+            self._content = FINGERPRINTS.rewrite_html(self._content)
+            cache_key = os.path.join(base_dir, path) + '#fingerprinted'
+        encoding = self.negotiate_encoding(request, mime_type)
+        if encoding:
+            with tracing.span('compress'):
+                variant = ASSET_CACHE.get(os.path.join(base_dir, path), encoding, self._content, cache_key)
+            if variant is not None:
+                self._content = variant
+                self.headers['Content-Encoding'] = encoding
         self._header = self.build_response_header()
-        return self._header + self._content
+        return b"".join((self._header, self._content))
+
+    def check_not_modified(self, request, filepath, newer_than=0):
+        """
+        Set Last-Modified for ``filepath`` and report whether the client's
+        If-Modified-Since copy is still current.
+
+        :param newer_than (float): other modification time the content depends on.
+        """
+        try:
+            mtime = int(max(os.stat(filepath).st_mtime, newer_than))
+        except OSError:
+            return False
+        self.headers['Last-Modified'] = formatdate(mtime, usegmt=True)
+        since = request.headers.get('if-modified-since') if request.headers else None
+        if not since:
+            return False
+        try:
+            return mtime <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return False
+
+    def add_vary(self, header):
+        current = self.headers.get('Vary')
+        if not current:
+            self.headers['Vary'] = header
+        elif header.lower() not in [h.strip().lower() for h in current.split(',')]:
+            self.headers['Vary'] = "{}, {}".format(current, header)
+
+    def negotiate_encoding(self, request, mime_type):
+        if not is_compressible(mime_type):
+            return None
+        self.add_vary('Accept-Encoding')
+        if request is None:
+            return None
+        return choose_encoding(request.accept_encoding)
     
     def build_json_response(self, data):
         # Convert dictionary to JSON string and encode to bytes
-        self._content = json.dumps(data).encode('utf-8')
+        self._content = encode_json(data)
+        self.headers['Content-Type'] = 'application/json'
+        # Handler results are dynamic and must not be kept by shared caches
+        self.cache_control = 'no-store'
+        encoding = self.negotiate_encoding(self.request, 'application/json')
+        if encoding and len(self._content) >= MIN_COMPRESS_SIZE:
+            self._content = compress(self._content, encoding)
+            self.headers['Content-Encoding'] = encoding
         self._header = self.build_response_header()
         if self.status_code == 401:
             return self.build_unauthorized()
         elif self.status_code == 404:
-            return self.build_notfound()
+            return self.build_not_found()
         elif self.status_code == 500:
             return self.build_internal_error()
-        return self._header + self._content
+        return b"".join((self._header, self._content))
+
+    def build_body_response(self, status_code, content_type, body):
+        """
+        Uncached response with a ready-made ``body``, used by admin endpoints.
+        """
+        return b"".join((
+            header_block(status_code, content_type, 'no-store'),
+            b"Date: ", http_date(), b"\r\n",
+            b"Content-Length: ", str(len(body)).encode('ascii'), b"\r\n\r\n",
+            body
+        ))
 
     def build_unauthorized(self):
-        return (
-                "HTTP/1.1 401 Unauthorized\r\n"
-                "Accept-Ranges: bytes\r\n"
-                "Content-Type: text/html\r\n"
-                "Content-Length: 16\r\n"
-                "Cache-Control: max-age=86000\r\n"
-                "Connection: close\r\n\r\n"
-                "401 Unauthorized"
-            ).encode('utf-8')
+        return UNAUTHORIZED_RESPONSE
+
+    def build_forbidden(self):
+        return FORBIDDEN_RESPONSE
 
     def build_not_found(self):
-        return (
-                "HTTP/1.1 404 Not Found\r\n"
-                "Accept-Ranges: bytes\r\n"
-                "Content-Type: text/html\r\n"
-                "Content-Length: 13\r\n"
-                "Cache-Control: max-age=86000\r\n"
-                "Connection: close\r\n\r\n"
-                "404 Not Found"
-            ).encode('utf-8')
+        return NOT_FOUND_RESPONSE
 
     def build_internal_error(self):
-        return (
-                "HTTP/1.1 500 Internal Server Error\r\n"
-                "Accept-Ranges: bytes\r\n"
-                "Content-Type: text/html\r\n"
-                "Content-Length: 25\r\n"
-                "Cache-Control: max-age=86000\r\n"
-                "Connection: close\r\n\r\n"
-                "500 Internal Server Error"
-            ).encode('utf-8')
\ No newline at end of file
+        return INTERNAL_ERROR_RESPONSE
+
+    def build_bad_gateway(self):
+        return BAD_GATEWAY_RESPONSE
+
+    def build_gateway_timeout(self):
+        return GATEWAY_TIMEOUT_RESPONSE
+
+    def build_retry_later(self, status_code, retry_after):
+        body = "{} {}".format(status_code, STATUS_REASONS[status_code]).encode('utf-8')
+        return b"".join((
+            header_block(status_code, 'text/html', 'no-store'),
+            b"Retry-After: ", str(retry_after).encode('ascii'), b"\r\n",
+            b"Content-Length: ", str(len(body)).encode('ascii'), b"\r\n\r\n",
+            body
+        ))
+
+    def build_service_unavailable(self, retry_after=1):
+        return self.build_retry_later(503, retry_after)
+
+    def build_too_many_requests(self, retry_after=1):
+        return self.build_retry_later(429, retry_after)
@@ -0,0 +1,174 @@
+import os
+import re
+import time
+import signal
+import threading
+from .ratelimit import parse_key_mode
+
+def parse_virtual_hosts(config_file):
+    with open(config_file, 'r') as f:
+        config_text = f.read()
+    host_blocks = re.findall(r'host\s+"([^"]+)"\s*\{(.*?)\}', config_text, re.DOTALL)
+    routes = {}
+    for host, block in host_blocks:
+        proxy_passes = re.findall(r'proxy_pass\s+http://([^\s;]+);', block)
+        policy_match = re.search(r'dist_policy\s+([\w-]+)', block)
+        if policy_match:
+            dist_policy_map = policy_match.group(1)
+        else:
+            dist_policy_map = 'round-robin'
+        # Remaining directives are per-host options, e.g. proxy_cache on;
+        options = {}
+        for name, value in re.findall(r'(\w+)\s+([^;]+);', block):
+            if name not in ('proxy_pass', 'dist_policy'):
+                options[name] = value.strip()
+        if 'limit_req_key' in options:
+            # A typo would otherwise silently change who shares a bucket
+            parse_key_mode(options['limit_req_key'])
+        routes[host] = (proxy_passes, dist_policy_map, options)
+    for key, value in routes.items():
+        print({key: value})
+    return routes
+
+def split_host(host):
+    """
+    Lower-case ``host`` and split off the port, e.g. ``App.Local:80``
+    -> (``app.local``, ``80``). Bracketed IPv6 literals are kept whole.
+    """
+    host = host.strip().lower()
+    if host.startswith('['):
+        name, _, rest = host.partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+        return name + ']', port
+    name, _, port = host.partition(':')
+    return name.rstrip('.'), port
+
+class HostIndex:
+    """
+    Compiled virtual-host lookup.
+
+    ``name:port`` and ``name`` patterns are exact matches, ``*.suffix``
+    matches any subdomain, ``.suffix`` matches the suffix and any
+    subdomain, and ``*`` is the fallback.
+    """
+    def __init__(self, hostnames):
+        self.exact = {}
+        self.wildcard = {}
+        self.default = None
+        for key in hostnames:
+            pattern = key.strip().lower()
+            if pattern in ('*', '_'):
+                self.default = key
+            elif pattern.startswith('*.'):
+                self.wildcard[pattern[2:].rstrip('.')] = key
+            elif pattern.startswith('.'):
+                self.wildcard[pattern[1:].rstrip('.')] = key
+                self.exact.setdefault(pattern[1:].rstrip('.'), key)
+            else:
+                name, port = split_host(pattern)
+                self.exact[name + ':' + port if port else name] = key
+
+    def match(self, host_header):
+        if not host_header:
+            return self.default
+        name, port = split_host(host_header)
+        if port:
+            key = self.exact.get(name + ':' + port)
+            if key is not None:
+                return key
+        key = self.exact.get(name)
+        if key is not None:
+            return key
+        labels = name.split('.')
+        for i in range(1, len(labels)):
+            key = self.wildcard.get('.'.join(labels[i:]))
+            if key is not None:
+                return key
+        return self.default
+
+class RoutingSnapshot:
+    """
+    Immutable view of the proxy configuration. Readers grab
+    ``RoutingTable.current`` once per request, so a reload never changes
+    routing in the middle of a request.
+    """
+    __slots__ = ('routes', 'index', 'version')
+
+    def __init__(self, routes, version=0):
+        self.routes = dict(routes)
+        self.index = HostIndex(self.routes.keys())
+        self.version = version
+
+    def match(self, host_header):
+        """
+        :return: (configured host key, route tuple) or (None, None).
+        """
+        key = self.index.match(host_header)
+        if key is None:
+            return None, None
+        return key, self.routes[key]
+
+class RoutingTable:
+    """
+    Holds the current :class:`RoutingSnapshot` and swaps it on SIGHUP or
+    when ``config_file`` changes on disk.
+
+    :param routes (dict): initial routes.
+    :param config_file (str, optional): file to reload from.
+    :param on_reload (callable, optional): called as ``on_reload(old, new)``
+        once ``new`` is current.
+    """
+    def __init__(self, routes, config_file=None, on_reload=None):
+        self.config_file = config_file
+        self.on_reload = on_reload
+        self.current = RoutingSnapshot(routes)
+        self.reload_lock = threading.Lock()
+        self.mtime = self.stat_config()
+
+    def stat_config(self):
+        if not self.config_file:
+            return None
+        try:
+            return os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self):
+        if not self.config_file:
+            return False
+        with self.reload_lock:
+            try:
+                routes = parse_virtual_hosts(self.config_file)
+            except (OSError, ValueError) as e:
+                print("[Proxy] Reload failed, keeping current config: {}".format(e))
+                return False
+            old = self.current
+            new = RoutingSnapshot(routes, old.version + 1)
+            # Single reference assignment; readers never see a partial table
+            self.current = new
+            # Drop state built for the old config only now: dropped before
+            # the swap, requests arriving in between would rebuild it from
+            # the old config and it would outlive the reload
+            if self.on_reload:
+                self.on_reload(old, new)
+            print("[Proxy] Loaded config version {}".format(new.version))
+            return True
+
+    def watch(self, interval=2.0):
+        def run():
+            while True:
+                time.sleep(interval)
+                mtime = self.stat_config()
+                if mtime is not None and mtime != self.mtime:
+                    self.mtime = mtime
+                    self.reload()
+        threading.Thread(target=run, daemon=True).start()
+
+    def install_signal_handler(self):
+        if not hasattr(signal, 'SIGHUP'):
+            return
+        try:
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self.reload, daemon=True).start())
+        except ValueError:
+            # signal handlers can only be installed from the main thread
+            pass
@@ -0,0 +1,329 @@
+import os
+import mmap
+import json
+import time
+import struct
+import bisect
+import zlib
+import threading
+from urllib.parse import quote, unquote
+
+# length, crc32, offset, timestamp
+RECORD_HEADER = struct.Struct('<IIQd')
+# offset, file position
+INDEX_ENTRY = struct.Struct('<QQ')
+
+FSYNC_POLICIES = ('always', 'batch', 'never')
+
+class Segment:
+    """
+    One ``<base_offset>.log`` file with its sparse ``.index`` companion.
+    """
+    def __init__(self, directory, base_offset):
+        self.base_offset = base_offset
+        self.log_path = os.path.join(directory, "{:020d}.log".format(base_offset))
+        self.index_path = os.path.join(directory, "{:020d}.index".format(base_offset))
+        self.index = []
+        self.size = 0
+        self.next_offset = base_offset
+        self.last_timestamp = 0.0
+        self.file = None
+        self.index_file = None
+        self._map = None
+        self._map_size = 0
+
+    def open(self, writable):
+        if writable:
+            self.file = open(self.log_path, 'ab')
+            self.index_file = open(self.index_path, 'ab')
+
+    def recover(self):
+        """
+        Scan the log, rebuild the sparse index from the entries that are
+        present and truncate a torn tail left by a crash.
+        """
+        self.index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            self.index = [INDEX_ENTRY.unpack_from(data, pos) for pos in range(0, usable, INDEX_ENTRY.size)]
+
+        file_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        position = self.index[-1][1] if self.index and self.index[-1][1] <= file_size else 0
+        if position == 0:
+            self.index = []
+        offset = self.base_offset
+        with open(self.log_path, 'a+b') as f:
+            f.seek(0)
+            data = f.read()
+            if self.index:
+                offset = self.index[-1][0]
+            while position + RECORD_HEADER.size <= len(data):
+                length, crc, rec_offset, timestamp = RECORD_HEADER.unpack_from(data, position)
+                end = position + RECORD_HEADER.size + length
+                if end > len(data) or zlib.crc32(data[position + RECORD_HEADER.size:end]) != crc:
+                    break
+                offset = rec_offset + 1
+                self.last_timestamp = timestamp
+                position = end
+            if position != len(data):
+                print("[Store] Truncating torn tail of {} at {}".format(self.log_path, position))
+                f.truncate(position)
+        self.size = position
+        self.next_offset = offset
+        self.index = [entry for entry in self.index if entry[1] < self.size]
+        with open(self.index_path, 'wb') as f:
+            for entry in self.index:
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    def append(self, offset, timestamp, payload, index_interval):
+        position = self.size
+        self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), offset, timestamp))
+        self.file.write(payload)
+        if not self.index or offset - self.index[-1][0] >= index_interval:
+            self.index.append((offset, position))
+            self.index_file.write(INDEX_ENTRY.pack(offset, position))
+        self.size += RECORD_HEADER.size + len(payload)
+        self.next_offset = offset + 1
+        self.last_timestamp = timestamp
+
+    def flush(self, fsync=False):
+        if self.file:
+            self.file.flush()
+            self.index_file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+                os.fsync(self.index_file.fileno())
+
+    def seal(self, fsync):
+        self.flush(fsync)
+        self.file.close()
+        self.index_file.close()
+        self.file = None
+        self.index_file = None
+
+    def view(self):
+        # Re-map only when the segment has grown since the last read
+        if self.size == 0:
+            return None
+        if self._map is None or self._map_size != self.size:
+            if self._map is not None:
+                self._map.close()
+            with open(self.log_path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._map_size = self.size
+        return self._map
+
+    def scan(self, start_offset, limit):
+        view = self.view()
+        if view is None:
+            return []
+        i = bisect.bisect_right(self.index, (start_offset, float('inf'))) - 1
+        position = self.index[i][1] if i >= 0 else 0
+        records = []
+        while position + RECORD_HEADER.size <= self._map_size and len(records) < limit:
+            length, _, offset, timestamp = RECORD_HEADER.unpack_from(view, position)
+            body_start = position + RECORD_HEADER.size
+            position = body_start + length
+            if offset < start_offset:
+                continue
+            records.append((offset, timestamp, view[body_start:position]))
+        return records
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self.file:
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+            self.index_file = None
+
+    def delete(self):
+        self.close()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class ChannelLog:
+    def __init__(self, directory, store):
+        self.directory = directory
+        self.store = store
+        self.lock = threading.Lock()
+        self.segments = []
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        for base in bases:
+            segment = Segment(directory, base)
+            segment.recover()
+            self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+        self.segments[-1].open(writable=True)
+        self.apply_retention()
+
+    @property
+    def next_offset(self):
+        return self.segments[-1].next_offset
+
+    def append(self, timestamp, payload):
+        with self.lock:
+            active = self.segments[-1]
+            if active.size >= self.store.segment_bytes:
+                active.seal(fsync=self.store.fsync_policy != 'never')
+                active = Segment(self.directory, active.next_offset)
+                active.open(writable=True)
+                self.segments.append(active)
+                self.apply_retention()
+            offset = active.next_offset
+            active.append(offset, timestamp, payload, self.store.index_interval)
+            self.pending += 1
+            self.maybe_sync(active)
+            return offset
+
+    def maybe_sync(self, active):
+        policy = self.store.fsync_policy
+        if policy == 'always':
+            active.flush(fsync=True)
+        elif policy == 'batch':
+            now = time.monotonic()
+            if self.pending >= self.store.fsync_batch or now - self.last_sync >= self.store.fsync_seconds:
+                active.flush(fsync=True)
+                self.pending = 0
+                self.last_sync = now
+            else:
+                active.flush()
+        else:
+            active.flush()
+
+    def read(self, start_offset=0, limit=100):
+        with self.lock:
+            bases = [segment.base_offset for segment in self.segments]
+            i = max(0, bisect.bisect_right(bases, start_offset) - 1)
+            records = []
+            for segment in self.segments[i:]:
+                records.extend(segment.scan(start_offset, limit - len(records)))
+                if len(records) >= limit:
+                    break
+            return records
+
+    def apply_retention(self):
+        # The active segment is never deleted
+        cutoff = time.time() - self.store.retention_seconds if self.store.retention_seconds else None
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            expired = cutoff is not None and oldest.last_timestamp < cutoff
+            oversized = self.store.retention_bytes and total > self.store.retention_bytes
+            if not (expired or oversized):
+                break
+            total -= oldest.size
+            oldest.delete()
+            self.segments.pop(0)
+            print("[Store] Removed segment {}".format(oldest.log_path))
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.flush(fsync=self.store.fsync_policy != 'never')
+                segment.close()
+
+class MessageStore:
+    """
+    Append-only, segmented message log with one directory per channel.
+
+    :param root (str): directory holding the channel logs.
+    :param segment_bytes (int): roll to a new segment past this size.
+    :param index_interval (int): records between sparse index entries.
+    :param fsync_policy (str): ``always``, ``batch`` or ``never``.
+    :param fsync_batch (int): records per fsync with the ``batch`` policy.
+    :param fsync_seconds (float): max seconds between fsyncs with ``batch``.
+    :param retention_seconds (float): drop sealed segments older than this.
+    :param retention_bytes (int): drop sealed segments past this size per channel.
+    """
+    def __init__(self, root, segment_bytes=16 * 1024 * 1024, index_interval=64,
+                 fsync_policy='batch', fsync_batch=100, fsync_seconds=1.0,
+                 retention_seconds=None, retention_bytes=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError("Unsupported fsync policy: {}".format(fsync_policy))
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync_policy = fsync_policy
+        self.fsync_batch = fsync_batch
+        self.fsync_seconds = fsync_seconds
+        self.retention_seconds = retention_seconds
+        self.retention_bytes = retention_bytes
+        self.logs = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        for name in os.listdir(root):
+            if os.path.isdir(os.path.join(root, name)):
+                self.get_log(self.channel_name(name))
+
+    @staticmethod
+    def channel_dir(channel):
+        """
+        :raises ValueError: for a name whose quoted form would not be a
+            directory of its own under the root.
+        """
+        # quote() leaves these as they are, and they name the root or its parent
+        if not isinstance(channel, str) or channel in ('', '.', '..'):
+            raise ValueError("Invalid channel name: {!r}".format(channel))
+        return quote(channel, safe='')
+
+    @staticmethod
+    def channel_name(directory):
+        return unquote(directory)
+
+    def get_log(self, channel):
+        with self.lock:
+            log = self.logs.get(channel)
+            if log is None:
+                log = ChannelLog(os.path.join(self.root, self.channel_dir(channel)), self)
+                self.logs[channel] = log
+            return log
+
+    def channels(self):
+        with self.lock:
+            return list(self.logs.keys())
+
+    def append(self, channel, message):
+        """
+        :param channel (str): channel the message belongs to.
+        :param message (dict): JSON-serializable message packet.
+        :return: offset of the record inside the channel log.
+        :raises ValueError: for an invalid channel name.
+        """
+        payload = json.dumps(message).encode('utf-8')
+        return self.get_log(channel).append(message.get('timestamp', time.time()), payload)
+
+    def read(self, channel, start_offset=0, limit=100):
+        """
+        :return: list of ``(offset, message dict)`` ordered by offset.
+        """
+        records = self.get_log(channel).read(start_offset, limit)
+        return [(offset, json.loads(payload)) for offset, _, payload in records]
+
+    def tail(self, channel, limit=100):
+        log = self.get_log(channel)
+        start = max(0, log.next_offset - limit)
+        return self.read(channel, start, limit)
+
+    def compact(self):
+        for channel in self.channels():
+            log = self.get_log(channel)
+            with log.lock:
+                log.apply_retention()
+
+    def close(self):
+        with self.lock:
+            logs = list(self.logs.values())
+        for log in logs:
+            log.close()
@@ -0,0 +1,166 @@
+import math
+import time
+import socket
+import threading
+
+class Timeouts:
+    """
+    Read deadlines in seconds; ``None`` disables a phase.
+
+    :param idle (float): wait for the first byte of a message.
+    :param header (float): total time to read the header block.
+    :param body (float): total time to read the body.
+    :param connect (float): upstream connect timeout.
+    :param scope (str): label used in reap metrics.
+    """
+    def __init__(self, idle=15.0, header=10.0, body=30.0, connect=5.0, scope='client'):
+        self.idle = idle
+        self.header = header
+        self.body = body
+        self.connect = connect
+        self.scope = scope
+
+    @classmethod
+    def upstream(cls, connect=5.0, read=30.0):
+        return cls(idle=read, header=read, body=read, connect=connect, scope='upstream')
+
+class ReapMetrics:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+class Timer:
+    __slots__ = ('callback', 'rounds', 'slot')
+
+    def __init__(self, callback, rounds):
+        self.callback = callback
+        self.rounds = rounds
+        self.slot = None
+
+class TimerWheel:
+    """
+    Hashed timer wheel driven by one thread, so thousands of connection
+    deadlines cost one set insert each instead of a thread or a
+    per-socket poll.
+
+    :param tick (float): resolution in seconds.
+    :param slots (int): slots per revolution.
+    """
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, delay, callback):
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        timer = Timer(callback, (ticks - 1) // len(self.slots))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            timer.slot = (self.position + ticks) % len(self.slots)
+            self.slots[timer.slot].add(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                self.slots[timer.slot].discard(timer)
+                timer.slot = None
+
+    def run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.tick
+            expired = []
+            with self.lock:
+                self.position = (self.position + 1) % len(self.slots)
+                bucket = self.slots[self.position]
+                for timer in list(bucket):
+                    if timer.rounds > 0:
+                        timer.rounds -= 1
+                    else:
+                        bucket.discard(timer)
+                        timer.slot = None
+                        expired.append(timer)
+            for timer in expired:
+                try:
+                    timer.callback()
+                except Exception as e:
+                    print("[Timeout] Timer callback failed: {}".format(e))
+
+WHEEL = TimerWheel()
+METRICS = ReapMetrics()
+
+class Deadline:
+    """
+    Shuts ``conn`` down when the current read phase overruns, which
+    wakes the thread blocked in ``recv``. The wheel runs callbacks after
+    releasing its lock, so a timer can fire after it was cancelled;
+    ``generation`` tells such a stale timer apart from the armed one.
+    """
+    __slots__ = ('conn', 'scope', 'phase', 'timer', 'expired', 'generation', 'lock')
+
+    def __init__(self, conn, scope='client'):
+        self.conn = conn
+        self.scope = scope
+        self.phase = None
+        self.timer = None
+        self.expired = False
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def arm(self, phase, seconds):
+        self.cancel()
+        self.phase = phase
+        if seconds:
+            generation = self.generation
+            self.timer = WHEEL.schedule(seconds, lambda: self.fire(generation))
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            WHEEL.cancel(timer)
+
+    def fire(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.timer = None
+            self.expired = True
+            METRICS.record("{}-{}".format(self.scope, self.phase))
+            # Under the lock, so cancel() returns only once the socket is
+            # no longer at risk of a late shutdown
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def start_reporter(name, interval=60.0):
+    """
+    Print reaped connection counts every ``interval`` seconds when they change.
+    """
+    def run():
+        last = {}
+        while True:
+            time.sleep(interval)
+            counts = METRICS.snapshot()
+            if counts != last:
+                print("[{}] Reaped connections: {}".format(name, counts))
+                last = counts
+    threading.Thread(target=run, daemon=True).start()
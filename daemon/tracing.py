@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+from queue import Queue, Full
+
+LOCAL = threading.local()
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+def new_request_id():
+    return os.urandom(8).hex()
+
+def find_request_id(header_string):
+    """
+    Return the X-Request-ID value of a raw header block, or None.
+    """
+    start = header_string.lower().find('\r\nx-request-id:')
+    if start < 0:
+        return None
+    start += len('\r\nx-request-id:')
+    end = header_string.find('\r\n', start)
+    value = header_string[start:end if end >= 0 else None].strip()
+    return value or None
+
+def add_request_header(header_string, name, value):
+    request_line, sep, rest = header_string.partition('\r\n')
+    return "{}\r\n{}: {}{}{}".format(request_line, name, value, sep, rest)
+
+# Per-request response headers that must not be replayed to another client
+PER_REQUEST_HEADERS = (b"x-request-id:", b"server-timing:")
+
+def strip_response_headers(response):
+    """
+    Remove X-Request-ID and Server-Timing from a raw response before it is
+    cached or handed to a different request.
+    """
+    head_end = response.find(b"\r\n\r\n")
+    if head_end < 0:
+        return response
+    lines = response[:head_end].split(b"\r\n")
+    kept = [line for line in lines[1:] if not line.lower().startswith(PER_REQUEST_HEADERS)]
+    if len(kept) == len(lines) - 1:
+        return response
+    return b"\r\n".join([lines[0]] + kept) + response[head_end:]
+
+class Span:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.spans.append((self.name, self.start, time.perf_counter() - self.start))
+        return False
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Trace:
+    """
+    Timing spans for one request in one process. Spans are plain tuples
+    appended to a list; nothing is formatted until the request finishes.
+
+    :param service (str): process role, prefixes Server-Timing metrics.
+    :param request_id (str): propagated X-Request-ID.
+    """
+    __slots__ = ('service', 'request_id', 'name', 'origin', 'epoch', 'tid', 'spans')
+
+    def __init__(self, service, request_id, name=''):
+        self.service = service
+        self.request_id = request_id
+        self.name = name
+        self.origin = time.perf_counter()
+        self.epoch = time.time()
+        self.tid = threading.get_ident()
+        self.spans = []
+
+    def span(self, name):
+        return Span(self, name)
+
+    def elapsed(self):
+        return time.perf_counter() - self.origin
+
+    def server_timing(self):
+        metrics = ["{}-{};dur={:.2f}".format(self.service, name, duration * 1000)
+                   for name, _, duration in self.spans]
+        metrics.append("{}-total;dur={:.2f}".format(self.service, self.elapsed() * 1000))
+        return ", ".join(metrics)
+
+    def add_response_headers(self, response):
+        """
+        Insert Server-Timing, and X-Request-ID when missing, after the
+        status line of a raw response.
+        """
+        head_end = response.find(b"\r\n\r\n")
+        line_end = response.find(b"\r\n")
+        if head_end < 0 or line_end < 0:
+            return response
+        lines = ["Server-Timing: {}".format(self.server_timing())]
+        if b"\r\nx-request-id:" not in response[line_end:head_end + 2].lower():
+            lines.insert(0, "{}: {}".format(REQUEST_ID_HEADER, self.request_id))
+        extra = ("\r\n" + "\r\n".join(lines)).encode('latin-1')
+        return b"".join((response[:line_end], extra, response[line_end:]))
+
+    def events(self, pid):
+        """
+        Complete ("X") events in the Chrome trace event format, loadable
+        in chrome://tracing or Perfetto.
+        """
+        base = self.epoch * 1e6
+        args = {"request_id": self.request_id}
+        events = [{
+            "name": self.name or self.service, "cat": self.service, "ph": "X",
+            "ts": round(base, 3), "dur": round(self.elapsed() * 1e6, 3),
+            "pid": pid, "tid": self.tid, "args": args,
+        }]
+        for name, start, duration in self.spans:
+            events.append({
+                "name": name, "cat": self.service, "ph": "X",
+                "ts": round(base + (start - self.origin) * 1e6, 3), "dur": round(duration * 1e6, 3),
+                "pid": pid, "tid": self.tid, "args": args,
+            })
+        return events
+
+class TraceExporter:
+    """
+    Appends finished traces to ``path`` from a background thread. The
+    file is a JSON array whose closing bracket is optional in the trace
+    event format, so it stays valid while the process runs.
+
+    :param max_pending (int): traces buffered before new ones are dropped.
+    """
+    def __init__(self, max_pending=10000):
+        self.path = None
+        self.queue = Queue(max_pending)
+        self.thread = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def configure(self, path, service):
+        with self.lock:
+            self.path = path
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=(path, service), daemon=True)
+                self.thread.start()
+
+    def submit(self, trace):
+        if self.path is None:
+            return
+        try:
+            self.queue.put_nowait(trace)
+        except Full:
+            self.dropped += 1
+
+    def run(self, path, service):
+        pid = os.getpid()
+        fresh = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, 'a') as f:
+            if fresh:
+                f.write("[\n")
+            meta = {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "{} {}".format(service, pid)}}
+            f.write(json.dumps(meta) + ",\n")
+            while True:
+                batch = [self.queue.get()]
+                while not self.queue.empty() and len(batch) < 256:
+                    batch.append(self.queue.get_nowait())
+                for trace in batch:
+                    for event in trace.events(pid):
+                        f.write(json.dumps(event) + ",\n")
+                f.flush()
+
+EXPORTER = TraceExporter()
+
+def begin(service, request_id=None, name=''):
+    trace = Trace(service, request_id or new_request_id(), name)
+    LOCAL.trace = trace
+    return trace
+
+def resume(trace):
+    """
+    Continue ``trace`` on the calling thread, for a request handed over
+    from the thread that read it.
+    """
+    LOCAL.trace = trace
+
+def current():
+    return getattr(LOCAL, 'trace', None)
+
+def finish(trace):
+    LOCAL.trace = None
+    EXPORTER.submit(trace)
+
+def span(name):
+    """
+    Time a block against the current thread's trace; a no-op when the
+    thread is not serving a traced request.
+    """
+    trace = getattr(LOCAL, 'trace', None)
+    if trace is None:
+        return NULL_SPAN
+    return Span(trace, name)
+
+def configure(path, service):
+    EXPORTER.configure(path, service)
@@ -0,0 +1,278 @@
+import os
+import json
+import socket
+import hashlib
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+# Largest chunk accepted from a remote manifest; each one is held in memory
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+def build_manifest(path, chunk_size=CHUNK_SIZE):
+    """
+    Hash ``path`` in fixed-size chunks. The file id is the hash of the
+    chunk hashes, so identical content gets the same id anywhere.
+    """
+    chunks = []
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            size += len(data)
+            chunks.append(hashlib.sha256(data).hexdigest())
+    file_id = hashlib.sha256("".join(chunks).encode('ascii')).hexdigest()
+    return {
+        "file_id": file_id,
+        "name": os.path.basename(path),
+        "size": size,
+        "chunk_size": chunk_size,
+        "chunks": chunks,
+    }
+
+def chunk_length(manifest, index):
+    start = index * manifest["chunk_size"]
+    return max(0, min(manifest["chunk_size"], manifest["size"] - start))
+
+def safe_name(name):
+    """
+    :return: ``name`` if it is a plain file name that stays inside the
+        download directory, else None.
+    """
+    if not isinstance(name, str) or name != os.path.basename(name):
+        return None
+    if name in ('', '.', '..') or '\0' in name:
+        return None
+    return name
+
+def verify_manifest(manifest):
+    try:
+        chunks = manifest["chunks"]
+        chunk_size = manifest["chunk_size"]
+        if not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            return False
+        if not isinstance(manifest["size"], int) or manifest["size"] < 0:
+            return False
+        expected = -(-manifest["size"] // manifest["chunk_size"]) if manifest["size"] else 0
+        # The name comes from a remote peer and becomes a local path
+        return (safe_name(manifest["name"]) is not None and len(chunks) == expected and
+                hashlib.sha256("".join(chunks).encode('ascii')).hexdigest() == manifest["file_id"])
+    except (KeyError, TypeError, ZeroDivisionError):
+        return False
+
+class FileShare:
+    """
+    Files this peer can serve, by file id.
+    """
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def add(self, path, manifest):
+        with self.lock:
+            self.files[manifest["file_id"]] = (os.path.abspath(path), manifest)
+
+    def get(self, file_id):
+        with self.lock:
+            return self.files.get(file_id)
+
+    def serve(self, sock, request):
+        """
+        Answer one chunk request on a blocking socket: a JSON header line,
+        then the chunk bytes straight from the page cache via sendfile.
+        """
+        entry = self.get(request.get("file_id"))
+        index = request.get("index")
+        if entry is None or not isinstance(index, int) or not 0 <= index < len(entry[1]["chunks"]):
+            sock.sendall(b'{"type": "chunk-error"}\n')
+            return
+        path, manifest = entry
+        length = chunk_length(manifest, index)
+        header = {"type": "chunk", "file_id": manifest["file_id"], "index": index, "length": length}
+        sock.sendall((json.dumps(header) + "\n").encode('utf-8'))
+        with open(path, 'rb') as f:
+            sock.sendfile(f, index * manifest["chunk_size"], length)
+
+def fetch_chunk(addr, manifest, index, timeout=10.0):
+    """
+    Download and verify one chunk from the peer listening on ``addr``.
+
+    :raises OSError: on network errors, a refusal or a hash mismatch.
+    """
+    length = chunk_length(manifest, index)
+    if length > MAX_CHUNK_SIZE:
+        raise ValueError("chunk {} is larger than {} bytes".format(index, MAX_CHUNK_SIZE))
+    sock = socket.create_connection(addr, timeout=timeout)
+    try:
+        request = {"type": "chunk-request", "file_id": manifest["file_id"], "index": index}
+        sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        head = bytearray()
+        header = {"type": "hello"}
+        # The listener greets every connection with a hello before it
+        # sees our request; skip it
+        while header.get("type") == "hello":
+            while b"\n" not in head:
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError("closed before chunk header")
+                head += data
+            line, _, rest = bytes(head).partition(b"\n")
+            head = bytearray(rest)
+            header = json.loads(line.decode('utf-8'))
+        if header.get("type") != "chunk" or header.get("length") != length:
+            raise ConnectionError("peer refused chunk {}".format(index))
+        buf = bytearray(length)
+        view = memoryview(buf)
+        received = len(rest[:length])
+        buf[:received] = rest[:length]
+        while received < length:
+            n = sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionError("closed mid-chunk")
+            received += n
+    finally:
+        sock.close()
+    if hashlib.sha256(buf).hexdigest() != manifest["chunks"][index]:
+        raise ValueError("chunk {} failed hash check".format(index))
+    return buf
+
+class Download:
+    """
+    Resumable download into ``<dest>/<name>.part``. Verified chunk
+    indices are appended to a ``.state`` log next to it, one per line
+    after a header line naming the file, so a restart only fetches what
+    is missing.
+
+    :param sources (callable): returns the current list of holder addresses.
+    :param workers (int): chunks fetched in parallel.
+    """
+    def __init__(self, manifest, dest_dir, sources, workers=4, on_done=None):
+        name = safe_name(manifest.get("name"))
+        if name is None:
+            raise ValueError("unsafe file name {!r}".format(manifest.get("name")))
+        self.manifest = manifest
+        self.dest = os.path.join(dest_dir, name)
+        self.part = self.dest + ".part"
+        self.state_path = self.part + ".state"
+        self.sources = sources
+        self.workers = workers
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.done = set()
+        self.state_file = None
+        self.pending = []
+        self.failures = {}
+        self.error = None
+        self.finished = False
+
+    def progress(self):
+        with self.lock:
+            return len(self.done), len(self.manifest["chunks"])
+
+    def load_state(self):
+        self.done = set()
+        try:
+            with open(self.state_path) as f:
+                state = json.loads(f.readline())
+                if state.get("file_id") != self.manifest["file_id"] or not os.path.exists(self.part):
+                    return
+                done = set(state.get("done", []))
+                for line in f:
+                    # A line cut short by a crash was never acknowledged
+                    if line.endswith("\n"):
+                        done.add(int(line))
+        except (OSError, ValueError, TypeError, AttributeError):
+            return
+        self.done = done & set(range(len(self.manifest["chunks"])))
+
+    def open_state(self):
+        """
+        Compact the log to one header line and keep it open for appends.
+        """
+        tmp = self.state_path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({"file_id": self.manifest["file_id"], "done": sorted(self.done)}) + "\n")
+        os.replace(tmp, self.state_path)
+        self.state_file = open(self.state_path, 'a')
+
+    def save_state(self, index):
+        # Caller holds self.lock
+        self.state_file.write("{}\n".format(index))
+        self.state_file.flush()
+
+    def close_state(self):
+        with self.lock:
+            if self.state_file is not None:
+                self.state_file.close()
+                self.state_file = None
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.dest) or ".", exist_ok=True)
+        self.load_state()
+        if not os.path.exists(self.part):
+            with open(self.part, 'wb') as f:
+                f.truncate(self.manifest["size"])
+        self.open_state()
+        self.pending = [i for i in range(len(self.manifest["chunks"])) if i not in self.done]
+        threads = [threading.Thread(target=self.run_worker, args=(n,), daemon=True) for n in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        threading.Thread(target=self.wait, args=(threads,), daemon=True).start()
+
+    def next_chunk(self):
+        with self.lock:
+            return self.pending.pop(0) if self.pending else None
+
+    def run_worker(self, number):
+        fd = os.open(self.part, os.O_WRONLY)
+        try:
+            while True:
+                index = self.next_chunk()
+                if index is None:
+                    return
+                if not self.fetch(fd, index, number):
+                    with self.lock:
+                        self.error = "no peer could serve chunk {}".format(index)
+                    return
+        finally:
+            os.close(fd)
+
+    def fetch(self, fd, index, number):
+        """
+        Try each holder, starting at a worker-specific offset so parallel
+        workers spread over different peers.
+        """
+        sources = list(self.sources())
+        for attempt in range(len(sources)):
+            addr = sources[(index + number + attempt) % len(sources)]
+            try:
+                data = fetch_chunk(addr, self.manifest, index)
+            except (OSError, ValueError) as e:
+                print("[Transfer] Chunk {} from {} failed: {}".format(index, addr, e))
+                continue
+            os.pwrite(fd, data, index * self.manifest["chunk_size"])
+            with self.lock:
+                self.done.add(index)
+                self.save_state(index)
+            return True
+        return False
+
+    def wait(self, threads):
+        for thread in threads:
+            thread.join()
+        self.close_state()
+        with self.lock:
+            complete = len(self.done) == len(self.manifest["chunks"])
+        if complete:
+            os.replace(self.part, self.dest)
+            try:
+                os.remove(self.state_path)
+            except OSError:
+                pass
+            self.finished = True
+            print("[Transfer] {} complete".format(self.dest))
+        else:
+            print("[Transfer] {} incomplete: {}".format(self.dest, self.error))
+        if self.on_done:
+            self.on_done(self)
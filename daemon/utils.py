@@ -1,6 +1,8 @@
 from urllib.parse import urlparse, unquote
 from .dictionary import CaseInsensitiveDict
-import socket
+from .timeouts import Deadline
+from .body import BodyStream
+import threading
 
 def get_auth_from_url(url):
     parsed = urlparse(url)
@@ -10,90 +12,95 @@ def get_auth_from_url(url):
         auth = ("", "")
     return auth
 
-def raw_data_to_msg(conn):
+SCRATCH = threading.local()
+# Largest body buffer allocated before the bytes have arrived
+MAX_PREALLOCATE = 64 * 1024
+
+def scratch_buffer(size=4096):
+    """
+    Per-thread receive buffer reused across connections.
+    """
+    buf = getattr(SCRATCH, 'buf', None)
+    if buf is None:
+        buf = SCRATCH.buf = bytearray(size)
+    return buf
+
+def raw_data_to_msg(conn, timeouts=None, stream=None):
+    """
+    :param conn (socket.socket): socket to read one HTTP message from.
+    :param timeouts (Timeouts, optional): idle/header/body deadlines.
+    :param stream (callable, optional): called with the header string; if
+        it returns True the body is left on the socket and returned as a
+        BodyStream instead of bytes.
+    :raises TimeoutError: if a deadline expired while reading.
+    """
+    deadline = Deadline(conn, timeouts.scope) if timeouts else None
     try:
         # 1. Read header
-        header_byte = b""
-        while b"\r\n\r\n" not in header_byte:
-            # Return type is bytes
-            chunk = conn.recv(1024)
-            if not chunk:
+        scratch = scratch_buffer()
+        view = memoryview(scratch)
+        header_byte = bytearray()
+        end = -1
+        if deadline:
+            deadline.arm('idle', timeouts.idle)
+        while end < 0:
+            n = conn.recv_into(scratch)
+            if not n:
                 break
-            header_byte += chunk
-        if b"\r\n\r\n" in header_byte:
-            headers_raw, extra_data_after_headers = header_byte.split(b"\r\n\r\n", 1)
+            if deadline and not header_byte:
+                deadline.arm('header', timeouts.header)
+            # Only rescan the tail that could complete a new terminator
+            search_from = max(0, len(header_byte) - 3)
+            header_byte += view[:n]
+            end = header_byte.find(b"\r\n\r\n", search_from)
+        view.release()
+        if end >= 0:
+            headers_raw = header_byte[:end]
+            extra_data_after_headers = header_byte[end + 4:]
         else:
             headers_raw = header_byte
             extra_data_after_headers = b""
         header_string = headers_raw.decode('latin-1')
-                
+
         # 2. Read Content-Length
-        headers_dict = {}
+        content_length = 0
         for line in header_string.split('\r\n'):
-            if ': ' in line:
-                key, val = line.split(': ', 1)
-                headers_dict[key.lower()] = val
-        content_length = int(headers_dict.get('content-length', 0))
-        
-        # 3. Read Body
-        body_byte = extra_data_after_headers
-        while len(body_byte) < content_length:
-            body_byte_remain = content_length - len(body_byte)
-            chunk = conn.recv(min(4096, body_byte_remain))
-            if not chunk:
+            key, sep, val = line.partition(': ')
+            if sep and key.lower() == 'content-length':
+                content_length = int(val)
                 break
-            body_byte += chunk
+        if stream is not None and stream(header_string):
+            # Only streaming routes need the other headers this early
+            headers = CaseInsensitiveDict()
+            for line in header_string.split('\r\n'):
+                key, sep, val = line.partition(': ')
+                if sep:
+                    headers[key] = val
+            initial = bytes(extra_data_after_headers[:content_length])
+            return header_string, BodyStream(conn, initial, content_length, headers, timeouts)
+
+        # 3. Read Body. Content-Length is only a claim, so the buffer starts
+        # at most MAX_PREALLOCATE bytes and doubles as data actually arrives
+        received = min(len(extra_data_after_headers), content_length)
+        if received >= content_length:
+            return header_string, bytes(extra_data_after_headers)
+        body_byte = bytearray(min(content_length, max(received, MAX_PREALLOCATE)))
+        body_byte[:received] = extra_data_after_headers[:received]
+        if deadline:
+            deadline.arm('body', timeouts.body)
+        while received < content_length:
+            if received == len(body_byte):
+                body_byte.extend(bytes(min(len(body_byte), content_length - received)))
+            with memoryview(body_byte) as body_view:
+                n = conn.recv_into(body_view[received:])
+            if not n:
+                break
+            received += n
 
         # 4. Request = headers + bodies
-        return header_string, body_byte
-    except Exception:
-        raise
-    
-def send_http_request(tracker, method, path, body_data=None, auth_cookie=None):
-    try:
-        parsed_url = urlparse(tracker)
-        host = parsed_url.hostname or "localhost"
-        port_from_url = parsed_url.port
-        port = port_from_url if port_from_url else 8000
-        
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.settimeout(10)
-        client_socket.connect((host, port))
-        
-        body_str = ""
-        if body_data:
-            if isinstance(body_data, dict):
-                body_str = "&".join(f"{k}={v}" for k, v in body_data.items())
-            else:
-                body_str = str(body_data)
-        
-        headers = CaseInsensitiveDict()
-        headers['Host'] = "{host}:{port}".format(host=host, port=port)
-        headers['Connection'] = 'close'
-        headers['User-Agent'] = 'P2P-Peer/1.0'
-        
-        if auth_cookie:
-            headers['Cookie'] = auth_cookie
-        
-        if body_data:
-            headers['Content-Type'] = 'application/x-www-form-urlencoded'
-            headers['Content-Length'] = str(len(body_str))
-        
-        request_lines = ["{} {} HTTP/1.1".format(method.upper(), path)]
-        for header, value in headers.items():
-            request_lines.append("{}: {}".format(header, value))
-        request_lines.extend(["", body_str])
-        
-        request_raw = "\r\n".join(line for line in request_lines).encode('utf-8')
-        client_socket.sendall(request_raw)
-        header_resp_str, body_content_bytes = raw_data_to_msg(client_socket)
-        client_socket.close()
-        
-        try:
-            status_line = header_resp_str.split('\r\n')[0]
-            status_code = int(status_line.split(' ')[1])
-        except (IndexError, ValueError, AttributeError):
-            status_code = 500
-        return status_code, header_resp_str, body_content_bytes
-    except Exception:
-        return 500, "", b""
\ No newline at end of file
+        return header_string, bytes(body_byte[:received])
+    finally:
+        if deadline:
+            deadline.cancel()
+            if deadline.expired:
+                raise TimeoutError("{} {} timeout".format(deadline.scope, deadline.phase))
@@ -10,18 +10,23 @@ class WeApRous:
         self.ip = ip
         self.port = port
 
-    def route(self, path, methods=['GET']):
+    def route(self, path, methods=['GET'], stream=False):
+        """
+        :param stream (bool): pass the handler a BodyStream instead of the
+            fully read and parsed body, for uploads of any size.
+        """
         def decorator(func):
             for method in methods:
                 self.routes[(method.upper(), path)] = func
 
             func._route_path = path
             func._route_methods = methods
+            func._route_stream = stream
 
             return func
         return decorator
 
-    def run(self):
+    def run(self, trace_file=None, profile_dir=None):
         if not self.ip or not self.port:
             print("Rous app need to prepare address by calling app.prepare_address(ip,port)")
-        create_backend(self.ip, self.port, self.routes)
\ No newline at end of file
+        create_backend(self.ip, self.port, self.routes, trace_file=trace_file, profile_dir=profile_dir)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import argparse
 from daemon import create_backend
+from daemon.timeouts import Timeouts
 
 PORT = 9000
 
@@ -21,8 +22,15 @@ if __name__ == "__main__":
         help='Port number to bind the server. Default is {}.'.format(PORT)
     )
  
+    parser.add_argument('--idle-timeout', type=float, default=15.0)
+    parser.add_argument('--header-timeout', type=float, default=10.0)
+    parser.add_argument('--body-timeout', type=float, default=30.0)
+    parser.add_argument('--trace-file', default=None, help='Append request spans in Chrome trace event format.')
+    parser.add_argument('--profile-dir', default=None, help='Where SIGUSR1 and route profiles are written.')
+ 
     args = parser.parse_args()
     ip = args.server_ip
     port = args.server_port
+    timeouts = Timeouts(idle=args.idle_timeout, header=args.header_timeout, body=args.body_timeout)
 
-    create_backend(ip, port)
\ No newline at end of file
+    create_backend(ip, port, timeouts=timeouts, trace_file=args.trace_file, profile_dir=args.profile_dir)
\ No newline at end of file
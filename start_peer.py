@@ -2,29 +2,158 @@ import socket
 import threading
 import json
 import time
+import os
+import random
 import argparse
 from queue import Queue
-from daemon.dictionary import CaseInsensitiveDict
-from daemon.utils import send_http_request
+from collections import OrderedDict, deque
+from daemon.client import HttpSession
+from daemon.eventloop import EventLoop
+from daemon.transfer import FileShare, Download, build_manifest, verify_manifest
+from concurrent.futures import ThreadPoolExecutor
+from daemon.history import MessageHistory, SeqTracker, sender_key
+from daemon.store import MessageStore
+from daemon import profiler
 from API_gateway import run_api_server
 
+SYNC_PAGE_SIZE = 100
+SEEN_IDS_LIMIT = 50000
+# Seconds a sender run stays in sync requests after it left the history,
+# so a sync in progress does not page through it again
+SYNC_SENDER_GRACE = 300
+DIAL_CONCURRENCY = 8
+DIAL_TIMEOUT = 5
+DIAL_BACKOFF_BASE = 2.0
+DIAL_BACKOFF_MAX = 300.0
+HANDSHAKE_TIMEOUT = 5
+TRANSFER_WORKERS = 4
+
+class PeerLink:
+    """
+    Protocol state of one peer connection, driven by the event loop: the
+    hello exchange, then newline-delimited JSON packets.
+    """
+    def __init__(self, peer, addr, outbound):
+        self.peer = peer
+        self.addr = addr
+        self.outbound = outbound
+        self.buffer = b""
+        self.registered = False
+        self.conn = None
+
+    def connection_made(self, conn):
+        self.conn = conn
+        try:
+            self.peer.send_hello(conn)
+        except OSError:
+            return
+        conn.loop.call_later(HANDSHAKE_TIMEOUT, self.handshake_expired)
+
+    def handshake_expired(self):
+        if not self.registered:
+            self.peer.remove_connection(self.conn, self.addr)
+
+    def data_received(self, conn, data):
+        # Keep a partial trailing line until the rest arrives
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if conn.closed:
+                return
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line.decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                print("Decoded message to JSON unsuccessfully")
+                continue
+            if not self.registered and message.get('type') == 'chunk-request':
+                # A file transfer, not a peer link: serve it off the loop
+                try:
+                    sock = conn.detach()
+                except OSError:
+                    conn.sock.close()
+                    return
+                self.peer.serve_chunk(sock, message)
+                return
+            if not self.registered:
+                # A peer without handshake support opens with a normal packet
+                hello = message if message.get('type') == 'hello' else None
+                key = self.peer.accept_hello(conn, self.addr, hello, self.outbound)
+                if key is None:
+                    return
+                self.addr = key
+                self.registered = True
+                if hello is not None:
+                    continue
+            try:
+                self.peer.handle_packet(conn, self.addr, message)
+            except Exception:
+                print("Handling peer message unsuccessfully")
+
+    def connection_lost(self, conn):
+        self.peer.remove_connection(conn, self.addr)
+
 class Peer:
-    def __init__(self, tracker, host, port, username, ui_queue):
+    def __init__(self, tracker, host, port, username, ui_queue, history_capacity=1000, store=None, download_dir='downloads', share_dir='shared'):
         self.tracker = tracker
         self.host = host
         self.port = int(port)
         self.username = username
         
-        self.auth_cookie = None
+        self.tracker_session = HttpSession(tracker)
         self.logged_in = False
         self.peers = {}
         self.connections_lock = threading.Lock()
+        # conn -> node id of the side that dialed it, for duplicate tie-breaks
+        self.initiators = {}
+        self.node_id = os.urandom(8).hex()
+        # Dials beyond DIAL_CONCURRENCY wait here; only the loop touches it
+        self.dial_queue = deque()
+        self.dials_active = 0
+        self.dialing = set()
+        # addr -> (consecutive failures, monotonic time of next allowed dial)
+        self.dial_failures = {}
+        # addr -> wall time the peer was last connected
+        self.last_seen = {}
         
         self.ui_queue = ui_queue
         self.current_channel = '#general'
         self.subscribed_channels = ['#general', '#mmt', '#cnpm']
+        self.subscriptions = set(self.subscribed_channels)
+        # channel -> addrs of peers subscribed to it, and the reverse map.
+        # Peers that never advertised (no handshake) get every channel.
+        self.interest = {}
+        self.peer_channels = {}
+        self.unfiltered_peers = set()
+        self.history = MessageHistory(history_capacity)
+        self.sync_lock = threading.Lock()
+        # channel -> sender key -> SeqTracker
+        self.seen_seqs = {}
+        self.seen_ids = OrderedDict()
+        # Our messages count up from 1 per channel within this run
+        self.epoch = int(time.time() * 1000)
+        self.send_seqs = {}
+        self.store = store
+        if self.store:
+            self.load_history_from_store()
+
+        # file id -> {"manifest", "channel", "holders": set of listen addrs}
+        self.known_files = {}
+        self.downloads = {}
+        self.files_lock = threading.Lock()
+        self.shared_files = FileShare()
+        self.download_dir = download_dir
+        self.share_dir = share_dir
+        self.transfer_pool = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS, thread_name_prefix='transfer')
+        # Sync pages are built off the loop thread; one worker keeps the
+        # pages for a connection in order
+        self.sync_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sync')
+        # Appends may fsync, so they run on their own writer, in arrival order
+        self.store_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
                 
         self.running = True
+        self.loop = EventLoop()
         self.peer_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.peer_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.peer_server_socket.bind((self.host, self.port))
@@ -32,23 +161,16 @@ class Peer:
         self.port = self.peer_server_socket.getsockname()[1]
         
     def start(self):
-        server_thread = threading.Thread(target=self.run_server_thread, daemon=True)
-        server_thread.start()
+        # Every peer socket lives on the loop thread; the connect thread
+        # only talks to the tracker and queues dials.
+        self.peer_server_socket.listen(128)
+        self.loop.listen(self.peer_server_socket, self.accept_peer)
+        self.loop.start(name='peer-loop')
         connect_thread = threading.Thread(target=self.run_connect_thread, daemon=True)
         connect_thread.start()
         
-    def run_server_thread(self):
-        self.peer_server_socket.listen(5)
-        while self.running:
-            try:
-                conn, addr = self.peer_server_socket.accept()
-                listener = threading.Thread(target=self.handle_peer_connections, args=(conn, addr), daemon=True)
-                listener.start()
-            except Exception:
-                if self.running:
-                    time.sleep(1)
-                else:
-                    break
+    def accept_peer(self, sock, addr):
+        self.loop.attach(sock, addr, PeerLink(self, addr, outbound=False))
                 
     def run_connect_thread(self):
         if not self.login_to_tracker('admin', 'password'):
@@ -59,115 +181,380 @@ class Peer:
         while self.running:
             peer_list = self.get_peer_list()
             if peer_list is None:
+                # The session token may have expired; log in again
+                if self.login_to_tracker('admin', 'password'):
+                    self.submit_info_to_tracker()
                 time.sleep(10)
                 continue
             
-            for peer_addr in peer_list:
-                if not self.running:
-                    break
-                
-                peer_addr_tuple = (peer_addr[0], int(peer_addr[1]))
-                
-                host = 'localhost' if self.host == '0.0.0.0' else self.host
-                info = (host, self.port)
-                if peer_addr_tuple == info:
-                    continue
-                    
-                is_connected = False
-                with self.connections_lock:
-                    if peer_addr_tuple in self.peers:
-                        is_connected = True
-                        
-                if not is_connected:
-                    try:
-                        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        peer_socket.settimeout(5)
-                        peer_socket.connect(peer_addr_tuple)
-                        self.add_connection(peer_socket, peer_addr_tuple)
-                        listener = threading.Thread(target=self.handle_peer_connections, args=(peer_socket, peer_addr_tuple), daemon=True)
-                        listener.start()
-                    except Exception:
-                        pass
+            self.dial_peers(peer_list)
+            if self.store:
+                self.store.compact()
             time.sleep(10)
 
-    def handle_peer_connections(self, conn, addr):
-        conn.settimeout(None)
-        while self.running:
+    def dial_candidates(self, peer_list):
+        """
+        Addresses worth dialing now: not ourselves, not connected or being
+        dialed, and out of backoff. Recently seen peers come first.
+        """
+        host = 'localhost' if self.host == '0.0.0.0' else self.host
+        own = (host, self.port)
+        now = time.monotonic()
+        listed = set((addr[0], int(addr[1])) for addr in peer_list)
+        with self.connections_lock:
+            # Forget peers the tracker no longer lists
+            for addr in list(self.dial_failures):
+                if addr not in listed:
+                    del self.dial_failures[addr]
+            for addr in list(self.last_seen):
+                if addr not in listed and addr not in self.peers:
+                    del self.last_seen[addr]
+            candidates = [addr for addr in listed
+                          if addr != own and addr not in self.peers and addr not in self.dialing
+                          and self.dial_failures.get(addr, (0, 0))[1] <= now]
+            candidates.sort(key=lambda addr: (-self.last_seen.get(addr, 0), self.dial_failures.get(addr, (0, 0))[0]))
+            self.dialing.update(candidates)
+        return candidates
+
+    def dial_peers(self, peer_list):
+        for addr in self.dial_candidates(peer_list):
+            self.loop.call_soon(self.queue_dial, addr)
+
+    def queue_dial(self, addr):
+        self.dial_queue.append(addr)
+        self.pump_dials()
+
+    def pump_dials(self):
+        while self.dial_queue and self.dials_active < DIAL_CONCURRENCY:
+            addr = self.dial_queue.popleft()
+            if not self.running:
+                with self.connections_lock:
+                    self.dialing.discard(addr)
+                continue
+            self.dials_active += 1
+            self.loop.connect(addr, DIAL_TIMEOUT, lambda sock, error, addr=addr: self.dial_done(addr, sock, error))
+
+    def dial_done(self, addr, sock, error):
+        self.dials_active -= 1
+        with self.connections_lock:
+            self.dialing.discard(addr)
+            if error is None:
+                self.dial_failures.pop(addr, None)
+            else:
+                failures = self.dial_failures.get(addr, (0, 0))[0] + 1
+                delay = min(DIAL_BACKOFF_MAX, DIAL_BACKOFF_BASE * (2 ** (failures - 1)))
+                self.dial_failures[addr] = (failures, time.monotonic() + delay * random.uniform(0.5, 1.5))
+        if sock is not None:
+            self.loop.attach(sock, addr, PeerLink(self, addr, outbound=True))
+        self.pump_dials()
+
+    def listen_address(self):
+        host = 'localhost' if self.host == '0.0.0.0' else self.host
+        return (host, self.port)
+
+    def send_hello(self, conn):
+        host, port = self.listen_address()
+        with self.connections_lock:
+            channels = list(self.subscribed_channels)
+        self.send_packet(conn, {"type": "hello", "node_id": self.node_id, "username": self.username, "listen": [host, port], "channels": channels})
+
+    def accept_hello(self, conn, addr, hello, outbound):
+        """
+        Register a connection once the remote side's first packet is in.
+
+        :return: the key the connection is stored under, or None if it
+            was closed as a self-dial or a duplicate.
+        """
+        if hello is not None:
+            if hello.get('node_id') == self.node_id:
+                # Dialed our own listen address under another name
+                self.remove_connection(conn, addr)
+                return None
+            remote_id = hello.get('node_id', '')
+            listen = self.verified_listen(conn, hello.get('listen'))
+            if listen is not None:
+                addr = listen
+            else:
+                # A claim the socket does not back up may not evict the
+                # link of the peer it names; keep the address we know
+                remote_id = None
+            initiator = self.node_id if outbound else remote_id
+        else:
+            remote_id = initiator = None
+        if not self.add_connection(conn, addr, initiator, remote_id):
+            return None
+        self.set_peer_channels(addr, hello.get('channels') if hello else None)
+        self.send_sync_request(conn)
+        return addr
+
+    def verified_listen(self, conn, listen):
+        """
+        :return: the (host, port) a hello claims to listen on if the
+            connection really comes from that host, else None. Only
+            literal addresses and loopback names can be checked.
+        """
+        try:
+            host, port = listen[0], int(listen[1])
+            peer_host = conn.sock.getpeername()[0]
+        except (TypeError, ValueError, IndexError, KeyError, OSError):
+            return None
+        if host == peer_host or (host in profiler.LOOPBACK and peer_host in profiler.LOOPBACK):
+            return (host, port)
+        return None
+
+    def handle_packet(self, conn, addr, message):
+        msg_type = message.get('type')
+        if msg_type == 'message':
+            self.deliver_message(message)
+        elif msg_type == 'sync-request':
+            self.sync_pool.submit(self.handle_sync_request, conn, message)
+        elif msg_type == 'sync-batch':
+            self.handle_sync_batch(conn, message)
+        elif msg_type == 'subscribe':
+            self.set_peer_channels(addr, message.get('channels', []))
+        elif msg_type == 'file-announce':
+            self.handle_file_announce(message)
+        elif msg_type == 'file-query':
+            self.handle_file_query(conn, message)
+
+    def deliver_message(self, message):
+        channel_id = message.get('channels', '#general')
+        username = message.get('username', 'Anonymous')
+        content = message.get('content', '')
+
+        if channel_id in self.subscriptions:
+            if not self.record_message(message):
+                return
+            formatted_msg = "{}|[{}]: {}".format(channel_id, username, content)
+            self.ui_queue.put(formatted_msg)
+
+    def next_message_seq(self, channel_id):
+        # Dense per channel, so a receiver can tell exactly which ones it missed
+        with self.sync_lock:
+            seq = self.send_seqs.get(channel_id, 0) + 1
+            self.send_seqs[channel_id] = seq
+            return seq
+
+    def mark_seen(self, message):
+        """
+        Track the message id and the sequence numbers seen per sender.
+        :return: False if the message was already seen.
+        """
+        msg_id = message.get('id')
+        seq = message.get('seq')
+        epoch = message.get('epoch')
+        if msg_id is None:
+            return True
+        channel_id = message.get('channels', '#general')
+        username = message.get('username', 'Anonymous')
+        with self.sync_lock:
+            if isinstance(seq, int) and isinstance(epoch, int):
+                # Track even a duplicate: its sender may have been pruned
+                vector = self.seen_seqs.setdefault(channel_id, {})
+                key = sender_key(username, epoch)
+                seen = vector.get(key)
+                if seen is None:
+                    seen = vector[key] = SeqTracker()
+                seen.add(seq)
+            if msg_id in self.seen_ids:
+                return False
+            self.seen_ids[msg_id] = None
+            if len(self.seen_ids) > SEEN_IDS_LIMIT:
+                self.seen_ids.popitem(last=False)
+        return True
+
+    def record_message(self, message):
+        if not self.mark_seen(message):
+            return False
+        channel_id = message.get('channels', '#general')
+        self.history.add(channel_id, message.get('username', 'Anonymous'), message.get('content', ''), message.get('timestamp', time.time()), message.get('seq'), message.get('epoch'))
+        if self.store:
+            self.store_pool.submit(self.store_message, channel_id, message)
+        return True
+
+    def store_message(self, channel_id, message):
+        try:
+            self.store.append(channel_id, message)
+        except (OSError, ValueError) as e:
+            print("Storing message unsuccessfully: {}".format(e))
+
+    def load_history_from_store(self):
+        for channel_id in self.store.channels():
+            for _, message in self.store.tail(channel_id, self.history.capacity):
+                self.mark_seen(message)
+                self.history.add(channel_id, message.get('username', 'Anonymous'), message.get('content', ''), message.get('timestamp', 0), message.get('seq'), message.get('epoch'))
+
+    def send_packet(self, conn, packet):
+        conn.send((json.dumps(packet) + '\n').encode('utf-8'))
+
+    def send_sync_request(self, conn, channels=None):
+        channels = channels if channels is not None else list(self.subscribed_channels)
+        # One channel per request keeps each packet bounded by one history
+        for channel in channels:
             try:
-                data = conn.recv(4096)
-                if not data:
-                    break
-            except (ConnectionResetError, ConnectionAbortedError, OSError):
-                break
-                
+                self.send_packet(conn, {"type": "sync-request", "vectors": {channel: self.sync_vector(channel)}})
+            except OSError:
+                return
+
+    def sync_vector(self, channel_id):
+        """
+        :return: ``{sender key: [high, gap, ...]}`` for the sender runs
+            still in our history of ``channel_id``; others are forgotten
+            once SYNC_SENDER_GRACE has passed.
+        """
+        present = self.history.senders(channel_id)
+        expired = time.monotonic() - SYNC_SENDER_GRACE
+        with self.sync_lock:
+            vector = self.seen_seqs.get(channel_id, {})
+            for key in [key for key, seen in vector.items() if key not in present and seen.touched < expired]:
+                del vector[key]
+            return {key: seen.to_packet() for key, seen in vector.items()}
+
+    def handle_sync_request(self, conn, request):
+        """
+        Answer one page of messages per channel that the requester is
+        missing; the requester asks again while ``more`` is set.
+        """
+        vectors = request.get('vectors', {})
+        for channel_id, vector in vectors.items():
+            if not isinstance(vector, dict):
+                continue
+            vector = {key: SeqTracker.from_packet(seen) for key, seen in vector.items()}
+            vector = {key: seen for key, seen in vector.items() if seen is not None}
+            messages, more = self.history.missing(channel_id, vector, SYNC_PAGE_SIZE)
+            if not messages:
+                continue
+            batch = {
+                "type": "sync-batch",
+                "channel": channel_id,
+                "messages": [m.to_packet() for m in messages],
+                "more": more
+            }
             try:
-                messages = data.decode('utf-8').strip().split('\n')
-                
-                for msg_str in messages:
-                    if not msg_str.strip():
-                        continue
-                    
-                    try:
-                        message = json.loads(msg_str)
-                        if message.get('type') == 'message':
-                            channel_id = message.get('channels', '#general')
-                            username = message.get('username', 'Anonymous')
-                            content = message.get('content', '')
-                            
-                            if channel_id in self.subscribed_channels:
-                                formatted_msg = "{}|[{}]: {}".format(channel_id, username, content)
-                                self.ui_queue.put(formatted_msg)
-                    except json.JSONDecodeError:
-                        print("Decoded message to JSON unsuccessfully")
-            except Exception:
-                print("Handling peer message unsuccessfully")
-                
-        self.remove_connection(conn, addr)
+                self.send_packet(conn, batch)
+            except OSError:
+                return
 
-    def add_connection(self, conn, addr):
+    def handle_sync_batch(self, conn, batch):
+        channel_id = batch.get('channel')
+        for message in batch.get('messages', []):
+            if message.get('channels') == channel_id:
+                self.deliver_message(message)
+        if batch.get('more') and channel_id in self.subscriptions:
+            vector = self.sync_vector(channel_id)
+            try:
+                self.send_packet(conn, {"type": "sync-request", "vectors": {channel_id: vector}})
+            except OSError:
+                pass
+
+    def add_connection(self, conn, addr, initiator=None, remote_id=None):
+        """
+        Register ``conn`` as the link to ``addr``. When both sides dialed
+        each other, both keep the socket dialed by the smaller node id,
+        so the pair agrees on which one to close.
+
+        :return: True if ``conn`` was kept.
+        """
+        replaced = None
         with self.connections_lock:
+            current = self.peers.get(addr)
+            if current is not None and remote_id:
+                winner = min(self.node_id, remote_id)
+                if initiator == winner and self.initiators.get(current) != winner:
+                    replaced = self.peers.pop(addr)
+                    self.initiators.pop(replaced, None)
             if addr not in self.peers:
                 self.peers[addr] = conn
+                self.initiators[conn] = initiator
+                self.last_seen[addr] = time.time()
                 print("Added connection {}. Total connections: {}".format(addr, len(self.peers)))
+                kept = True
             else:
-                conn.close()
+                kept = False
+        if replaced is not None:
+            print("Closed duplicate connection to {}".format(addr))
+            self.close_quietly(replaced)
+        if not kept:
+            print("Closed duplicate connection to {}".format(addr))
+            self.close_quietly(conn)
+        return kept
+
+    def set_peer_channels(self, addr, channels):
+        """
+        Replace what ``addr`` is subscribed to; ``None`` means unknown,
+        so it is sent everything.
+        """
+        with self.connections_lock:
+            if addr not in self.peers:
+                return
+            self.drop_peer_channels(addr)
+            if channels is None:
+                self.unfiltered_peers.add(addr)
+                return
+            channels = set(channels)
+            self.peer_channels[addr] = channels
+            for channel in channels:
+                self.interest.setdefault(channel, set()).add(addr)
+
+    def drop_peer_channels(self, addr):
+        # Caller holds connections_lock
+        self.unfiltered_peers.discard(addr)
+        for channel in self.peer_channels.pop(addr, ()):
+            subscribers = self.interest.get(channel)
+            if subscribers is not None:
+                subscribers.discard(addr)
+                if not subscribers:
+                    del self.interest[channel]
+
+    def subscribe(self, channel):
+        """
+        Join ``channel``, tell every peer, and catch up on its history
+        from the peers that carry it.
+        """
+        with self.connections_lock:
+            if channel in self.subscriptions:
+                return False
+            self.subscribed_channels.append(channel)
+            self.subscriptions.add(channel)
+            channels = list(self.subscribed_channels)
+            active_items = list(self.peers.items())
+            carriers = self.interest.get(channel, set()) | self.unfiltered_peers
+        for addr, conn in active_items:
+            try:
+                self.send_packet(conn, {"type": "subscribe", "channels": channels})
+                if addr in carriers:
+                    self.send_sync_request(conn, [channel])
+            except OSError:
+                self.remove_connection(conn, addr)
+        return True
+
+    def close_quietly(self, conn):
+        conn.close()
                 
     def remove_connection(self, conn, addr):
         with self.connections_lock:
-            if addr in self.peers:
+            if self.peers.get(addr) is conn:
                 del self.peers[addr]
+                self.drop_peer_channels(addr)
+                self.last_seen[addr] = time.time()
                 print("Removed connection {}. Total connections: {}".format(addr, len(self.peers)))
-            try:
-                conn.close()
-            except:
-                pass
+            self.initiators.pop(conn, None)
+        conn.close()
 
     def login_to_tracker(self, username, password):
         payload = {"username": username, "password": password}
         
         try:
-            status_code, headers, body = send_http_request(self.tracker, "POST", "/login", body_data=payload, auth_cookie=None)
-
-            if status_code == 200:
-                response_headers = CaseInsensitiveDict()
-                if headers:
-                    for line in headers.split('\r\n')[1:]:
-                        if ': ' in line:
-                            key, val = line.split(': ', 1)
-                            response_headers[key] = val
-                    
-                    set_cookie = response_headers.get('Set-Cookie')
-                    if set_cookie and 'auth=true' in set_cookie:
-                        self.auth_cookie = set_cookie.split(';')[0].strip()
-                        self.logged_in = True
-                        print("Login successfully, session cookie: {}".format(self.auth_cookie))
-                        return True
-                    else:
-                        print("Login unsuccessfully")
-                        self.logged_in = False
-                        return False
+            response = self.tracker_session.request("POST", "/login", body_data=payload)
+            if response.status_code == 200:
+                # The session's cookie jar keeps the signed token for later calls
+                if self.tracker_session.cookies.get('auth'):
+                    self.logged_in = True
+                    print("Login successfully, session cookies: {}".format(self.tracker_session.cookies))
+                    return True
+                print("Login unsuccessfully")
             else:
-                print("Login unsuccessfully: status code {}".format(status_code))
+                print("Login unsuccessfully: status code {}".format(response.status_code))
         except Exception as e:
             print("Login to tracker unsuccessfully: {}".format(e))
 
@@ -185,12 +572,12 @@ class Peer:
         }
         
         try:
-            status_code, headers, body = send_http_request(self.tracker, "POST", "/submit-info", body_data=payload, auth_cookie=self.auth_cookie)
-            if status_code == 200:
+            response = self.tracker_session.request("POST", "/submit-info", body_data=payload)
+            if response.status_code == 200:
                 print("Successfully registered to tracker")
                 return True
             else:
-                print("Unsuccessfully registered to tracker: status code {}".format(status_code))
+                print("Unsuccessfully registered to tracker: status code {}".format(response.status_code))
                 return False
         except Exception:
             print("Unsuccessfully registered to tracker")
@@ -201,12 +588,11 @@ class Peer:
             return None
 
         try:
-            status_code, headers, body = send_http_request(self.tracker, "GET", "/get-list", body_data=None, auth_cookie=self.auth_cookie)
+            response = self.tracker_session.request("GET", "/get-list")
             
-            if status_code == 200:
+            if response.status_code == 200:
                 try:
-                    body_str = body.decode('utf-8')
-                    peers_data = json.loads(body_str)
+                    peers_data = response.json()
                     
                     if isinstance(peers_data, list):
                         peer_tuple_list = []
@@ -218,82 +604,214 @@ class Peer:
                     print("Failed to decode peer list JSON: {}".format(e))
                     return None
             else:
-                print("Failed to get peer list: status code {}".format(status_code))
+                print("Failed to get peer list: status code {}".format(response.status_code))
                 return None
         except Exception:
             print("Failed to get peer list")
             return None
         
-    def send_to_peer(self, target_peer, message_content, channel_id='#general'):
-        message_packet = {
+    def build_message_packet(self, message_content, channel_id, private=False):
+        if private:
+            # Direct messages take no channel number: they are not synced,
+            # and a number only one peer sees would be a gap for the rest
+            seq = None
+            msg_id = "{}:dm:{}".format(self.username, os.urandom(8).hex())
+        else:
+            seq = self.next_message_seq(channel_id)
+            msg_id = "{}:{}:{}".format(self.username, self.epoch, seq)
+        return {
             "type": "message",
+            "id": msg_id,
+            "seq": seq,
+            "epoch": self.epoch,
             "channels": channel_id,
             "username": self.username,
             "content": message_content.strip(),
             "timestamp": time.time()
         }
-        
-        message_json = json.dumps(message_packet) + '\n'
-        bytes_packet = message_json.encode('utf-8')
+
+    def send_to_peer(self, target_peer, message_content, channel_id='#general'):
+        message_packet = self.build_message_packet(message_content, channel_id, private=True)
         
         with self.connections_lock:
             target_conn = self.peers.get(target_peer)
             
-            if target_conn:
-                try:
-                    target_conn.sendall(bytes_packet)
-                    return True
-                except Exception:
-                    return False
+        if target_conn:
+            try:
+                self.send_packet(target_conn, message_packet)
+                return True
+            except Exception:
+                return False
         return False
     
     def broadcast_message(self, message_content, channel_id='#general'):
         if not message_content.strip():
             return
             
-        message_packet = {
-            "type": "message",
-            "channels": channel_id,
-            "username": self.username,
-            "content": message_content.strip(),
-            "timestamp": time.time()
-        }
-        
-        message_json = json.dumps(message_packet) + '\n'
-        bytes_packet = message_json.encode('utf-8')
-        
+        message_packet = self.build_message_packet(message_content, channel_id)
+        self.record_message(message_packet)
+        self.send_to_channel(channel_id, message_packet)
+
+    def send_to_channel(self, channel_id, packet):
         with self.connections_lock:
-            active_items = list(self.peers.items())
+            targets = self.interest.get(channel_id, set()) | self.unfiltered_peers
+            active_items = [(addr, self.peers[addr]) for addr in targets if addr in self.peers]
         
         for addr, conn in active_items:
             try:
-                conn.sendall(bytes_packet)
+                self.send_packet(conn, packet)
             except Exception:
                 self.remove_connection(conn, addr)
+
+    def serve_chunk(self, sock, request):
+        def serve():
+            try:
+                self.shared_files.serve(sock, request)
+            except OSError as e:
+                print("Serving chunk unsuccessfully: {}".format(e))
+            finally:
+                sock.close()
+        self.transfer_pool.submit(serve)
+
+    def resolve_share_path(self, path):
+        """
+        :return: absolute path of ``path`` taken relative to the share
+            directory, or None if it is not a file inside it.
+        """
+        root = os.path.realpath(self.share_dir)
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root or not os.path.isfile(resolved):
+            return None
+        return resolved
+
+    def share_file(self, path, channel_id='#general'):
+        """
+        Hash ``path`` into chunks, serve it, and announce its manifest on
+        ``channel_id``.
+        """
+        manifest = build_manifest(path)
+        self.shared_files.add(path, manifest)
+        holder = self.listen_address()
+        with self.files_lock:
+            entry = self.known_files.setdefault(manifest["file_id"], {"manifest": manifest, "channel": channel_id, "holders": set()})
+            entry["holders"].add(holder)
+        self.send_to_channel(channel_id, self.build_file_announce(manifest, channel_id))
+        self.broadcast_message("shared {} ({} bytes) file:{}".format(manifest["name"], manifest["size"], manifest["file_id"]), channel_id)
+        return manifest
+
+    def build_file_announce(self, manifest, channel_id):
+        host, port = self.listen_address()
+        return {"type": "file-announce", "channel": channel_id, "manifest": manifest, "holder": [host, port]}
+
+    def handle_file_announce(self, message):
+        manifest = message.get('manifest')
+        holder = message.get('holder')
+        if not isinstance(manifest, dict) or not holder or not verify_manifest(manifest):
+            return
+        with self.files_lock:
+            entry = self.known_files.setdefault(manifest["file_id"], {"manifest": manifest, "channel": message.get('channel', '#general'), "holders": set()})
+            entry["holders"].add((holder[0], int(holder[1])))
+
+    def handle_file_query(self, conn, message):
+        shared = self.shared_files.get(message.get('file_id'))
+        if shared is None:
+            return
+        with self.files_lock:
+            entry = self.known_files.get(shared[1]["file_id"])
+            channel_id = entry["channel"] if entry else '#general'
+        try:
+            self.send_packet(conn, self.build_file_announce(shared[1], channel_id))
+        except OSError:
+            pass
+
+    def download_file(self, file_id, dest_dir=None):
+        """
+        Fetch ``file_id`` in parallel from every known holder.
+
+        :return: the Download, or None when the manifest is not known yet;
+            peers are then asked for it so a retry can succeed.
+        """
+        with self.files_lock:
+            entry = self.known_files.get(file_id)
+            running = self.downloads.get(file_id)
+        if running is not None and not running.finished and running.error is None:
+            return running
+        if entry is None:
+            with self.connections_lock:
+                active_items = list(self.peers.items())
+            for addr, conn in active_items:
+                try:
+                    self.send_packet(conn, {"type": "file-query", "file_id": file_id})
+                except OSError:
+                    self.remove_connection(conn, addr)
+            return None
+        own = self.listen_address()
+
+        def sources():
+            with self.files_lock:
+                return [addr for addr in entry["holders"] if addr != own]
+        download = Download(entry["manifest"], dest_dir or self.download_dir, sources, on_done=self.download_done)
+        with self.files_lock:
+            self.downloads[file_id] = download
+        download.start()
+        return download
+
+    def download_done(self, download):
+        if not download.finished:
+            return
+        manifest = download.manifest
+        self.shared_files.add(download.dest, manifest)
+        with self.files_lock:
+            entry = self.known_files[manifest["file_id"]]
+            entry["holders"].add(self.listen_address())
+            channel_id = entry["channel"]
+        # Seed to later downloaders
+        self.send_to_channel(channel_id, self.build_file_announce(manifest, channel_id))
+
+    def list_files(self):
+        with self.files_lock:
+            items = list(self.known_files.items())
+            downloads = dict(self.downloads)
+        files = []
+        for file_id, entry in items:
+            manifest = entry["manifest"]
+            info = {
+                "file_id": file_id,
+                "name": manifest["name"],
+                "size": manifest["size"],
+                "channel": entry["channel"],
+                "holders": len(entry["holders"]),
+            }
+            download = downloads.get(file_id)
+            if download is not None:
+                done, total = download.progress()
+                info["progress"] = [done, total]
+                info["finished"] = download.finished
+            files.append(info)
+        return files
     
     def shutdown(self):
         self.running = False
         
         with self.connections_lock:
             for conn in self.peers.values():
-                try:
-                    conn.shutdown(socket.SHUT_RDWR)
-                    conn.close()
-                except:
-                    pass
+                conn.close()
             self.peers.clear()
 
-        try:
-            dummy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            dummy_socket.connect(('localhost' if self.host == '0.0.0.0' else self.host, self.port))
-            dummy_socket.close()
-        except:
-            pass
-        
+        self.loop.stop()
         try:
             self.peer_server_socket.close()
         except:
             pass
+
+        self.tracker_session.close()
+        self.transfer_pool.shutdown(wait=False)
+        self.sync_pool.shutdown(wait=False)
+        # Let queued appends reach the store before it closes
+        self.store_pool.shutdown(wait=True)
+
+        if self.store:
+            self.store.close()
       
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -302,8 +820,18 @@ if __name__ == "__main__":
     parser.add_argument('--port', type=int, default=0)
     parser.add_argument('--api-port', type=int, default=0)
     parser.add_argument('--tracker', default="http://localhost:8080")
+    parser.add_argument('--history-size', type=int, default=1000)
+    parser.add_argument('--data-dir', default=None)
+    parser.add_argument('--fsync', choices=['always', 'batch', 'never'], default='batch')
+    parser.add_argument('--retention-hours', type=float, default=None)
+    parser.add_argument('--retention-mb', type=int, default=None)
+    parser.add_argument('--profile-dir', default=None)
+    parser.add_argument('--download-dir', default='downloads')
+    parser.add_argument('--share-dir', default='shared')
     
     args = parser.parse_args()
+    if args.history_size < 1:
+        parser.error("--history-size must be at least 1")
     
     # Random port
     if args.api_port == 0:
@@ -312,10 +840,18 @@ if __name__ == "__main__":
         args.api_port = temp_sock.getsockname()[1]
         temp_sock.close()
     
+    profiler.install_signal_handler('peer', args.profile_dir)
     ui_queue = Queue()      
-    api_thread = None
+    store = None
+    if args.data_dir:
+        store = MessageStore(
+            args.data_dir,
+            fsync_policy=args.fsync,
+            retention_seconds=args.retention_hours * 3600 if args.retention_hours else None,
+            retention_bytes=args.retention_mb * 1024 * 1024 if args.retention_mb else None
+        )
 
-    peer_instance = Peer(tracker=args.tracker, host='0.0.0.0', port=args.port, username=args.username, ui_queue=ui_queue)    
+    peer_instance = Peer(tracker=args.tracker, host='0.0.0.0', port=args.port, username=args.username, ui_queue=ui_queue, history_capacity=args.history_size, store=store, download_dir=args.download_dir, share_dir=args.share_dir)    
     
     try:
         peer_instance.start()
@@ -323,13 +859,11 @@ if __name__ == "__main__":
         print("P2P Port: {}".format(peer_instance.port))
         print("UI URL:   http://localhost:{}/chat.html".format(args.api_port))
         
-        api_thread = threading.Thread(target=run_api_server, args=(args.api_port, peer_instance, ui_queue), daemon=True)
-        api_thread.start()
+        if run_api_server(args.api_port, peer_instance, ui_queue, peer_instance.loop) is None:
+            raise SystemExit(1)
         
-        while True:
+        while peer_instance.loop.is_alive():
             time.sleep(1)
-            if not api_thread.is_alive():
-                break
             
     except KeyboardInterrupt:
         print("Shutting down")
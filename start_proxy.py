@@ -3,42 +3,49 @@ Requirements:
 - socket: provide socket networking interface.
 - threading: enables concurrent client handling via threads.
 - argparse: parses command-line arguments for server configuration.
-- re: used for regular expression matching in configuration parsing
+- routing: parses the virtual host configuration and reloads it on change.
 - response: response utilities.
 - httpadapter: the class for handling HTTP requests.
 - urlparse: parses URLs to extract host and port information.
 - daemon.create_proxy: initializes and starts the proxy server.
 """
 
+import os
 import argparse
-import re
 from daemon import create_proxy
+from daemon import auth
+from daemon.routing import parse_virtual_hosts
+from daemon.timeouts import Timeouts
+from daemon.ratelimit import SESSION_KEY_MODES
 
 PROXY_PORT = 8080
 
-def parse_virtual_hosts(config_file):
-    with open(config_file, 'r') as f:
-        config_text = f.read()
-    host_blocks = re.findall(r'host\s+"([^"]+)"\s*\{(.*?)\}', config_text, re.DOTALL)
-    routes = {}
-    for host, block in host_blocks:
-        proxy_passes = re.findall(r'proxy_pass\s+http://([^\s;]+);', block)
-        policy_match = re.search(r'dist_policy\s+([\w-]+)', block)
-        if policy_match:
-            dist_policy_map = policy_match.group(1)
-        else:
-            dist_policy_map = 'round-robin'
-        routes[host] = (proxy_passes, dist_policy_map)
-    for key, value in routes.items():
-        print({key: value})
-    return routes
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='Proxy', description='', epilog='Proxy daemon')
     parser.add_argument('--server-ip', default='0.0.0.0')
     parser.add_argument('--server-port', type=int, default=PROXY_PORT)
+    parser.add_argument('--config', default="config/proxy.conf")
+    parser.add_argument('--idle-timeout', type=float, default=15.0)
+    parser.add_argument('--header-timeout', type=float, default=10.0)
+    parser.add_argument('--body-timeout', type=float, default=30.0)
+    parser.add_argument('--upstream-connect-timeout', type=float, default=5.0)
+    parser.add_argument('--upstream-read-timeout', type=float, default=30.0)
+    parser.add_argument('--trace-file', default=None, help='Append request spans in Chrome trace event format.')
+    parser.add_argument('--profile-dir', default=None, help='Where SIGUSR1 and route profiles are written.')
+    parser.add_argument('--secret', default=None, help='session signing key of the backends, to key rate limits on users (default: $SESSION_SECRET)')
     args = parser.parse_args()
     ip = args.server_ip
     port = args.server_port
-    routes = parse_virtual_hosts("config/proxy.conf")
-    create_proxy(ip, port, routes)
\ No newline at end of file
+    try:
+        routes = parse_virtual_hosts(args.config)
+    except ValueError as e:
+        parser.error(str(e))
+    session_hosts = [host for host, (_, _, options) in routes.items() if options.get('limit_req_key') in SESSION_KEY_MODES]
+    if session_hosts and not (args.secret or os.environ.get('SESSION_SECRET')):
+        # Without the backends' key no session verifies and every client
+        # would quietly be limited by IP alone
+        parser.error("limit_req_key on {} needs --secret or $SESSION_SECRET".format(', '.join(session_hosts)))
+    auth.configure(args.secret)
+    timeouts = Timeouts(idle=args.idle_timeout, header=args.header_timeout, body=args.body_timeout)
+    upstream_timeouts = Timeouts.upstream(connect=args.upstream_connect_timeout, read=args.upstream_read_timeout)
+    create_proxy(ip, port, routes, args.config, timeouts, upstream_timeouts, args.trace_file, args.profile_dir)
\ No newline at end of file
@@ -1,13 +1,19 @@
+import os
+import json
+import socket
 import argparse
 from daemon.weaprous import WeApRous
-import threading
+from daemon.replication import Membership, Replicator
+from daemon import auth
 
 PORT = 8000
 
 app = WeApRous()
 
-active_peers = []
-peers_lock = threading.Lock()
+# Shared with the other trackers given by --replica. Stamps tie-break on
+# the node id, so two trackers must never share one
+membership = Membership("{}-{}".format(socket.gethostname(), os.urandom(4).hex()))
+replicator = Replicator(membership, [])
 
 @app.route('/login', methods=['GET'])
 def login_page(header, body):
@@ -26,17 +32,13 @@ def login(header, body):
 @app.route('/submit-info', methods=['POST'])
 def submit_info(header, body):
     try:
-        auth_cookie = header.get('cookie', '')
-        if "auth=true" not in auth_cookie:
+        if auth.authenticate(header.get('cookie', '')) is None:
             return False
         peer_ip = body.get('ip')
         peer_port = body.get('port')
         if not peer_ip or not peer_port:
             return False
-        peer_info = (peer_ip, int(peer_port))
-        with peers_lock:
-            if peer_info not in active_peers:
-                active_peers.append(peer_info)
+        membership.add(peer_ip, int(peer_port), body.get('username'))
         return True
     except Exception:
         return False
@@ -44,22 +46,46 @@ def submit_info(header, body):
 @app.route('/get-list', methods=['GET'])
 def get_list(header, body):
     try:
-        auth_cookie = header.get('cookie', '')
-        if "auth=true" not in auth_cookie:
+        if auth.authenticate(header.get('cookie', '')) is None:
             return False
-        with peers_lock:
-            # Create a copy instead of referencing
-            data_to_send = list(active_peers)
-        return data_to_send
+        return membership.peers()
     except Exception:
         return False
 
+@app.route('/replicate', methods=['POST'])
+def replicate(header, body):
+    # A tracker without replicas takes part in no cluster, so it accepts
+    # no membership from outside either
+    if not replicator.replicas:
+        return None
+    if not (auth.authenticate(header.get('cookie', '')) or '').startswith('tracker:'):
+        return None
+    try:
+        payload = json.loads(body.decode('utf-8') if isinstance(body, bytes) else "")
+    except ValueError:
+        return None
+    return replicator.handle(payload)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='Backend', description='', epilog='Backend daemon')
     parser.add_argument('--server-ip', default='0.0.0.0')
     parser.add_argument('--server-port', type=int, default=PORT)
+    parser.add_argument('--trace-file', default=None)
+    parser.add_argument('--profile-dir', default=None)
+    parser.add_argument('--replica', action='append', default=[], help='base URL of another tracker to share peers with, repeatable; replication must be configured on both sides')
+    parser.add_argument('--node-id', default=None, help='unique name of this tracker in its cluster (default: hostname plus a random suffix)')
+    parser.add_argument('--gossip-interval', type=float, default=1.0)
+    parser.add_argument('--secret', default=None, help='session signing key, shared by all replicas (default: $SESSION_SECRET)')
+    parser.add_argument('--token-ttl', type=int, default=auth.TOKEN_TTL)
     args = parser.parse_args()
     ip = args.server_ip
     port = args.server_port
+    auth.configure(args.secret, args.token_ttl)
+    if args.replica and not (args.secret or os.environ.get('SESSION_SECRET')):
+        print("Warning: replicas need a shared --secret to accept each other's tokens")
+    if args.node_id:
+        membership.node_id = args.node_id
+    replicator = Replicator(membership, args.replica, args.gossip_interval)
+    replicator.start()
     app.prepare_address(ip, port)
-    app.run()
\ No newline at end of file
+    app.run(trace_file=args.trace_file, profile_dir=args.profile_dir)
\ No newline at end of file
@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import resource
+import argparse
+import threading
+import subprocess
+import multiprocessing
+from queue import Empty
+from start_peer import Peer
+
+SWARM_CHANNEL = '#general'
+MESSAGE_PREFIX = 'swarm '
+
+class Inbox:
+    """
+    Stands in for a peer's UI queue and timestamps every benchmark
+    message the moment it is delivered.
+    """
+    def __init__(self):
+        self.receipts = []
+
+    def put(self, formatted_msg):
+        now = time.time()
+        content = formatted_msg.split(']: ', 1)[-1]
+        if content.startswith(MESSAGE_PREFIX):
+            self.receipts.append((content.split(' ', 2)[1], now))
+
+class SwarmPeer(Peer):
+    """
+    Peer that counts what it sends and receives. Only the loop thread
+    and the connect thread touch the counters.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.packets_received = 0
+        self.bytes_sent = 0
+        self.message_bytes_sent = 0
+        self.connect_ident = None
+
+    def run_connect_thread(self):
+        self.connect_ident = threading.get_ident()
+        super().run_connect_thread()
+
+    def handle_packet(self, conn, addr, message):
+        if message.get('type') == 'message':
+            self.packets_received += 1
+        super().handle_packet(conn, addr, message)
+
+    def send_packet(self, conn, packet):
+        data = (json.dumps(packet) + '\n').encode('utf-8')
+        self.bytes_sent += len(data)
+        if packet.get('type') == 'message':
+            self.message_bytes_sent += len(data)
+        conn.send(data)
+
+    def cpu_seconds(self):
+        total = 0.0
+        for ident in (self.loop.thread.ident if self.loop.thread else None, self.connect_ident):
+            if ident is None:
+                continue
+            try:
+                total += time.clock_gettime(time.pthread_getcpuclockid(ident))
+            except (OSError, AttributeError):
+                pass
+        return total
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def start_tracker(port):
+    root = os.path.dirname(os.path.abspath(__file__))
+    tracker = subprocess.Popen([sys.executable, os.path.join(root, 'start_sampleapp.py'), '--server-ip', '127.0.0.1', '--server-port', str(port)],
+                               cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return tracker
+        except OSError:
+            time.sleep(0.1)
+    tracker.kill()
+    raise SystemExit("Tracker did not start on port {}".format(port))
+
+def run_worker(worker, count, tracker_url, commands, results, verbose):
+    """
+    Host ``count`` peers in this process and answer the coordinator's
+    commands: ``status``, ``inject`` and ``finish``.
+    """
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    raise_fd_limit()
+    peers = []
+    for index in range(count):
+        peer = SwarmPeer(tracker=tracker_url, host='127.0.0.1', port=0, username='w{}p{}'.format(worker, index), ui_queue=Inbox(), history_capacity=100)
+        peer.start()
+        peers.append(peer)
+    sent = {}
+    sent_lock = threading.Lock()
+
+    def inject(start_at, duration, rate):
+        # Absolute schedule, so a slow send does not lower the rate
+        time.sleep(max(0, start_at - time.time()))
+        interval = 1.0 / rate
+        next_at = start_at
+        number = 0
+        while next_at < start_at + duration:
+            time.sleep(max(0, next_at - time.time()))
+            msg_id = 'w{}m{}'.format(worker, number)
+            peer = random.choice(peers)
+            with sent_lock:
+                sent[msg_id] = time.time()
+            peer.broadcast_message('{}{} {}'.format(MESSAGE_PREFIX, msg_id, 'x' * 32), SWARM_CHANNEL)
+            number += 1
+            next_at += interval
+
+    injector = None
+    while True:
+        command = commands.get()
+        if command[0] == 'status':
+            results.put(('status', worker, [len(peer.peers) for peer in peers]))
+        elif command[0] == 'inject':
+            _, start_at, duration, rate = command
+            if rate > 0:
+                injector = threading.Thread(target=inject, args=(start_at, duration, rate), daemon=True)
+                injector.start()
+        elif command[0] == 'finish':
+            if injector:
+                injector.join()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            stats = [{
+                "packets_received": peer.packets_received,
+                "delivered": len(peer.ui_queue.receipts),
+                "bytes_sent": peer.bytes_sent,
+                "message_bytes_sent": peer.message_bytes_sent,
+                "cpu": peer.cpu_seconds(),
+                "connections": len(peer.peers),
+            } for peer in peers]
+            receipts = [receipt for peer in peers for receipt in peer.ui_queue.receipts]
+            with sent_lock:
+                sent_copy = dict(sent)
+            process = {
+                "threads": threading.active_count(),
+                "cpu": usage.ru_utime + usage.ru_stime,
+                "max_rss_kb": usage.ru_maxrss,
+            }
+            for peer in peers:
+                peer.shutdown()
+            results.put(('result', worker, sent_copy, receipts, stats, process))
+            return
+
+def collect(results, kind, workers, timeout):
+    replies = {}
+    deadline = time.time() + timeout
+    while len(replies) < workers:
+        try:
+            reply = results.get(timeout=max(0.1, deadline - time.time()))
+        except Empty:
+            raise SystemExit("Workers did not answer {} in time".format(kind))
+        if reply[0] == kind:
+            replies[reply[1]] = reply[2:]
+    return replies
+
+def report(args, sent, receipts, stats, processes, settle_seconds, connections):
+    latencies = sorted(received - sent[msg_id] for msg_id, received in receipts if msg_id in sent)
+    expected = len(sent) * (args.peers - 1)
+    delivered = len(set(receipts))
+    packets = sum(s["packets_received"] for s in stats)
+    message_bytes = sum(s["message_bytes_sent"] for s in stats)
+    cpu = sorted(s["cpu"] for s in stats)
+    summary = {
+        "peers": args.peers,
+        "processes": args.processes,
+        "settle_seconds": round(settle_seconds, 2),
+        "connections_min": min(connections),
+        "connections_mean": round(sum(connections) / len(connections), 1),
+        "messages_sent": len(sent),
+        "delivery_ratio": round(delivered / expected, 4) if expected else 0.0,
+        "duplicate_rate": round(max(0, packets - delivered) / packets, 4) if packets else 0.0,
+        "latency_ms": {name: round(percentile(latencies, fraction) * 1000, 2)
+                       for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        "bytes_per_message": round(message_bytes / len(sent)) if sent else 0,
+        "bytes_per_peer": round(sum(s["bytes_sent"] for s in stats) / len(stats)),
+        "peer_cpu_seconds": {"p50": round(percentile(cpu, 0.5), 3), "p99": round(percentile(cpu, 0.99), 3), "max": round(cpu[-1], 3)},
+        "threads_per_peer": round(sum(p["threads"] for p in processes) / args.peers, 2),
+        "process_cpu_seconds": round(sum(p["cpu"] for p in processes), 2),
+        "max_rss_mb": round(max(p["max_rss_kb"] for p in processes) / 1024, 1),
+    }
+    print("Peers:            {} in {} process(es), mesh settled in {}s (min {} / mean {} connections)".format(
+        args.peers, args.processes, summary["settle_seconds"], summary["connections_min"], summary["connections_mean"]))
+    print("Messages:         {} sent at {}/s, delivery {:.2%}, duplicates {:.2%}".format(
+        len(sent), args.rate, summary["delivery_ratio"], summary["duplicate_rate"]))
+    print("Latency ms:       p50 {p50} p90 {p90} p99 {p99} max {max}".format(**summary["latency_ms"]))
+    print("Bytes:            {} per message (all copies), {} sent per peer".format(summary["bytes_per_message"], summary["bytes_per_peer"]))
+    print("Peer CPU s:       p50 {p50} p99 {p99} max {max}".format(**summary["peer_cpu_seconds"]))
+    print("Threads per peer: {}, process CPU {}s, max RSS {} MB".format(summary["threads_per_peer"], summary["process_cpu_seconds"], summary["max_rss_mb"]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+def run_swarm(args):
+    limit = raise_fd_limit()
+    per_process = -(-args.peers // args.processes)
+    # Every mesh link holds a socket at both ends
+    if per_process * (args.peers - 1) + 64 > limit:
+        print("Warning: {} peers per process need about {} descriptors, the limit is {}".format(
+            per_process, per_process * (args.peers - 1), limit))
+
+    tracker_port = args.tracker_port or free_port()
+    tracker = start_tracker(tracker_port)
+    tracker_url = "http://127.0.0.1:{}".format(tracker_port)
+    results = multiprocessing.Queue()
+    workers = []
+    try:
+        started = time.time()
+        for worker in range(args.processes):
+            count = args.peers // args.processes + (1 if worker < args.peers % args.processes else 0)
+            commands = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_worker, args=(worker, count, tracker_url, commands, results, args.verbose), daemon=True)
+            process.start()
+            workers.append((process, commands, count))
+
+        # Peers refresh the tracker list every 10s, so the mesh fills in steps
+        connections = []
+        while True:
+            for _, commands, _ in workers:
+                commands.put(('status',))
+            replies = collect(results, 'status', len(workers), 30)
+            connections = [count for reply in replies.values() for count in reply[0]]
+            if min(connections) >= args.peers - 1 or time.time() - started > args.settle:
+                break
+            time.sleep(0.5)
+        settle_seconds = time.time() - started
+
+        start_at = time.time() + 0.5
+        for _, commands, count in workers:
+            commands.put(('inject', start_at, args.duration, args.rate * count / args.peers))
+        time.sleep(max(0, start_at + args.duration + args.drain - time.time()))
+        for _, commands, _ in workers:
+            commands.put(('finish',))
+        replies = collect(results, 'result', len(workers), 60 + args.peers)
+
+        sent, receipts, stats, processes = {}, [], [], []
+        for worker_sent, worker_receipts, worker_stats, process in replies.values():
+            sent.update(worker_sent)
+            receipts.extend(worker_receipts)
+            stats.extend(worker_stats)
+            processes.append(process)
+        return report(args, sent, receipts, stats, processes, settle_seconds, connections)
+    finally:
+        for process, _, _ in workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        tracker.terminate()
+        tracker.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='Swarm', description='Measure message propagation across many local peers')
+    parser.add_argument('--peers', type=int, default=50)
+    parser.add_argument('--processes', type=int, default=max(1, min(os.cpu_count() or 1, 8)))
+    parser.add_argument('--rate', type=float, default=20.0, help='messages per second across the swarm')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--drain', type=float, default=3.0, help='seconds to wait for stragglers after the last send')
+    parser.add_argument('--settle', type=float, default=60.0, help='max seconds to wait for the full mesh')
+    parser.add_argument('--tracker-port', type=int, default=0)
+    parser.add_argument('--json', default=None, help='also write the summary to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep peer output')
+    args = parser.parse_args()
+    if args.peers < 2 or args.processes < 1:
+        parser.error("need at least 2 peers and 1 process")
+    args.processes = min(args.processes, args.peers)
+    run_swarm(args)
@@ -25,6 +25,7 @@ channelListDiv.addEventListener("click", (e) => {
       channelTitle.textContent = currentChannel;
       messagesDiv.innerHTML = "";
       addMessage(`Switched to channel <strong>${currentChannel}</strong>`);
+      loadHistory(currentChannel);
     }
   }
 });
@@ -164,6 +165,29 @@ async function pollMessages() {
   }
 }
 
+// --- HISTORY ---
+async function loadHistory(channel) {
+  try {
+    const response = await fetch(
+      `${API_BASE}/history?channel=${encodeURIComponent(channel)}&limit=50`
+    );
+    if (!response.ok) return;
+    const data = await response.json();
+    if (channel !== currentChannel) return;
+
+    for (const msg of data.messages) {
+      seenMessages.add(`${msg.sender}-${msg.raw}`);
+      if (msg.sender === USERNAME) {
+        addOwnMessage(msg.text);
+      } else {
+        addOtherMessage(msg.text, msg.sender);
+      }
+    }
+  } catch (e) {
+    console.error("History error:", e);
+  }
+}
+
 // --- INITIALIZE ---
 setTimeout(async () => {
   try {
@@ -172,6 +196,7 @@ setTimeout(async () => {
       const data = await response.json();
       addMessage(`Connected peers: ${data.peer_count}`);
       lastPeerCount = data.peer_count;
+      await loadHistory(currentChannel);
       pollMessages();
     }
   } catch (e) {
@@ -0,0 +1,59 @@
+import unittest
+from daemon.body import MultipartParser
+
+BOUNDARY = 'XyZ'
+
+def part(name, value, filename=None):
+    disposition = 'form-data; name="{}"'.format(name)
+    if filename is not None:
+        disposition += '; filename="{}"'.format(filename)
+    return b''.join((b'--XyZ\r\nContent-Disposition: ', disposition.encode('ascii'), b'\r\n\r\n', value, b'\r\n'))
+
+BODY = part('title', b'hello') + part('upload', b'0123456789' * 50, 'data.bin') + b'--XyZ--\r\n'
+
+def parse(body, step, **options):
+    parser = MultipartParser(BOUNDARY, **options)
+    for start in range(0, len(body), step):
+        parser.feed(body[start:start + step])
+    return parser, parser.close()
+
+class MultipartTest(unittest.TestCase):
+    def test_any_chunking_gives_the_same_parts(self):
+        # Steps of 1 and 7 split the delimiter at every possible place
+        for step in (1, 7, 64, len(BODY)):
+            _, (fields, files) = parse(BODY, step, threshold=100)
+            self.assertEqual(fields, {'title': 'hello'})
+            upload = files['upload']
+            self.assertEqual((upload.filename, upload.size), ('data.bin', 500))
+            self.assertEqual(upload.file.read(), b'0123456789' * 50)
+            upload.file.close()
+
+    def test_delimiter_lookalike_in_a_body_is_kept(self):
+        body = part('note', b'a\r\n--XyQ\r\n--Xy') + b'--XyZ--\r\n'
+        for step in (1, 3):
+            _, (fields, _) = parse(body, step)
+            self.assertEqual(fields['note'], 'a\r\n--XyQ\r\n--Xy')
+
+    def test_missing_closing_boundary_closes_files(self):
+        parser = MultipartParser(BOUNDARY)
+        parser.feed(part('upload', b'abc', 'a.txt') + part('other', b'x'))
+        upload = parser.files['upload']
+        self.assertRaises(ValueError, parser.close)
+        self.assertTrue(upload.file.closed)
+
+    def test_limits(self):
+        self.assertRaises(ValueError, parse, part('big', b'x' * 100) + b'--XyZ--\r\n', 16, max_field_size=50)
+        self.assertRaises(ValueError, parse, part('a', b'1') * 3 + b'--XyZ--\r\n', 16, max_fields=2)
+
+    def test_duplicate_file_name_closes_the_replaced_file(self):
+        parser = MultipartParser(BOUNDARY)
+        # The first part ends once the next delimiter has arrived
+        parser.feed(part('upload', b'first', 'a.txt') + b'--XyZ')
+        first = parser.files['upload']
+        parser.feed(part('upload', b'second', 'b.txt')[5:] + b'--XyZ--\r\n')
+        _, files = parser.close()
+        self.assertTrue(first.file.closed)
+        self.assertEqual(files['upload'].file.read(), b'second')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from daemon import auth
+from daemon.ratelimit import RateLimiter, parse_rate
+
+ADDR = ('10.0.0.1', 5000)
+
+class ClientKeyTest(unittest.TestCase):
+    def test_cookie_mode_keys_on_the_session_user(self):
+        limiter = RateLimiter({'limit_req_key': 'cookie', 'limit_req_client': '1r/s'})
+        token = auth.issue('alice')
+        self.assertEqual(limiter.client_key(ADDR, {'cookie': 'theme=dark; auth=' + token}), 'user:alice')
+        self.assertEqual(limiter.client_key(ADDR, {'cookie': 'theme=dark'}), '10.0.0.1')
+
+    def test_ip_cookie_mode_keys_on_both(self):
+        limiter = RateLimiter({'limit_req_key': 'ip_cookie', 'limit_req_client': '1r/s'})
+        token = auth.issue('alice')
+        self.assertEqual(limiter.client_key(ADDR, {'cookie': 'auth=' + token}), ('10.0.0.1', 'alice'))
+        self.assertEqual(limiter.client_key(ADDR, {}), '10.0.0.1')
+
+    def test_unverified_cookies_fall_back_to_the_ip(self):
+        for mode in ('cookie', 'ip_cookie'):
+            limiter = RateLimiter({'limit_req_key': mode, 'limit_req_client': '5r/s burst=1'})
+            self.assertIsNone(limiter.check(ADDR, {'cookie': 'auth=first'}))
+            self.assertIsNotNone(limiter.check(ADDR, {'cookie': 'auth=second'}))
+
+    def test_check_limits_per_key(self):
+        for mode in ('cookie', 'ip_cookie'):
+            limiter = RateLimiter({'limit_req_key': mode, 'limit_req_client': '5r/s burst=1'})
+            headers = {'cookie': 'auth=' + auth.issue('bob')}
+            self.assertIsNone(limiter.check(ADDR, headers))
+            self.assertIsNotNone(limiter.check(ADDR, headers))
+
+    def test_unknown_key_mode_is_rejected(self):
+        with self.assertRaises(ValueError):
+            RateLimiter({'limit_req_key': 'ip-cookie', 'limit_req_client': '1r/s'})
+
+class CheckTest(unittest.TestCase):
+    def test_zero_rate_is_rejected(self):
+        self.assertRaises(ValueError, parse_rate, '0r/s')
+
+    def test_host_rejection_does_not_spend_the_client_token(self):
+        limiter = RateLimiter({'limit_req_client': '1r/m burst=2', 'limit_req_host': '1r/m burst=1'})
+        self.assertIsNone(limiter.check(ADDR, {}))
+        self.assertIsNotNone(limiter.check(ADDR, {}))
+        # The host bucket refused the second request, so one client token is left
+        tokens, _ = limiter.client.stripes[hash(ADDR[0]) % len(limiter.client.stripes)][0][ADDR[0]]
+        self.assertAlmostEqual(tokens, 1.0, places=2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+from daemon.store import MessageStore
+
+def message(n):
+    return {"type": "message", "channels": "#general", "username": "alice", "content": "message {}".format(n), "timestamp": 1000.0 + n}
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def open_store(self, **options):
+        options.setdefault('fsync_policy', 'never')
+        return MessageStore(self.root, **options)
+
+    def log_files(self, channel='#general'):
+        directory = os.path.join(self.root, MessageStore.channel_dir(channel))
+        return sorted(name for name in os.listdir(directory) if name.endswith('.log'))
+
+    def test_segments_roll_and_read_back_in_order(self):
+        store = self.open_store(segment_bytes=256, index_interval=2)
+        for n in range(20):
+            self.assertEqual(store.append('#general', message(n)), n)
+        self.assertGreater(len(self.log_files()), 1)
+        records = store.read('#general', 0, 100)
+        self.assertEqual([offset for offset, _ in records], list(range(20)))
+        self.assertEqual(store.read('#general', 13, 2)[0][1]['content'], 'message 13')
+        store.close()
+        reopened = self.open_store(segment_bytes=256)
+        self.assertEqual([m['content'] for _, m in reopened.tail('#general', 3)], ['message 17', 'message 18', 'message 19'])
+        reopened.close()
+
+    def test_retention_drops_oldest_sealed_segments(self):
+        store = self.open_store(segment_bytes=256, retention_bytes=600)
+        for n in range(40):
+            store.append('#general', message(n))
+        records = store.read('#general', 0, 100)
+        self.assertGreater(records[0][0], 0)
+        self.assertEqual(records[-1][0], 39)
+        # Whatever is left is contiguous up to the newest record
+        self.assertEqual([offset for offset, _ in records], list(range(records[0][0], 40)))
+        store.close()
+
+    def test_torn_tail_is_truncated_on_recovery(self):
+        store = self.open_store()
+        for n in range(5):
+            store.append('#general', message(n))
+        store.close()
+        path = os.path.join(self.root, MessageStore.channel_dir('#general'), self.log_files()[-1])
+        intact = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            # A header promising more bytes than were written before the crash
+            f.write(b'\x40\x00\x00\x00partial')
+        reopened = self.open_store()
+        self.assertEqual(os.path.getsize(path), intact)
+        self.assertEqual(len(reopened.read('#general', 0, 100)), 5)
+        self.assertEqual(reopened.append('#general', message(5)), 5)
+        reopened.close()
+
+    def test_channel_names_stay_inside_the_root(self):
+        store = self.open_store()
+        for name in ('', '.', '..'):
+            self.assertRaises(ValueError, store.append, name, message(0))
+        store.append('../outside', message(0))
+        self.assertEqual(store.channels(), ['../outside'])
+        self.assertEqual(os.listdir(self.root), ['..%2Foutside'])
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
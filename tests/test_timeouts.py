@@ -0,0 +1,71 @@
+import socket
+import threading
+import time
+import unittest
+from daemon.timeouts import Deadline, TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        # A small wheel so a delay of a few ticks spans several revolutions
+        self.wheel = TimerWheel(tick=0.01, slots=4)
+
+    def schedule(self, delay):
+        fired = threading.Event()
+        self.wheel.schedule(delay, fired.set)
+        return fired
+
+    def test_timers_fire_after_their_delay(self):
+        started = time.monotonic()
+        times = {}
+        done = threading.Event()
+
+        def record(delay):
+            times[delay] = time.monotonic() - started
+            if len(times) == 3:
+                done.set()
+        for delay in (0.01, 0.05, 0.15):
+            self.wheel.schedule(delay, lambda delay=delay: record(delay))
+        self.assertTrue(done.wait(2))
+        for delay, elapsed in times.items():
+            self.assertGreaterEqual(elapsed, delay - 0.01)
+        self.assertLess(times[0.05], times[0.15])
+
+    def test_cancelled_timer_does_not_fire(self):
+        fired = threading.Event()
+        timer = self.wheel.schedule(0.05, fired.set)
+        self.wheel.cancel(timer)
+        self.assertFalse(fired.wait(0.2))
+
+    def test_failing_callback_does_not_stop_the_wheel(self):
+        self.wheel.schedule(0.01, lambda: 1 / 0)
+        self.assertTrue(self.schedule(0.03).wait(2))
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.conn, self.other = socket.socketpair()
+        self.conn.settimeout(2)
+
+    def tearDown(self):
+        self.conn.close()
+        self.other.close()
+
+    def test_expiry_shuts_the_connection_down(self):
+        deadline = Deadline(self.conn)
+        deadline.arm('idle', 0.05)
+        self.assertEqual(self.conn.recv(1), b'')
+        self.assertTrue(deadline.expired)
+
+    def test_timer_from_a_previous_phase_is_ignored(self):
+        deadline = Deadline(self.conn)
+        deadline.arm('idle', 5)
+        stale = deadline.generation
+        deadline.arm('body', 5)
+        # What a timer collected by the wheel just before the re-arm does
+        deadline.fire(stale)
+        deadline.cancel()
+        self.assertFalse(deadline.expired)
+        self.other.sendall(b'x')
+        self.assertEqual(self.conn.recv(1), b'x')
+
+if __name__ == '__main__':
+    unittest.main()